@@ -0,0 +1,316 @@
+"""Офлайн-бенчмарки бота на поддельном транспорте Telegram
+
+Бот работает как обычно, но вместо HTTP-запросов к Bot API ответы формирует FakeTelegram
+с заданной задержкой и долей ошибок. Все файлы бота создаются во временном каталоге.
+Результаты выводятся в JSON, чтобы сравнивать прогоны между собой:
+
+    python bench.py --latency-ms 5 --error-rate 0.01 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List
+
+import telegram
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+from telegram.request import BaseRequest
+
+BOT_TOKEN = "123456:BENCH"
+
+
+class FakeTelegram(BaseRequest):
+    """Bot API в памяти процесса: задержка на каждый вызов и случайные ошибки 403 при отправке"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls: Dict[str, int] = {}
+        self.errors = 0
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        params = request_data.parameters if request_data else {}
+
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+
+        if api_method.startswith("send") and self.random.random() < self.error_rate:
+            self.errors += 1
+            return 403, json.dumps({"ok": False, "error_code": 403,
+                                    "description": "Forbidden: bot was blocked by the user"}).encode()
+        return 200, json.dumps({"ok": True, "result": self._result(api_method, params)}).encode()
+
+    def _result(self, api_method: str, params: Dict):
+        if api_method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if api_method.startswith("send") or api_method == "editMessageText":
+            self._message_id += 1
+            message = {"message_id": self._message_id, "date": int(time.time()),
+                       "chat": {"id": int(params.get("chat_id", 1)), "type": "private"}}
+            if api_method == "sendDocument":
+                message["document"] = {"file_id": f"file-{self._message_id}", "file_unique_id": str(self._message_id)}
+            else:
+                message["text"] = params.get("text", "")
+            return message
+        return True
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """Сводка по выборке в миллисекундах"""
+    if not samples:
+        return {"count": 0}
+    ms = sorted(sample * 1000 for sample in samples)
+    cuts = statistics.quantiles(ms, n=100, method="inclusive") if len(ms) > 1 else ms * 99
+    return {
+        "count": len(ms),
+        "mean_ms": round(statistics.fmean(ms), 3),
+        "p50_ms": round(cuts[49], 3),
+        "p95_ms": round(cuts[94], 3),
+        "p99_ms": round(cuts[98], 3),
+        "max_ms": round(ms[-1], 3)
+    }
+
+
+def make_user(user_id: int, employee_name=None) -> Dict:
+    now = datetime.now().isoformat()
+    return {
+        "username": f"user{user_id}",
+        "first_name": "Bench",
+        "last_name": None,
+        "telegram_name": "Bench",
+        "notifications": True,
+        "selected_employee": employee_name,
+        "registered_at": now,
+        "last_active": now,
+        "is_admin": False
+    }
+
+
+def message_update(update_id: int, user_id: int, text: str) -> Dict:
+    update = {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"user{user_id}"},
+            "text": text
+        }
+    }
+    if text.startswith("/"):
+        update["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return update
+
+
+def callback_update(update_id: int, user_id: int, data: str) -> Dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": "bench",
+            "data": data,
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"user{user_id}"},
+            "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+                        "from": {"id": 1, "is_bot": True, "first_name": "Bench"}, "text": "меню"}
+        }
+    }
+
+
+class Bench:
+    def __init__(self, args):
+        import bot as bot_module
+        self.args = args
+        self.bot_module = bot_module
+        self.transport = FakeTelegram(args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate, args.seed)
+        self.duty_bot = bot_module.DutyBot(BOT_TOKEN)
+        self.duty_bot.application = (
+            ApplicationBuilder().token(BOT_TOKEN)
+            .request(self.transport)
+            .get_updates_request(FakeTelegram())
+            .build()
+        )
+        self.duty_bot.bot_instance = self.duty_bot.application.bot
+        self.duty_bot.register_handlers(self.duty_bot.application)
+        self._update_id = 0
+
+    def _next_update_id(self) -> int:
+        self._update_id += 1
+        return self._update_id
+
+    async def _process(self, payload: Dict) -> float:
+        application = self.duty_bot.application
+        update = Update.de_json(payload, application.bot)
+        started = time.perf_counter()
+        await application.process_update(update)
+        return time.perf_counter() - started
+
+    async def bench_broadcast(self, size: int) -> Dict:
+        """Рассылка всем пользователям через _send_notification_to_all_users"""
+        duty_bot = self.duty_bot
+        rate = self.args.rate or 1e9
+        duty_bot.broadcaster = self.bot_module.BroadcastEngine(concurrency=self.args.concurrency, global_rate=rate)
+
+        employees = list(self.bot_module.EMPLOYEE_PHONES)
+        base_id = 10_000_000
+        users = {str(base_id + i): make_user(base_id + i, employees[i % len(employees)] if i % 10 == 0 else None)
+                 for i in range(size)}
+        duty_bot.user_store.delete_many(list(duty_bot.user_data))
+        duty_bot.user_data.clear()
+        duty_bot.user_store.upsert_many(users.items())
+        duty_bot.user_data.update(users)
+
+        messages = duty_bot.notification_planner.get_variants("среда")
+        calls_before = self.transport.calls.get("sendMessage", 0)
+        started = time.perf_counter()
+        await duty_bot._send_notification_to_all_users(messages, "bench")
+        elapsed = time.perf_counter() - started
+        return {
+            "users": size,
+            "variants": len(messages),
+            "elapsed_s": round(elapsed, 3),
+            "messages_per_s": round(size / elapsed, 1) if elapsed else None,
+            "send_calls": self.transport.calls.get("sendMessage", 0) - calls_before,
+            "removed_users": size - len(duty_bot.user_data)
+        }
+
+    async def bench_start(self) -> Dict:
+        """/start: половина - новые пользователи, половина - повторный вход"""
+        samples = []
+        for i in range(self.args.iterations):
+            user_id = 20_000_000 + i // 2
+            samples.append(await self._process(message_update(self._next_update_id(), user_id, "/start")))
+        return percentiles(samples)
+
+    async def bench_buttons(self) -> Dict:
+        """button_handler по самым частым кнопкам зарегистрированного пользователя"""
+        user_id = 30_000_000
+        employee_name = self.bot_module.DUTY_ROTATION_CIRCLE[0]
+        self.duty_bot.user_data[str(user_id)] = make_user(user_id, employee_name)
+        results = {}
+        for data in ("full_schedule", "my_duty", "back_to_main", "instructions", "questions"):
+            samples = [await self._process(callback_update(self._next_update_id(), user_id, data))
+                       for _ in range(self.args.iterations)]
+            results[data] = percentiles(samples)
+        return results
+
+    def bench_schedule(self) -> Dict:
+        """Построение текста графика: холодный кэш (после правки) и теплый"""
+        generator = self.duty_bot.schedule_generator
+        cold, warm, employee = [], [], []
+        employee_name = self.bot_module.DUTY_ROTATION_CIRCLE[0]
+        for _ in range(self.args.iterations):
+            generator._bump_version()
+            started = time.perf_counter()
+            generator.get_schedule_text()
+            cold.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            generator.get_schedule_text()
+            warm.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            generator.get_employee_duties_text(employee_name)
+            employee.append(time.perf_counter() - started)
+        return {"schedule_cold": percentiles(cold), "schedule_warm": percentiles(warm),
+                "employee_duties": percentiles(employee)}
+
+    async def run(self) -> Dict:
+        results = {}
+        async with self.duty_bot.application:
+            if "schedule" in self.args.only:
+                results["schedule"] = self.bench_schedule()
+            if "start" in self.args.only:
+                results["start"] = await self.bench_start()
+            if "buttons" in self.args.only:
+                results["buttons"] = await self.bench_buttons()
+            if "broadcast" in self.args.only:
+                results["broadcast"] = [await self.bench_broadcast(size) for size in self.args.sizes]
+        self.duty_bot.user_writer.flush()
+        self.duty_bot.user_store.close()
+        return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки бота дежурств")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="задержка каждого вызова Bot API")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="случайная добавка к задержке (0..jitter)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля отправок, завершающихся 403")
+    parser.add_argument("--sizes", type=lambda s: [int(x) for x in s.split(",")], default=[1000, 10000, 100000],
+                        help="размеры рассылки через запятую")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="глобальный лимит рассылки, сообщ./с (0 - без лимита, 30 - как в боте)")
+    parser.add_argument("--concurrency", type=int, default=10, help="параллельность рассылки")
+    parser.add_argument("--iterations", type=int, default=200, help="повторов для измерений задержки")
+    parser.add_argument("--only", type=lambda s: s.split(","), default=["schedule", "start", "buttons", "broadcast"],
+                        help="какие группы запускать: schedule,start,buttons,broadcast")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="файл для JSON (по умолчанию - stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.getLogger().setLevel(logging.ERROR if args.error_rate else logging.WARNING)
+    logging.getLogger("bot").setLevel(logging.CRITICAL)
+
+    output = os.path.abspath(args.output) if args.output else None
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    workdir = tempfile.mkdtemp(prefix="duty-bench-")
+    os.chdir(workdir)
+
+    bench = Bench(args)
+    started = time.perf_counter()
+    results = asyncio.run(bench.run())
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "python_telegram_bot": telegram.__version__,
+            "latency_ms": args.latency_ms,
+            "jitter_ms": args.jitter_ms,
+            "error_rate": args.error_rate,
+            "rate_limit": args.rate,
+            "concurrency": args.concurrency,
+            "iterations": args.iterations,
+            "total_s": round(time.perf_counter() - started, 3),
+            "api_calls": bench.transport.calls,
+            "injected_errors": bench.transport.errors,
+            "workdir": workdir
+        },
+        "results": results
+    }
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
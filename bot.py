@@ -1,18 +1,41 @@
 import logging
 import json
 import os
+import re
+import random
+import signal
+import shutil
 import asyncio
+import bisect
+import functools
+import hashlib
+import hmac
+import io
+import sqlite3
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+import zipfile
+from xml.sax.saxutils import escape
+from itertools import islice
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (
     CommandHandler, CallbackQueryHandler,
-    MessageHandler, filters, ContextTypes, ApplicationBuilder
+    MessageHandler, TypeHandler, filters, ContextTypes, ApplicationBuilder
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
 import pytz
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 
 # Настройка логирования
 logging.basicConfig(
@@ -80,116 +103,590 @@ DUTY_ROTATION_CIRCLE = [
     "Каримов Т.Р."
 ]
 
-# Исходный базовый список для хранения ручных правок админов
-DUTY_SCHEDULE = []
+# Файл с ручными правками админов, телефонами и составом круга (переживает перезапуск)
+SCHEDULE_STORE_FILE = "schedule_store.jsonl"
+
+# Режим получения обновлений: "polling" (по умолчанию) или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Публичный адрес вебхука, который регистрируется в Telegram (например, https://example.org/telegram)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token; если не задан, создается при запуске
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Адрес Bot API, например локальный сервер-заглушка: http://127.0.0.1:8081/bot
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "")
+# Файл для записи входящих обновлений (JSON Lines) для replay.py; пусто - запись выключена
+UPDATE_CAPTURE_FILE = os.getenv("UPDATE_CAPTURE_FILE", "")
+# Адрес страницы метрик Prometheus (/metrics); порт 0 - отключить
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    parts = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    """Счетчик Prometheus с метками"""
+
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, label_values=(), amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма Prometheus: на одно наблюдение - поиск корзины и три сложения"""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # метки -> [счетчики по корзинам (без накопления), сумма, количество]
+        self.values: Dict[tuple, list] = {}
+
+    def observe(self, label_values, value: float):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_label = f'le="{le}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, bucket_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Метрики процесса в текстовом формате Prometheus
+
+    Счетчики и гистограммы обновляются в момент события; значения, которые и так
+    хранятся в объектах бота (кэши, очереди), собираются коллекторами только при запросе.
+    """
+
+    def __init__(self):
+        self.metrics: List = []
+        self.collectors: Dict[str, object] = {}
+
+    def counter(self, name: str, help_text: str, labels=()) -> Counter:
+        metric = Counter(name, help_text, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labels=(), buckets=Histogram.DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def set_collector(self, name: str, collect):
+        """collect() -> [(имя, тип, описание, [(метки, значение)])]"""
+        self.collectors[name] = collect
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collect in self.collectors.values():
+            try:
+                families = collect()
+            except Exception as e:
+                logger.error(f"Ошибка сбора метрик: {e}")
+                continue
+            for name, metric_type, help_text, samples in families:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels.keys(), labels.values())} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+HANDLER_LATENCY = METRICS.histogram(
+    "dutybot_handler_seconds", "Время обработки обновления обработчиком", ["handler"])
+BROADCAST_MESSAGES = METRICS.counter(
+    "dutybot_broadcast_messages_total", "Результаты рассылок: sent, failed, removed", ["type", "result"])
+TELEGRAM_API_LATENCY = METRICS.histogram(
+    "dutybot_telegram_api_seconds", "Время вызова Bot API", ["method"])
+TELEGRAM_API_ERRORS = METRICS.counter(
+    "dutybot_telegram_api_errors_total", "Вызовы Bot API, завершившиеся ошибкой", ["method"])
+BROADCAST_ERRORS = METRICS.counter(
+    "dutybot_broadcast_errors_total", "Ошибки отправки в рассылках по типу ошибки", ["error"])
+PERSISTENCE_FLUSH = METRICS.histogram(
+    "dutybot_persistence_flush_seconds", "Время записи на диск", ["store"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+
+
+class RenderCache:
+    """Ограниченный LRU-кэш готовых текстов со счетчиками попаданий"""
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._items: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> Optional[str]:
+        value = self._items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value: str):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+    def get_stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {"size": len(self._items), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0}
+
+
+class OverrideStore:
+    """Ручные правки графика, упорядоченные по дате
+
+    Ключ - порядковый номер дня (date.toordinal()). Поиск по дате O(1), вставка и удаление
+    через бинарный поиск по отсортированному списку ключей, выборка диапазона дат и
+    удаление прошедших правок - одним срезом.
+    """
+
+    def __init__(self):
+        self._keys: List[int] = []
+        self._items: Dict[int, Dict] = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, day: int) -> bool:
+        return day in self._items
+
+    def get(self, day: int) -> Optional[Dict]:
+        return self._items.get(day)
+
+    def put(self, duty: Dict) -> Optional[Dict]:
+        """Добавить правку, вернуть замененную правку на ту же дату"""
+        day = duty["date_obj"].toordinal()
+        previous = self._items.get(day)
+        if previous is None:
+            bisect.insort(self._keys, day)
+        self._items[day] = duty
+        return previous
+
+    def pop(self, day: int) -> Optional[Dict]:
+        duty = self._items.pop(day, None)
+        if duty is not None:
+            del self._keys[bisect.bisect_left(self._keys, day)]
+        return duty
+
+    def between(self, start_day: int, end_day: int) -> Iterator[Dict]:
+        """Правки с start_day по end_day включительно, по возрастанию даты"""
+        lo = bisect.bisect_left(self._keys, start_day)
+        hi = bisect.bisect_right(self._keys, end_day)
+        for day in self._keys[lo:hi]:
+            yield self._items[day]
+
+    def prune_before(self, day: int) -> List[Dict]:
+        """Удалить все правки раньше day за один проход, вернуть удаленные"""
+        cut = bisect.bisect_left(self._keys, day)
+        removed_keys, self._keys = self._keys[:cut], self._keys[cut:]
+        return [self._items.pop(k) for k in removed_keys]
+
+    def values(self) -> Iterator[Dict]:
+        for day in self._keys:
+            yield self._items[day]
+
+
+class EmployeeRegistry:
+    """Короткие стабильные ID сотрудников для callback_data
+
+    ФИО кириллицей занимает в UTF-8 по два байта на букву и упирается в лимит Telegram
+    в 64 байта; вместо него в кнопки кладется ID из нескольких символов base36.
+    Выданный ID закрепляется за сотрудником и не переиспользуется.
+    """
+
+    ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+    def __init__(self):
+        self._by_name: Dict[str, str] = {}
+        self._by_id: Dict[str, str] = {}
+        self._next = 0
+
+    def __len__(self) -> int:
+        return len(self._by_name)
+
+    def load(self, ids: Dict[str, str]):
+        """Восстановить соответствия {сотрудник: ID}"""
+        self._by_name = dict(ids)
+        self._by_id = {employee_id: name for name, employee_id in ids.items()}
+        self._next = max((int(employee_id, 36) + 1 for employee_id in self._by_id), default=0)
+
+    def get_id(self, employee_name: str) -> Optional[str]:
+        return self._by_name.get(employee_name)
+
+    def get_name(self, employee_id: str) -> Optional[str]:
+        return self._by_id.get(employee_id)
+
+    def assign(self, employee_name: str) -> str:
+        """Выдать сотруднику новый ID"""
+        number, employee_id = self._next, ""
+        while True:
+            number, digit = divmod(number, 36)
+            employee_id = self.ALPHABET[digit] + employee_id
+            if not number:
+                break
+        self._next += 1
+        self._by_name[employee_name] = employee_id
+        self._by_id[employee_id] = employee_name
+        return employee_id
+
+    def as_dict(self) -> Dict[str, str]:
+        return dict(self._by_name)
+
+
+def read_journal(path: str) -> List[Dict]:
+    """Записи журнала JSON Lines; недописанный при падении хвост отрезается
+
+    Без обрезки следующие записи легли бы после поврежденной строки, и при очередном
+    чтении пропали бы вместе с ней.
+    """
+    records = []
+    good_size = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+            good_size += len(line)
+    size = os.path.getsize(path)
+    if good_size < size:
+        logger.error(f"Поврежденный хвост журнала {path} ({size - good_size} байт) отрезан")
+        os.truncate(path, good_size)
+    return records
+
+
+class ScheduleStore:
+    """Хранилище правок графика: журнал изменений (JSON Lines) с периодическим уплотнением
+
+    Каждая правка дописывается в конец файла одной строкой. Когда после последнего снимка
+    накапливается compact_every записей, файл атомарно заменяется одним снимком состояния.
+    """
+
+    def __init__(self, path: str = SCHEDULE_STORE_FILE, compact_every: int = 200):
+        self.path = path
+        self.compact_every = compact_every
+        self.ops_since_snapshot = 0
+
+    def load(self) -> Dict:
+        """Восстановить состояние проигрыванием журнала
+
+        Возвращает {"overrides": {день: правка}, "phones", "rotation", "telegram", "employee_ids"};
+        None вместо словаря/списка означает, что значение ни разу не сохранялось.
+        """
+        state = {"overrides": {}, "phones": None, "rotation": None, "telegram": None, "employee_ids": {}}
+        self.ops_since_snapshot = 0
+        if not os.path.exists(self.path):
+            return state
+
+        started = time.monotonic()
+        for record in read_journal(self.path):
+            self._apply(state, record)
+            self.ops_since_snapshot += 1
+        logger.info(f"Правки графика загружены из {self.path} за {(time.monotonic() - started) * 1000:.1f} мс")
+        return state
+
+    @staticmethod
+    def _apply(state: Dict, record: Dict):
+        op = record["op"]
+        if op == "snapshot":
+            state["overrides"] = {duty["day"]: duty for duty in record["overrides"]}
+            state["phones"] = dict(record["phones"])
+            state["rotation"] = list(record["rotation"])
+            state["telegram"] = dict(record["telegram"])
+            state["employee_ids"] = dict(record.get("employee_ids", {}))
+        elif op == "duty_set":
+            state["overrides"][record["day"]] = record
+        elif op == "duty_del":
+            state["overrides"].pop(record["day"], None)
+        elif op == "phone_set":
+            state["phones"] = state["phones"] if state["phones"] is not None else dict(EMPLOYEE_PHONES)
+            state["phones"][record["name"]] = record["phone"]
+        elif op == "phone_del":
+            state["phones"] = state["phones"] if state["phones"] is not None else dict(EMPLOYEE_PHONES)
+            state["phones"].pop(record["name"], None)
+        elif op == "rotation":
+            state["rotation"] = list(record["members"])
+        elif op == "telegram_set":
+            state["telegram"] = state["telegram"] if state["telegram"] is not None else dict(TELEGRAM_TO_EMPLOYEE)
+            state["telegram"][record["username"]] = record["name"]
+        elif op == "telegram_del":
+            state["telegram"] = state["telegram"] if state["telegram"] is not None else dict(TELEGRAM_TO_EMPLOYEE)
+            state["telegram"].pop(record["username"], None)
+        elif op == "employee_id":
+            state["employee_ids"][record["name"]] = record["id"]
+
+    def append(self, record: Dict):
+        """Дописать одну правку"""
+        started = time.perf_counter()
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.ops_since_snapshot += 1
+        PERSISTENCE_FLUSH.observe(("schedule_log",), time.perf_counter() - started)
+
+    def should_compact(self) -> bool:
+        return self.ops_since_snapshot > self.compact_every
+
+    def compact(self, snapshot: Dict):
+        """Заменить журнал одним снимком текущего состояния"""
+        started = time.perf_counter()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(dict(snapshot, op="snapshot"), ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.ops_since_snapshot = 1
+        PERSISTENCE_FLUSH.observe(("schedule_compact",), time.perf_counter() - started)
+        logger.info(f"Журнал правок графика уплотнен: {len(snapshot['overrides'])} ручных дежурств")
 
 
 class DutyScheduleGenerator:
     """Генератор графика дежурств с поддержкой полного цикла из 12 недель"""
 
-    def __init__(self, schedule_data: List[Dict]):
-        self.schedule_data = schedule_data
-        self.schedule = {}
+    # Базовая точка отсчета: 30.05.2026 — это Осипов Р.Э (индекс 0 в кругу)
+    BASE_DATE = datetime(2026, 5, 30)
+    # Суббот в выводимом графике
+    SCHEDULE_WEEKS = 12
+
+    def __init__(self, store: ScheduleStore):
+        self.store = store
+        self.overrides = OverrideStore()
+        # Обратный индекс: сотрудник -> позиция в круге и отсортированные дни ручных субботних дежурств
+        self._rotation_position: Dict[str, List[int]] = {}
+        self._override_index: Dict[str, List[int]] = {}
+        self._rebuild_rotation_index()
+        # Версия графика: увеличивается при любой правке, от нее зависят все кэши
+        self.version = 0
+        self._dynamic_cache_key = None
+        self._dynamic_cache: Dict[int, Dict] = {}
+        self.cache_stats = {"hits": 0, "misses": 0}
+        self.render_cache = RenderCache(maxsize=64)
+        self.employee_ids = EmployeeRegistry()
         self.initialize_schedule()
 
+    @staticmethod
+    def format_date(date_obj: datetime) -> str:
+        """Дата дежурства для вывода: 06.06.2026г."""
+        return date_obj.strftime("%d.%m.%Yг.")
+
+    @staticmethod
+    def parse_date(date_str: str) -> datetime:
+        """Разбор даты из ввода админа (с «г.» или без)"""
+        return datetime.strptime(date_str.replace("г.", "").strip(), "%d.%m.%Y")
+
+    def _bump_version(self):
+        """Отметить изменение графика"""
+        self.version += 1
+
+    def _rebuild_rotation_index(self):
+        """Позиции сотрудников в круге дежурств (сотрудник может стоять в круге несколько раз)"""
+        self._rotation_position = {}
+        for position, employee_name in enumerate(DUTY_ROTATION_CIRCLE):
+            self._rotation_position.setdefault(employee_name, []).append(position)
+
+    def _index_override(self, duty: Dict):
+        """Добавить ручное дежурство в индекс сотрудников (учитываются только субботы)"""
+        if duty["date_obj"].weekday() != 5:
+            return
+        for employee_name in duty["employees"]:
+            bisect.insort(self._override_index.setdefault(employee_name, []), duty["date_obj"].toordinal())
+
+    def _unindex_override(self, duty: Dict):
+        """Убрать ручное дежурство из индекса сотрудников"""
+        day = duty["date_obj"].toordinal()
+        for employee_name in duty["employees"]:
+            days = self._override_index.get(employee_name)
+            if not days:
+                continue
+            i = bisect.bisect_left(days, day)
+            if i < len(days) and days[i] == day:
+                del days[i]
+            if not days:
+                del self._override_index[employee_name]
+
     def initialize_schedule(self):
-        """Инициализация первоначального графика"""
-        for duty in self.schedule_data:
-            self.schedule[duty["date"]] = {
-                "employees": duty["employees"],
-                "phones": duty["phones"],
-                "is_pair": duty["is_pair"],
-                "date_obj": duty["date_obj"]
+        """Инициализация графика из хранилища правок"""
+        state = self.store.load()
+
+        # Справочники меняются на месте: на них ссылается весь модуль
+        if state["phones"] is not None:
+            EMPLOYEE_PHONES.clear()
+            EMPLOYEE_PHONES.update(state["phones"])
+        if state["telegram"] is not None:
+            TELEGRAM_TO_EMPLOYEE.clear()
+            TELEGRAM_TO_EMPLOYEE.update(state["telegram"])
+        if state["rotation"] is not None:
+            DUTY_ROTATION_CIRCLE[:] = state["rotation"]
+            self._rebuild_rotation_index()
+        self.employee_ids.load(state["employee_ids"])
+        for employee_name in EMPLOYEE_PHONES:
+            self.get_employee_id(employee_name)
+
+        for record in state["overrides"].values():
+            duty = {
+                "employees": record["employees"],
+                "phones": record["phones"],
+                "is_pair": record["is_pair"],
+                "date_obj": datetime.fromordinal(record["day"])
             }
-        logger.info(f"Загружен график на {len(self.schedule)} недель")
+            self.overrides.put(duty)
+            self._index_override(duty)
+        logger.info(f"Загружен график на {len(self.overrides)} недель")
         self.remove_past_duties()
+        if self.store.should_compact():
+            self.store.compact(self._snapshot())
+
+    def _snapshot(self) -> Dict:
+        """Полное состояние для уплотнения журнала"""
+        return {
+            "overrides": [self._duty_record(duty) for duty in self.overrides.values()],
+            "phones": dict(EMPLOYEE_PHONES),
+            "rotation": list(DUTY_ROTATION_CIRCLE),
+            "telegram": dict(TELEGRAM_TO_EMPLOYEE),
+            "employee_ids": self.employee_ids.as_dict()
+        }
 
-    def remove_past_duties(self):
-        """Удаление прошедших ручных дежурств"""
-        today = datetime.now(MOSCOW_TZ).replace(tzinfo=None)
-        dates_to_remove = []
-
-        for date_str, duty in self.schedule.items():
-            if duty["date_obj"] < today:
-                dates_to_remove.append(date_str)
-
-        for date_str in dates_to_remove:
-            del self.schedule[date_str]
-            self.schedule_data = [d for d in self.schedule_data if d["date"] != date_str]
-
-        if dates_to_remove:
-            logger.info(f"Удалено {len(dates_to_remove)} прошедших ручных дежурств")
-
-    def _get_upcoming_saturdays(self, count: int = 12) -> List[datetime]:
-        """Генерирует список суббот вперед, начиная с текущей недели"""
-        saturdays = []
-        today = datetime.now(MOSCOW_TZ).replace(hour=0, minute=0, second=0, microsecond=0).replace(tzinfo=None)
-
-        days_ahead = 5 - today.weekday()
-        if days_ahead < 0:
-            days_ahead += 7
+    @staticmethod
+    def _duty_record(duty: Dict) -> Dict:
+        return {
+            "day": duty["date_obj"].toordinal(),
+            "employees": duty["employees"],
+            "phones": duty["phones"],
+            "is_pair": duty["is_pair"]
+        }
 
-        current_saturday = today + timedelta(days=days_ahead)
+    def _persist(self, record: Dict):
+        """Записать правку в журнал, при необходимости уплотнить его"""
+        try:
+            self.store.append(record)
+            if self.store.should_compact():
+                self.store.compact(self._snapshot())
+        except Exception as e:
+            logger.error(f"Ошибка сохранения правки графика {record.get('op')}: {e}")
 
-        for _ in range(count):
-            saturdays.append(current_saturday)
-            current_saturday += timedelta(days=7)
+    def remove_past_duties(self):
+        """Удаление прошедших ручных дежурств (сегодняшнее остается)"""
+        today = datetime.now(MOSCOW_TZ).replace(tzinfo=None)
+        removed = self.overrides.prune_before(today.toordinal())
 
-        return saturdays
+        for duty in removed:
+            self._unindex_override(duty)
+            self._persist({"op": "duty_del", "day": duty["date_obj"].toordinal()})
 
-    def _generate_dynamic_schedule(self) -> Dict[str, Dict]:
-        """ИСПРАВЛЕНО: Строит полный цикл из 12 суббот подряд, накладывая ручные правки на автоматический круг"""
-        # Базовая точка отсчета: 30.05.2026 — это Осипов Р.Э (индекс 0 в кругу)
-        base_date = datetime(2026, 5, 30)
-        base_index = 0
+        if removed:
+            self._bump_version()
+            logger.info(f"Удалено {len(removed)} прошедших ручных дежурств")
 
+    def _current_week_start(self) -> datetime:
+        """Первая суббота отображаемого цикла"""
         now_moscow = datetime.now(MOSCOW_TZ).replace(tzinfo=None)
-        all_saturdays = self._get_upcoming_saturdays(count=13)
+        today = now_moscow.replace(hour=0, minute=0, second=0, microsecond=0)
+        first_saturday = today + timedelta(days=(5 - today.weekday()) % 7)
 
         # Если сегодня суббота и время >= 8:00 утра, текущая суббота завершена — сдвигаем цикл на следующую субботу
         if now_moscow.weekday() == 5 and now_moscow.hour >= 8:
-            active_saturdays = all_saturdays[1:13]  # Берем ровно 12 суббот со следующей недели
-        else:
-            active_saturdays = all_saturdays[:12]  # Берем ровно 12 суббот начиная с текущей недели
-
-        dynamic_schedule = {}
-
-        for sat in active_saturdays:
-            date_str = sat.strftime("%d.%m.%Yг.")
-
-            # Приоритет ручной записи админа
-            if date_str in self.schedule:
-                dynamic_schedule[date_str] = self.schedule[date_str]
-            else:
-                # Математический расчет по кругу (всегда выстраивает полный цикл из 12 человек вперед)
-                weeks_diff = int((sat - base_date).days / 7)
-                employee_index = (base_index + weeks_diff) % len(DUTY_ROTATION_CIRCLE)
-                employee_name = DUTY_ROTATION_CIRCLE[employee_index]
-                phone = EMPLOYEE_PHONES.get(employee_name, "не указан")
-
-                dynamic_schedule[date_str] = {
-                    "employees": [employee_name],
-                    "phones": [phone],
-                    "is_pair": False,
-                    "date_obj": sat
-                }
+            first_saturday += timedelta(days=7)
+        return first_saturday
+
+    def _generate_dynamic_schedule(self) -> Dict[int, Dict]:
+        """ИСПРАВЛЕНО: Строит полный цикл из 12 суббот подряд, накладывая ручные правки на автоматический круг
+
+        Ключ - порядковый номер дня (date.toordinal()), строки дат формируются только при выводе.
+        Результат кэшируется по (первая суббота цикла, версия графика) - повторный вызов O(1).
+        Возвращаемый словарь общий для всех вызовов, изменять его нельзя.
+        """
+        week_start = self._current_week_start()
+        cache_key = (week_start.toordinal(), self.version)
+        if cache_key == self._dynamic_cache_key:
+            self.cache_stats["hits"] += 1
+            return self._dynamic_cache
+        self.cache_stats["misses"] += 1
+
+        dynamic_schedule = {
+            duty["date_obj"].toordinal(): duty
+            for duty in self.iter_duties(week_start, week_start + timedelta(weeks=self.SCHEDULE_WEEKS - 1))
+        }
 
+        self._dynamic_cache_key = cache_key
+        self._dynamic_cache = dynamic_schedule
         return dynamic_schedule
 
     def get_schedule_text(self) -> str:
         """Форматирование графика в текстовый вид"""
+        # Тело кэшируется по версии и неделе, отметка времени добавляется при каждом чтении
+        cache_key = ("schedule", self.version, self._current_week_start().toordinal())
+        text = self.render_cache.get(cache_key)
+        if text is None:
+            text = self._render_schedule_body()
+            self.render_cache.put(cache_key, text)
+        return text + f"<i>Актуально на: {datetime.now(MOSCOW_TZ).strftime('%d.%m.%Y %H:%M')}</i>"
+
+    def _render_schedule_body(self) -> str:
         text = "📅 <b>АКТУАЛЬНЫЙ ГРАФИК ДЕЖУРСТВ</b>\n\n"
 
         # Получаем объединенный динамический график
         current_schedule = self._generate_dynamic_schedule()
 
         # Сортируем по дате
-        duties_list = sorted(current_schedule.items(), key=lambda x: x[1]["date_obj"])
+        duties_list = [current_schedule[day] for day in sorted(current_schedule)]
 
         if not duties_list:
             text += "Нет запланированных дежурств\n"
         else:
-            for i, (date_str, duty) in enumerate(duties_list):
+            for i, duty in enumerate(duties_list):
+                date_str = self.format_date(duty["date_obj"])
                 if i == 0:
                     text += f"<b>{date_str} (Ближайшее)</b>\n"
                 else:
@@ -202,84 +699,203 @@ class DutyScheduleGenerator:
                     text += f"{duty['employees'][0]}\n"
                     text += f"{duty['phones'][0]}\n\n"
 
-        text += f"<i>Актуально на: {datetime.now(MOSCOW_TZ).strftime('%d.%m.%Y %H:%M')}</i>"
         return text
 
-    def get_employee_schedule(self, employee_name: str) -> List[Dict]:
-        """Получить все дежурства конкретного сотрудника"""
-        result = []
-        current_schedule = self._generate_dynamic_schedule()
+    def get_employee_duties_text(self, employee_name: str) -> str:
+        """Текст «Моё дежурство» для сотрудника (кэшируется до смены версии, недели или дня)"""
+        today = datetime.now(MOSCOW_TZ).replace(tzinfo=None)
+        cache_key = ("employee", self.version, self._current_week_start().toordinal(), today.toordinal(), employee_name)
+        text = self.render_cache.get(cache_key)
+        if text is not None:
+            return text
 
-        for date_str, duty in current_schedule.items():
-            if employee_name in duty["employees"]:
-                result.append({
-                    "date": date_str,
-                    "employees": duty["employees"],
-                    "phones": duty["phones"],
-                    "is_pair": duty["is_pair"],
-                    "date_obj": duty["date_obj"]
-                })
-        return sorted(result, key=lambda x: x["date_obj"])
+        duties = self.get_upcoming_duties(employee_name, 3)
+        if not duties:
+            text = f"📅 <b>БЛИЖАЙШИЕ ДЕЖУРСТВА: {employee_name}</b>\n\nНет запланированных дежурств"
+        else:
+            text = f"📅 <b>БЛИЖАЙШИЕ ДЕЖУРСТВА: {employee_name}</b>\n\n"
+            for duty in duties:
+                days_left = (duty["date_obj"] - today).days
+                date_str = self.format_date(duty["date_obj"])
+                if duty["is_pair"]:
+                    partners = [e for e in duty["employees"] if e != employee_name]
+                    duty_text = f"{date_str} (с {', '.join(partners)})"
+                    phones = ', '.join(duty['phones'])
+                else:
+                    duty_text = date_str
+                    phones = duty['phones'][0]
 
-    def get_next_duty(self, employee_name: str) -> Optional[Dict]:
-        """Получить следующее дежурство сотрудника"""
-        duties = self.get_employee_schedule(employee_name)
-        return duties[0] if duties else None
+                text += f"{duty_text}\n📅 Осталось: {max(0, days_left)} дней\n📞 {phones}\n\n"
 
-    def get_todays_duty(self) -> Optional[Dict]:
-        """Получить дежурных на сегодня"""
-        now_moscow = datetime.now(MOSCOW_TZ).replace(tzinfo=None)
-        today_str = now_moscow.strftime("%d.%m.%Yг.")
+        self.render_cache.put(cache_key, text)
+        return text
 
-        # Проверяем ручные записи
-        if today_str in self.schedule:
-            return self.schedule[today_str]
+    def get_fairness_text(self) -> str:
+        """Строка статистики о равномерности нагрузки на год вперед (кэшируется до смены версии или дня)"""
+        today = datetime.now(MOSCOW_TZ).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+        cache_key = ("fairness", self.version, today.toordinal())
+        text = self.render_cache.get(cache_key)
+        if text is not None:
+            return text
+
+        text = ""
+        counts = self.duty_counts(today, today + timedelta(weeks=52))
+        if counts:
+            busiest = max(counts, key=counts.get)
+            text = (
+                f"⚖️ <b>Дежурств на год вперед:</b> от {min(counts.values())} до {counts[busiest]} "
+                f"на сотрудника (больше всех - {busiest})\n"
+            )
+        self.render_cache.put(cache_key, text)
+        return text
 
-        # Проверяем автоматический круг
-        base_date = datetime(2026, 5, 30)
-        all_saturdays = self._get_upcoming_saturdays(count=5)
-        for sat in all_saturdays:
-            if sat.strftime("%d.%m.%Yг.") == today_str:
-                weeks_diff = int((sat - base_date).days / 7)
-                employee_index = weeks_diff % len(DUTY_ROTATION_CIRCLE)
-                employee_name = DUTY_ROTATION_CIRCLE[employee_index]
-                return {
+    def _rotation_duty(self, sat: datetime) -> Dict:
+        """Дежурство по кругу на субботу sat: индекс в круге считается напрямую от базовой даты"""
+        employee_name = DUTY_ROTATION_CIRCLE[((sat - self.BASE_DATE).days // 7) % len(DUTY_ROTATION_CIRCLE)]
+        return {
+            "employees": [employee_name],
+            "phones": [EMPLOYEE_PHONES.get(employee_name, "не указан")],
+            "is_pair": False,
+            "date_obj": sat
+        }
+
+    def iter_duties(self, start: datetime, end: datetime) -> Iterator[Dict]:
+        """Дежурства по субботам с start по end включительно, ручные правки поверх круга
+
+        Работает для любого диапазона, в том числе прошлого; каждая суббота рассчитывается
+        только при обращении, поэтому годовые выгрузки не строят промежуточных словарей.
+        Ручные правки диапазона берутся одной выборкой и сливаются с кругом по порядку дат.
+        """
+        sat = datetime(start.year, start.month, start.day)
+        sat += timedelta(days=(5 - sat.weekday()) % 7)
+        last_day = end.toordinal()
+        step = timedelta(weeks=1)
+        overrides = self.overrides.between(sat.toordinal(), last_day)
+        override = next(overrides, None)
+        while sat.toordinal() <= last_day:
+            day = sat.toordinal()
+            # Правки на другие дни недели в субботний график не попадают
+            while override is not None and override["date_obj"].toordinal() < day:
+                override = next(overrides, None)
+            if override is not None and override["date_obj"].toordinal() == day:
+                yield override
+            else:
+                yield self._rotation_duty(sat)
+            sat += step
+
+    def duty_counts(self, start: datetime, end: datetime) -> Dict[str, int]:
+        """Сколько раз дежурил каждый сотрудник за период (для проверки равномерности)"""
+        counts: Dict[str, int] = {}
+        for duty in self.iter_duties(start, end):
+            for employee_name in duty["employees"]:
+                counts[employee_name] = counts.get(employee_name, 0) + 1
+        return counts
+
+    def _iter_rotation_dates(self, employee_name: str, start: datetime) -> Iterator[datetime]:
+        """Субботы сотрудника по кругу начиная со start (без учета ручных правок)"""
+        positions = self._rotation_position.get(employee_name)
+        if not positions:
+            return
+        circle_size = len(DUTY_ROTATION_CIRCLE)
+        # Номер первой субботы не раньше start относительно базовой даты, затем смещения до недель сотрудника
+        start = datetime(start.year, start.month, start.day)
+        week = -((self.BASE_DATE - start).days // 7)
+        offsets = sorted((position - week) % circle_size for position in positions)
+        sat = self.BASE_DATE + timedelta(weeks=week)
+        step = timedelta(weeks=circle_size)
+        while True:
+            for offset in offsets:
+                yield sat + timedelta(weeks=offset)
+            sat += step
+
+    def iter_employee_duties(self, employee_name: str, start: datetime,
+                             end: Optional[datetime] = None) -> Iterator[Dict]:
+        """Дежурства сотрудника по возрастанию даты с start по end: круг с учетом ручных правок
+
+        Недели других сотрудников не перебираются - круг шагает сразу через len(DUTY_ROTATION_CIRCLE) недель.
+        Без end итератор для сотрудника из круга бесконечен.
+        """
+        if end is not None:
+            last_day = end.toordinal()
+            for duty in self.iter_employee_duties(employee_name, start):
+                if duty["date_obj"].toordinal() > last_day:
+                    return
+                yield duty
+            return
+
+        override_days = self._override_index.get(employee_name, [])
+        i = bisect.bisect_left(override_days, start.toordinal())
+        rotation = self._iter_rotation_dates(employee_name, start)
+        next_rotation = next(rotation, None)
+
+        while True:
+            # Дата по кругу, перекрытая ручной правкой, не считается дежурством по кругу
+            while next_rotation is not None and next_rotation.toordinal() in self.overrides:
+                next_rotation = next(rotation, None)
+
+            next_override = override_days[i] if i < len(override_days) else None
+            if next_override is None and next_rotation is None:
+                return
+
+            if next_rotation is None or (next_override is not None and next_override <= next_rotation.toordinal()):
+                i += 1
+                yield self.overrides.get(next_override)
+            else:
+                yield {
                     "employees": [employee_name],
-                    "phones": [EMPLOYEE_PHONES.get(employee_name)],
+                    "phones": [EMPLOYEE_PHONES.get(employee_name, "не указан")],
                     "is_pair": False,
-                    "date_obj": sat
+                    "date_obj": next_rotation
                 }
+                next_rotation = next(rotation, None)
+
+    def get_upcoming_duties(self, employee_name: str, count: int) -> List[Dict]:
+        """Ближайшие count дежурств сотрудника без ограничения горизонта"""
+        return list(islice(self.iter_employee_duties(employee_name, self._current_week_start()), count))
+
+    def get_next_duty(self, employee_name: str) -> Optional[Dict]:
+        """Получить следующее дежурство сотрудника"""
+        return next(self.iter_employee_duties(employee_name, self._current_week_start()), None)
+
+    def get_duty(self, date_obj: datetime) -> Optional[Dict]:
+        """Получить дежурных на конкретную дату: ручная правка или круг (по субботам)"""
+        # Проверяем ручные записи
+        override = self.overrides.get(date_obj.toordinal())
+        if override is not None:
+            return override
+
+        # Проверяем автоматический круг
+        if date_obj.weekday() == 5 and DUTY_ROTATION_CIRCLE:
+            return self._rotation_duty(datetime(date_obj.year, date_obj.month, date_obj.day))
         return None
 
+    def get_todays_duty(self) -> Optional[Dict]:
+        """Получить дежурных на сегодня"""
+        return self.get_duty(datetime.now(MOSCOW_TZ).replace(tzinfo=None))
+
     def add_duty(self, date_str: str, employees: List[str], phones: List[str], is_pair: bool):
         """Добавить ручное дежурство (перезаписывает круг на эту дату)"""
         try:
-            date_str_clean = date_str.replace("г.", "").strip()
-            date_obj = datetime.strptime(date_str_clean, "%d.%m.%Y")
+            date_obj = self.parse_date(date_str)
             today = datetime.now(MOSCOW_TZ).replace(tzinfo=None)
 
-            if date_obj < today and date_str != today.strftime("%d.%m.%Yг."):
+            if date_obj.toordinal() < today.toordinal():
                 return False, "Дата должна быть в будущем или текущей"
 
-            if not date_str.endswith("г."):
-                date_str += "г."
-
-            self.schedule[date_str] = {
+            duty = {
                 "employees": employees,
                 "phones": phones,
                 "is_pair": is_pair,
                 "date_obj": date_obj
             }
-
-            self.schedule_data.append({
-                "date": date_str,
-                "date_obj": date_obj,
-                "employees": employees,
-                "phones": phones,
-                "is_pair": is_pair
-            })
-
-            logger.info(f"Добавлено ручное дежурство: {date_str} - {employees}")
+            previous = self.overrides.put(duty)
+            if previous is not None:
+                self._unindex_override(previous)
+            self._index_override(duty)
+            self._persist(dict(self._duty_record(duty), op="duty_set"))
+
+            self._bump_version()
+            logger.info(f"Добавлено ручное дежурство: {self.format_date(date_obj)} - {employees}")
             return True, "Дежурство успешно добавлено"
         except Exception as e:
             logger.error(f"Ошибка добавления дежурства: {e}")
@@ -287,12 +903,16 @@ class DutyScheduleGenerator:
 
     def remove_duty(self, date_str: str) -> bool:
         """Удалить ручное дежурство (вернуть на эту дату автоматический круг)"""
-        if not date_str.endswith("г."):
-            date_str += "г."
-        if date_str in self.schedule:
-            del self.schedule[date_str]
-            self.schedule_data = [d for d in self.schedule_data if d["date"] != date_str]
-            logger.info(f"Удалено ручное дежурство: {date_str}")
+        try:
+            date_obj = self.parse_date(date_str)
+        except ValueError:
+            return False
+        duty = self.overrides.pop(date_obj.toordinal())
+        if duty is not None:
+            self._unindex_override(duty)
+            self._persist({"op": "duty_del", "day": duty["date_obj"].toordinal()})
+            self._bump_version()
+            logger.info(f"Удалено ручное дежурство: {self.format_date(date_obj)}")
             return True
         return False
 
@@ -300,6 +920,8 @@ class DutyScheduleGenerator:
         global EMPLOYEE_PHONES
         if employee_name in EMPLOYEE_PHONES:
             EMPLOYEE_PHONES[employee_name] = new_phone
+            self._persist({"op": "phone_set", "name": employee_name, "phone": new_phone})
+            self._bump_version()
             logger.info(f"Обновлен телефон {employee_name}: {new_phone}")
             return True
         return False
@@ -308,6 +930,9 @@ class DutyScheduleGenerator:
         global EMPLOYEE_PHONES
         if employee_name not in EMPLOYEE_PHONES:
             EMPLOYEE_PHONES[employee_name] = phone
+            self._persist({"op": "phone_set", "name": employee_name, "phone": phone})
+            self.get_employee_id(employee_name)
+            self._bump_version()
             logger.info(f"Добавлен сотрудник: {employee_name} - {phone}")
             return True
         return False
@@ -316,22 +941,1415 @@ class DutyScheduleGenerator:
         global EMPLOYEE_PHONES
         if employee_name in EMPLOYEE_PHONES:
             del EMPLOYEE_PHONES[employee_name]
+            self._persist({"op": "phone_del", "name": employee_name})
+            self._bump_version()
             logger.info(f"Удален сотрудник: {employee_name}")
             return True
         return False
 
+    def get_employee_id(self, employee_name: str) -> str:
+        """Короткий ID сотрудника для callback_data, при первом обращении выдается и сохраняется"""
+        employee_id = self.employee_ids.get_id(employee_name)
+        if employee_id is None:
+            employee_id = self.employee_ids.assign(employee_name)
+            self._persist({"op": "employee_id", "name": employee_name, "id": employee_id})
+        return employee_id
+
+    def get_employee_by_id(self, employee_id: str) -> Optional[str]:
+        """Сотрудник по ID из callback_data; кнопки старого формата содержали ФИО целиком
+
+        None - если ID неизвестен или сотрудник уже удален (кнопка устарела).
+        """
+        employee_name = self.employee_ids.get_name(employee_id) or employee_id
+        return employee_name if employee_name in EMPLOYEE_PHONES else None
+
+    def set_rotation(self, members: List[str]):
+        """Задать новый состав и порядок круга дежурств"""
+        DUTY_ROTATION_CIRCLE[:] = members
+        self._rebuild_rotation_index()
+        self._persist({"op": "rotation", "members": list(members)})
+        self._bump_version()
+        logger.info(f"Обновлен круг дежурств: {len(members)} сотрудников")
+
+    def link_telegram(self, telegram_username: str, employee_name: str):
+        """Привязать Telegram username к сотруднику"""
+        if not telegram_username.startswith('@'):
+            telegram_username = '@' + telegram_username
+        telegram_username = telegram_username.lower()
+        TELEGRAM_TO_EMPLOYEE[telegram_username] = employee_name
+        self._persist({"op": "telegram_set", "username": telegram_username, "name": employee_name})
+        self._bump_version()
+        return telegram_username
+
+    def unlink_telegram(self, employee_name: str) -> List[str]:
+        """Отвязать все Telegram username сотрудника, вернуть отвязанные"""
+        usernames = [tg_user for tg_user, emp_name in TELEGRAM_TO_EMPLOYEE.items() if emp_name == employee_name]
+        for tg_user in usernames:
+            del TELEGRAM_TO_EMPLOYEE[tg_user]
+            self._persist({"op": "telegram_del", "username": tg_user})
+        if usernames:
+            self._bump_version()
+        return usernames
+
+
+class NotificationPlanner:
+    """Тексты трех уведомлений недели (среда, пятница, суббота) о ближайшей субботе
+
+    Все три текста строятся один раз и перестраиваются только при смене субботы или версии
+    графика, поэтому задачи планировщика отправляют уже готовые сообщения.
+    """
+
+    KINDS = ("среда", "пятница", "суббота")
+
+    # Шапка персонального варианта для дежурного
+    PERSONAL_HEADERS = {
+        "среда": "👤 <b>В эту субботу дежурите вы!</b>",
+        "пятница": "👤 <b>Завтра дежурите вы!</b>",
+        "суббота": "🙏 <b>Спасибо за дежурство!</b>"
+    }
+
+    def __init__(self, schedule_generator: DutyScheduleGenerator):
+        self.schedule_generator = schedule_generator
+        self._plan_key = None
+        self._plan: Dict = {}
+        self.stats = {"renders": 0, "hits": 0}
+
+    @staticmethod
+    def _week_saturday(now: datetime) -> datetime:
+        """Суббота текущей недели уведомлений (в воскресенье - следующая)"""
+        today = datetime(now.year, now.month, now.day)
+        return today + timedelta(days=(5 - today.weekday()) % 7)
+
+    @staticmethod
+    def _duty_texts(duty: Dict):
+        if duty["is_pair"]:
+            return (f"{duty['employees'][0]} + {duty['employees'][1]}",
+                    f"{duty['phones'][0]} + {duty['phones'][1]}")
+        return f"{duty['employees'][0]}", f"{duty['phones'][0]}"
+
+    def get_week_plan(self, now: Optional[datetime] = None) -> Dict:
+        """{"saturday": дата, "version": версия графика, "messages": {вид: текст}}"""
+        now = now or datetime.now(MOSCOW_TZ).replace(tzinfo=None)
+        saturday = self._week_saturday(now)
+        key = (saturday.toordinal(), self.schedule_generator.version)
+        if key == self._plan_key:
+            self.stats["hits"] += 1
+            return self._plan
+
+        duty = self.schedule_generator.get_duty(saturday)
+        messages = {
+            "среда": self._render_wednesday(saturday, duty),
+            "пятница": self._render_friday(saturday, duty),
+            "суббота": self._render_saturday(saturday, duty)
+        }
+        self._plan = {
+            "saturday": saturday,
+            "version": self.schedule_generator.version,
+            "duty_employees": list(duty["employees"]) if duty else [],
+            "messages": messages,
+            "variants": {kind: self._render_variants(kind, messages[kind], duty) for kind in self.KINDS}
+        }
+        self._plan_key = key
+        self.stats["renders"] += 1
+        logger.info(f"Подготовлены уведомления на неделю субботы {saturday.strftime('%d.%m.%Y')}")
+        return self._plan
+
+    def get_message(self, kind: str, now: Optional[datetime] = None) -> str:
+        return self.get_week_plan(now)["messages"][kind]
+
+    def get_variants(self, kind: str, now: Optional[datetime] = None) -> Dict[str, str]:
+        """Варианты уведомления: "" - общий текст, имя сотрудника - персональный текст дежурного"""
+        return self.get_week_plan(now)["variants"][kind]
+
+    def _render_variants(self, kind: str, generic: str, duty: Optional[Dict]) -> Dict[str, str]:
+        """Один общий вариант и по одному на каждого дежурного - число рендеров не зависит от числа подписчиков"""
+        variants = {"": generic}
+        if not duty:
+            return variants
+        for i, employee_name in enumerate(duty["employees"]):
+            header = self.PERSONAL_HEADERS[kind] + "\n"
+            if duty["is_pair"]:
+                partners = [(e, p) for j, (e, p) in enumerate(zip(duty["employees"], duty["phones"])) if j != i]
+                header += "".join(f"👥 <b>Ваш напарник:</b> {e} ({p})\n" for e, p in partners)
+            variants[employee_name] = header + "\n" + generic
+        return variants
+
+    @staticmethod
+    def group_recipients(users: Dict[str, Dict], variants: Dict[str, str]) -> Dict[str, List[str]]:
+        """Разложить получателей по вариантам: дежурные - по своему имени, остальные - в общий"""
+        groups: Dict[str, List[str]] = {variant: [] for variant in variants}
+        for user_id, info in users.items():
+            employee_name = info.get("selected_employee")
+            groups[employee_name if employee_name in variants else ""].append(user_id)
+        return {variant: user_ids for variant, user_ids in groups.items() if user_ids}
+
+    def _render_wednesday(self, saturday: datetime, duty_saturday: Optional[Dict]) -> str:
+        if not duty_saturday:
+            return (
+                f"🔔 <b>НАПОМИНАНИЕ О ДЕЖУРСТВЕ В СУББОТУ</b>\n\n"
+                f"📅 <b>{saturday.strftime('%d.%m.%Y')}</b>\n\n"
+                f"⚠️ <b>В эту субботу дежурных нет</b>\n\n"
+                f"✅ Можно отдыхать!\n\n"
+                f"<i>Следующее напоминание: пятница в 18:00</i>"
+            )
+
+        duty_text, phones_text = self._duty_texts(duty_saturday)
+        return (
+            f"🔔 <b>НАПОМИНАНИЕ О ДЕЖУРСТВЕ В СУББОТУ</b>\n\n"
+            f"📅 <b>Дата:</b> {saturday.strftime('%d.%m.%Y')}\n"
+            f"👤 <b>Дежурит:</b> {duty_text}\n"
+            f"📞 <b>Телефоны:</b> {phones_text}\n\n"
+            f"⏰ <b>Время:</b> 6:50 - 8:00\n"
+            f"📍 <b>Место:</b> кабинет 6002, 6 этаж, АДЦ\n\n"
+            f"📋 <b>Инструкция:</b>\n"
+            f"• В пятницу до 17:00 позвонить в приемную: 5600\n"
+            f"• Прийти в субботу к 6:50 в АДЦ\n"
+            f"• Взять ключ на охране от кубов\n"
+            f"• Сфотографировать открытый кабинет\n"
+            f"• Находиться там до 8:00\n\n"
+            f"<i>Следующее напоминание: пятница в 18:00</i>"
+        )
+
+    def _render_friday(self, tomorrow: datetime, duty_tomorrow: Optional[Dict]) -> str:
+        if not duty_tomorrow:
+            return (
+                f"🔔 <b>НАПОМИНАНИЕ О ЗАВТРАШНЕМ ДЕЖУРСТВЕ</b>\n\n"
+                f"📅 <b>Завтра ({tomorrow.strftime('%d.%m.%Y')}) дежурных нет</b>\n\n"
+                f"✅ Можете не беспокоиться!\n\n"
+                f"<i>Следующее напоминание: суббота в 10:00</i>"
+            )
+
+        duty_text, phones_text = self._duty_texts(duty_tomorrow)
+        return (
+            f"🔔 <b>НАПОМИНАНИЕ О ЗАВТРАШНЕМ ДЕЖУРСТВЕ</b>\n\n"
+            f"📅 <b>Завтра ({tomorrow.strftime('%d.%m.%Y')}) дежурит:</b>\n"
+            f"👤 {duty_text}\n"
+            f"📞 {phones_text}\n\n"
+            f"⏰ <b>Время:</b> 6:50 - 8:00\n"
+            f"📍 <b>Место:</b> кабинет 6002, 6 этаж, АДЦ\n\n"
+            f"⚠️ <b>ВАЖНО! СЕГОДНЯ ДО 19:00:</b>\n"
+            f"• Дежурным позвонить в приемную: 5600\n"
+            f"• Сообщить о дежурстве\n"
+            f"• Попросить оставить ключи на вахте\n\n"
+            f"📋 <b>План на завтра:</b>\n"
+            f"• Прийти в АДЦ к 6:50\n"
+            f"• Взять ключ на охране от кубов\n"
+            f"• Открыть кабинет 6002\n"
+            f"• Сфотографировать открытый кабинет\n"
+            f"• Находиться там до 8:00\n"
+            f"• Оформить протокол разногласий\n\n"
+            f"<i>Следующее напоминание: суббота в 10:00</i>"
+        )
+
+    def _render_saturday(self, today: datetime, duty_today: Optional[Dict]) -> str:
+        if not duty_today:
+            return (
+                f"🔔 <b>ИНФОРМАЦИЯ О ДЕЖУРСТВЕ</b>\n\n"
+                f"📅 <b>Сегодня ({today.strftime('%d.%m.%Y')}) дежурных нет</b>\n\n"
+                f"✅ Всем хороших выходных!\n\n"
+                f"<i>Следующее напоминание: среда в 18:00</i>"
+            )
+
+        duty_text, phones_text = self._duty_texts(duty_today)
+        return (
+            f"🔔 <b>ИТОГИ ДЕЖУРСТВА</b>\n\n"
+            f"📅 <b>Сегодня ({today.strftime('%d.%m.%Y')}) дежурили:</b>\n"
+            f"👤 {duty_text}\n"
+            f"📞 {phones_text}\n\n"
+            f"✅ <b>Дежурство завершилось в 8:00</b>\n\n"
+            f"📋 <b>Напоминание дежурным:</b>\n"
+            f"• Не забудьте оформить протокол разногласий\n"
+            f"• Протокол оставить у Е.С. Денисовой\n\n"
+            f"<i>Следующее напоминание: среда в 18:00</i>"
+        )
+
+
+class TokenBucket:
+    """Асинхронный ограничитель скорости по алгоритму token bucket"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Не выдавать токены seconds секунд (ответ сервера 429 Retry-After)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        """Дождаться свободного токена (ожидающие обслуживаются по очереди)"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class BroadcastEngine:
+    """Рассылка с ограниченной параллельностью под лимиты Telegram (30 сообщ./с всего, 1 сообщ./с в чат)
+
+    Ошибки разбираются по типу из telegram.error: Forbidden и BadRequest из CHAT_ERRORS - пользователь
+    недоступен и удаляется, любой другой BadRequest - просто неудача; RetryAfter - вся рассылка
+    ставится на паузу на указанное сервером время, получатель возвращается в очередь;
+    TimedOut/NetworkError - повтор с экспоненциальной задержкой и случайным разбросом.
+    Отложенный повтор ставится в очередь таймером, воркер в это время берет следующего
+    получателя. Сетевых повторов на получателя не больше max_attempts; RetryAfter в этот
+    счет не входит - сообщение не было отклонено, сервер лишь попросил подождать.
+    """
+
+    # BadRequest, после которого получателя можно удалять: чата больше нет
+    CHAT_ERRORS = ("chat not found", "user not found", "peer_id_invalid", "user is deactivated")
+
+    def __init__(self, concurrency: int = 10, global_rate: float = 30, per_chat_interval: float = 1.0,
+                 checkpoint_every: int = 200, max_attempts: int = 5, backoff_base: float = 1.0,
+                 backoff_max: float = 30.0):
+        self.concurrency = concurrency
+        self.checkpoint_every = checkpoint_every
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.limiter = TokenBucket(global_rate, capacity=1)
+        self.per_chat_interval = per_chat_interval
+        self._chat_next_at: Dict[int, float] = {}
+
+    def _take_chat_slot(self, chat_id: int) -> float:
+        """Соблюдение лимита на один чат: 0 - слот занят за нами, иначе сколько секунд ждать"""
+        now = time.monotonic()
+        next_at = self._chat_next_at.get(chat_id, 0.0)
+        if next_at > now:
+            return next_at - now
+        self._chat_next_at[chat_id] = now + self.per_chat_interval
+        return 0.0
+
+    async def _worker(self, bot, queue: asyncio.Queue, stats: Dict, progress: Dict):
+        while True:
+            user_id, message, attempt = await queue.get()
+            requeued = False
+            try:
+                try:
+                    chat_id = int(user_id)
+                except ValueError:
+                    logger.error(f"✗ Некорректный ID пользователя: {user_id}")
+                    stats["failed"] += 1
+                    stats["deactivated"].append(user_id)
+                    self._record(progress, "failed", user_id)
+                    continue
+
+                # Чат еще занят - получатель откладывается таймером, воркер берет следующего
+                wait = self._take_chat_slot(chat_id)
+                if wait > 0:
+                    self._retry_later(queue, (user_id, message, attempt), wait)
+                    requeued = True
+                    continue
+
+                await self.limiter.acquire()
+                try:
+                    await bot.send_message(chat_id=chat_id, text=message, parse_mode=ParseMode.HTML)
+                except Exception as e:
+                    self._count_error(stats, e)
+                    requeued = self._handle_error(e, queue, stats, progress, user_id, message, attempt)
+                else:
+                    # Учет - вне try отправки: сбой записи журнала не превращает доставку в ошибку
+                    stats["sent"] += 1
+                    logger.debug(f"✓ Отправлено пользователю {user_id}")
+                    self._record(progress, "sent", user_id)
+            finally:
+                # Повторно поставленный получатель закрывается в _requeue, когда вернется в очередь
+                if not requeued:
+                    queue.task_done()
+
+    def _count_error(self, stats: Dict, error: Exception):
+        error_class = type(error).__name__
+        stats["errors"][error_class] = stats["errors"].get(error_class, 0) + 1
+        BROADCAST_ERRORS.inc((error_class,))
+
+    @staticmethod
+    def _requeue(queue: asyncio.Queue, item: tuple):
+        """Вернуть получателя в очередь и только потом закрыть его прошлую попытку - join не завершится раньше"""
+        queue.put_nowait(item)
+        queue.task_done()
+
+    def _retry_later(self, queue: asyncio.Queue, item: tuple, delay: float):
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._requeue, queue, item)
+        else:
+            self._requeue(queue, item)
+
+    def _handle_error(self, error: Exception, queue: asyncio.Queue, stats: Dict, progress: Dict,
+                      user_id: str, message: str, attempt: int) -> bool:
+        """Решение по ошибке отправки: удалить получателя, повторить позже или засчитать как неудачу
+
+        Возвращает True, если получатель поставлен на повтор.
+        """
+        error_msg = str(error)[:100]
+        if isinstance(error, RetryAfter):
+            delay = error.retry_after
+            delay = delay.total_seconds() if isinstance(delay, timedelta) else float(delay)
+            self.limiter.pause(delay)
+            logger.warning(f"⏸ Превышен лимит Telegram, пауза рассылки {delay:.0f} с")
+            stats["retried"] += 1
+            # Номер попытки не растет: пауза выдерживается в limiter, получатель не теряется
+            self._retry_later(queue, (user_id, message, attempt), 0)
+            return True
+        elif isinstance(error, Forbidden) or (
+                isinstance(error, BadRequest)
+                and any(phrase in error.message.lower() for phrase in self.CHAT_ERRORS)):
+            logger.warning(f"Удаляю неактивного пользователя {user_id}: {error_msg}")
+            stats["failed"] += 1
+            stats["deactivated"].append(user_id)
+            self._record(progress, "failed", user_id)
+            return False
+        elif isinstance(error, (TimedOut, NetworkError)) and not isinstance(error, BadRequest):
+            if attempt < self.max_attempts:
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+                delay *= random.uniform(0.5, 1.5)
+                logger.warning(f"↻ Сетевая ошибка для {user_id} (попытка {attempt}), повтор через {delay:.1f} с: {error_msg}")
+                stats["retried"] += 1
+                self._retry_later(queue, (user_id, message, attempt + 1), delay)
+                return True
+
+        stats["failed"] += 1
+        self._record(progress, "failed", user_id)
+        logger.error(f"✗ Ошибка отправки пользователю {user_id}: {error_msg}")
+        return False
+
+    def _record(self, progress: Dict, status: str, user_id: str):
+        """Накопить результат и отдать пачку в on_checkpoint, когда она заполнится"""
+        progress[status].append(user_id)
+        if progress["callback"] and len(progress["sent"]) + len(progress["failed"]) >= progress["flush_at"]:
+            self._flush_progress(progress)
+
+    def _flush_progress(self, progress: Dict):
+        """Отдать накопленное в on_checkpoint; при ошибке пачка сохраняется до следующей попытки"""
+        if not (progress["sent"] or progress["failed"]):
+            return
+        try:
+            progress["callback"](progress["sent"], progress["failed"])
+        except Exception as e:
+            pending = len(progress["sent"]) + len(progress["failed"])
+            logger.error(f"Ошибка фиксации прогресса рассылки ({pending} результатов): {e}")
+            progress["flush_at"] = pending + self.checkpoint_every
+            return
+        progress["sent"], progress["failed"] = [], []
+        progress["flush_at"] = self.checkpoint_every
+
+    async def run(self, bot, groups: Dict[str, List[str]], messages: Dict[str, str], on_checkpoint=None) -> Dict:
+        """Разослать сообщения группам пользователей, вернуть статистику рассылки
+
+        groups - {вариант: [user_id]}, messages - {вариант: готовый текст}; каждой группе
+        уходит один и тот же заранее подготовленный текст.
+        on_checkpoint(sent_ids, failed_ids) вызывается пачками по checkpoint_every результатов.
+        """
+        total = sum(len(user_ids) for user_ids in groups.values())
+        stats = {"total": total, "sent": 0, "failed": 0, "deactivated": [], "retried": 0, "errors": {},
+                 "elapsed": 0.0, "rate": 0.0}
+        if not total:
+            return stats
+        progress = {"sent": [], "failed": [], "callback": on_checkpoint, "flush_at": self.checkpoint_every}
+
+        queue = asyncio.Queue()
+        for variant, user_ids in groups.items():
+            message = messages[variant]
+            for user_id in user_ids:
+                queue.put_nowait((user_id, message, 1))
+
+        started = time.monotonic()
+        workers = [
+            asyncio.create_task(self._worker(bot, queue, stats, progress))
+            for _ in range(min(self.concurrency, total))
+        ]
+        # Очередь пуста и отложенных повторов не осталось - воркеры ждут в get(), их можно снять.
+        # Воркер сам не завершается: если он упал, join() не дождаться - рассылка прерывается
+        drained = asyncio.create_task(queue.join())
+        try:
+            done, _ = await asyncio.wait([drained] + workers, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in [drained] + workers:
+                task.cancel()
+            await asyncio.gather(drained, *workers, return_exceptions=True)
+        if drained not in done:
+            error = next(task for task in done if task is not drained).exception()
+            logger.error(f"Воркер рассылки завершился с ошибкой, рассылка прервана: {error!r}")
+            raise error
+        if on_checkpoint:
+            self._flush_progress(progress)
+
+        stats["elapsed"] = time.monotonic() - started
+        stats["rate"] = stats["sent"] / stats["elapsed"] if stats["elapsed"] > 0 else 0.0
+
+        # Чистим устаревшие отметки по чатам, чтобы словарь не рос бесконечно
+        now = time.monotonic()
+        self._chat_next_at = {cid: t for cid, t in self._chat_next_at.items() if t > now}
+        return stats
+
+
+class UserStore:
+    """Хранилище пользователей в SQLite: запись по одной строке вместо перезаписи всего файла"""
+
+    FIELDS = ("username", "first_name", "last_name", "telegram_name", "notifications",
+              "selected_employee", "registered_at", "last_active", "is_admin")
+    BOOL_FIELDS = ("notifications", "is_admin")
+
+    def __init__(self, db_path: str = "user_data.db", legacy_json_path: str = "user_data.json"):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                telegram_name TEXT,
+                notifications INTEGER,
+                selected_employee TEXT,
+                registered_at TEXT,
+                last_active TEXT,
+                is_admin INTEGER,
+                extra TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_users_username ON users (username COLLATE NOCASE);
+            CREATE INDEX IF NOT EXISTS idx_users_employee ON users (selected_employee);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        self.conn.commit()
+        self._migrate_json(legacy_json_path)
+        self._data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _migrate_json(self, json_path: str):
+        """Однократный импорт старого user_data.json"""
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+            return
+        if os.path.exists(json_path):
+            try:
+                with open(json_path, 'r', encoding='utf-8') as f:
+                    legacy = json.load(f)
+                self.upsert_many(legacy.items())
+                logger.info(f"Импортировано {len(legacy)} пользователей из {json_path}")
+            except Exception as e:
+                logger.error(f"Ошибка импорта {json_path}: {e}")
+                return
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)",
+                          (datetime.now().isoformat(),))
+        self.conn.commit()
+
+    def _to_row(self, user_id: str, info: Dict) -> tuple:
+        values = []
+        for field in self.FIELDS:
+            value = info.get(field)
+            if field in self.BOOL_FIELDS and value is not None:
+                value = int(bool(value))
+            values.append(value)
+        extra = {k: v for k, v in info.items() if k not in self.FIELDS}
+        return (user_id, *values, json.dumps(extra, ensure_ascii=False) if extra else None)
+
+    def _from_row(self, row: tuple) -> Dict:
+        info = {}
+        for field, value in zip(self.FIELDS, row[1:-1]):
+            # NULL = поле отсутствовало, чтобы .get(field, default) работал как со старым JSON
+            if value is None:
+                continue
+            info[field] = bool(value) if field in self.BOOL_FIELDS else value
+        if row[-1]:
+            info.update(json.loads(row[-1]))
+        return info
+
+    def _upsert_sql(self) -> str:
+        columns = ("user_id",) + self.FIELDS + ("extra",)
+        updates = ", ".join(f"{c} = excluded.{c}" for c in columns[1:])
+        return (f"INSERT INTO users ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT (user_id) DO UPDATE SET {updates}")
+
+    def external_changes(self) -> bool:
+        """Были ли коммиты из других соединений (sqlite3, скрипты) с прошлой проверки
+
+        PRAGMA data_version меняется только от чужих записей, поэтому проверка почти бесплатна
+        и не срабатывает на собственные сбросы бота.
+        """
+        version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        changed = version != self._data_version
+        self._data_version = version
+        return changed
+
+    def load_all(self) -> Dict[str, Dict]:
+        """Все пользователи в формате прежнего user_data"""
+        cursor = self.conn.execute(f"SELECT user_id, {', '.join(self.FIELDS)}, extra FROM users")
+        return {row[0]: self._from_row(row) for row in cursor}
+
+    def find_by_username(self, username: str) -> Optional[str]:
+        """ID пользователя по username (без @, без учета регистра)"""
+        row = self.conn.execute("SELECT user_id FROM users WHERE username = ? COLLATE NOCASE LIMIT 1",
+                                (username,)).fetchone()
+        return row[0] if row else None
+
+    def upsert(self, user_id: str, info: Dict):
+        """Записать одного пользователя"""
+        self.conn.execute(self._upsert_sql(), self._to_row(user_id, info))
+        self.conn.commit()
+
+    def upsert_many(self, items):
+        """Записать несколько пользователей одной транзакцией (items - пары user_id, info)"""
+        self.conn.executemany(self._upsert_sql(), [self._to_row(uid, info) for uid, info in items])
+        self.conn.commit()
+
+    def delete_many(self, user_ids: List[str]):
+        """Удалить пользователей"""
+        self.conn.executemany("DELETE FROM users WHERE user_id = ?", [(uid,) for uid in user_ids])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class UserWriteBehind:
+    """Отложенная запись пользователей: изменения помечаются и сбрасываются в базу одной пачкой
+
+    Сброс происходит по таймеру (flush вызывается планировщиком) или сразу, когда накопилось
+    max_dirty измененных записей. При остановке бота нужно вызвать flush принудительно.
+    Все вызовы - только из потока event loop: соединение SQLite привязано к нему, а dirty
+    не защищен блокировкой.
+    """
+
+    def __init__(self, store: UserStore, max_dirty: int = 500):
+        self.store = store
+        self.max_dirty = max_dirty
+        self.dirty: Dict[str, Dict] = {}
+        self.stats = {"marks": 0, "flushes": 0, "rows": 0, "last_batch": 0, "max_batch": 0, "errors": 0}
+
+    def mark(self, user_id: str, info: Dict):
+        """Пометить запись измененной (повторные изменения одной записи склеиваются)"""
+        self.dirty[user_id] = info
+        self.stats["marks"] += 1
+        if len(self.dirty) >= self.max_dirty:
+            self.flush()
+
+    def discard(self, user_ids: List[str]):
+        """Забыть изменения удаленных пользователей"""
+        for user_id in user_ids:
+            self.dirty.pop(user_id, None)
+
+    def flush(self) -> int:
+        """Записать все накопленные изменения одной транзакцией"""
+        if not self.dirty:
+            return 0
+        batch, self.dirty = self.dirty, {}
+        started = time.perf_counter()
+        try:
+            self.store.upsert_many(batch.items())
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Ошибка отложенной записи {len(batch)} пользователей: {e}")
+            # Возвращаем пачку, не затирая более свежие пометки
+            for user_id, info in batch.items():
+                self.dirty.setdefault(user_id, info)
+            return 0
+        PERSISTENCE_FLUSH.observe(("users",), time.perf_counter() - started)
+        size = len(batch)
+        self.stats["flushes"] += 1
+        self.stats["rows"] += size
+        self.stats["last_batch"] = size
+        self.stats["max_batch"] = max(self.stats["max_batch"], size)
+        return size
+
+    def get_stats(self) -> Dict:
+        stats = dict(self.stats)
+        stats["pending"] = len(self.dirty)
+        stats["avg_batch"] = stats["rows"] / stats["flushes"] if stats["flushes"] else 0.0
+        return stats
+
+
+class BroadcastJournal:
+    """Журнал рассылок на диске: после перезапуска рассылка продолжается только по оставшимся получателям
+
+    Каждая рассылка - отдельный файл JSON Lines: первая строка описывает задание (ID, тексты вариантов,
+    получатели по вариантам), следующие - пачки доставленных/неудачных отправок.
+    Завершенная рассылка удаляется из журнала.
+    """
+
+    PENDING = "pending"
+    SENT = "sent"
+    FAILED = "failed"
+
+    def __init__(self, directory: str = "broadcast_journal", max_age_hours: int = 12):
+        self.directory = directory
+        self.max_age = timedelta(hours=max_age_hours)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, broadcast_id: str) -> str:
+        return os.path.join(self.directory, f"{broadcast_id}.jsonl")
+
+    def _append(self, broadcast_id: str, record: Dict):
+        started = time.perf_counter()
+        with open(self._path(broadcast_id), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        PERSISTENCE_FLUSH.observe(("broadcast_journal",), time.perf_counter() - started)
+
+    def create(self, notification_type: str, messages: Dict[str, str], groups: Dict[str, List[str]]) -> str:
+        """Зарегистрировать новую рассылку, вернуть её ID"""
+        broadcast_id = f"{datetime.now(MOSCOW_TZ).strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self._append(broadcast_id, {
+            "op": "start",
+            "id": broadcast_id,
+            "type": notification_type,
+            "messages": messages,
+            "created_at": datetime.now(MOSCOW_TZ).isoformat(),
+            "groups": groups
+        })
+        total = sum(len(user_ids) for user_ids in groups.values())
+        logger.info(f"Рассылка {broadcast_id} ({notification_type}) записана в журнал: {total} получателей")
+        return broadcast_id
+
+    def checkpoint(self, broadcast_id: str, sent: List[str], failed: List[str]):
+        """Зафиксировать пачку результатов"""
+        self._append(broadcast_id, {"op": "batch", "sent": sent, "failed": failed})
+
+    def finish(self, broadcast_id: str):
+        """Рассылка завершена - убрать её из журнала"""
+        try:
+            os.remove(self._path(broadcast_id))
+        except FileNotFoundError:
+            pass
+
+    def _read(self, path: str) -> Optional[Dict]:
+        job = None
+        # Недописанная при падении пачка отрезается и считается неотправленной - иначе пачки,
+        # дописанные после перезапуска, оказались бы за битой строкой и терялись бы при чтении
+        for record in read_journal(path):
+            if record.get("op") == "start":
+                if "messages" in record:
+                    messages, groups = record["messages"], record["groups"]
+                else:
+                    # Формат до персональных вариантов: один текст для всех
+                    messages, groups = {"": record["message"]}, {"": record["recipients"]}
+                job = {
+                    "id": record["id"],
+                    "type": record["type"],
+                    "messages": messages,
+                    "groups": groups,
+                    "created_at": record["created_at"],
+                    "status": {uid: self.PENDING for user_ids in groups.values() for uid in user_ids}
+                }
+            elif job is not None and record.get("op") == "batch":
+                for user_id in record["sent"]:
+                    job["status"][user_id] = self.SENT
+                for user_id in record["failed"]:
+                    job["status"][user_id] = self.FAILED
+        return job
+
+    def load_unfinished(self) -> List[Dict]:
+        """Незавершенные рассылки со статусом каждого получателя; устаревшие задания удаляются"""
+        jobs = []
+        now = datetime.now(MOSCOW_TZ)
+        for file_name in sorted(os.listdir(self.directory)):
+            if not file_name.endswith(".jsonl"):
+                continue
+            path = os.path.join(self.directory, file_name)
+            try:
+                job = self._read(path)
+            except Exception as e:
+                logger.error(f"Ошибка чтения журнала рассылки {file_name}: {e}")
+                continue
+            if job is None:
+                os.remove(path)
+                continue
+            if now - datetime.fromisoformat(job["created_at"]) > self.max_age:
+                logger.warning(f"Рассылка {job['id']} ({job['type']}) устарела и не будет продолжена")
+                os.remove(path)
+                continue
+            jobs.append(job)
+        return jobs
+
+
+class FileIdCache:
+    """Telegram file_id отправленных файлов по SHA-256 содержимого
+
+    Файл загружается в Telegram один раз, дальше отправляется по file_id. Ключ - хэш
+    содержимого, поэтому новый файл по тому же пути никогда не получит чужой file_id.
+    """
+
+    def __init__(self, path: str = "file_ids.json"):
+        self.path = path
+        self._ids: Dict[str, str] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self._ids = json.load(f)
+            except Exception as e:
+                logger.error(f"Ошибка чтения {path}: {e}")
+
+    def get(self, content_hash: str) -> Optional[str]:
+        return self._ids.get(content_hash)
+
+    def put(self, content_hash: str, file_id: str):
+        if self._ids.get(content_hash) != file_id:
+            self._ids[content_hash] = file_id
+            self._save()
+
+    def forget(self, content_hash: str):
+        if self._ids.pop(content_hash, None) is not None:
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._ids, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения {self.path}: {e}")
+
+
+class DocumentStore:
+    """Хранилище версий документа с адресацией по содержимому
+
+    Каждая версия лежит в файле <sha256>.docx, одинаковые загрузки не дублируются.
+    Манифест index.json хранит историю версий (новые первыми) и текущую версию,
+    поэтому откат - это смена указателя без копирования файлов.
+    """
+
+    def __init__(self, directory: str = "protocols", keep_versions: int = 5):
+        self.directory = directory
+        self.keep_versions = keep_versions
+        self.manifest_path = os.path.join(directory, "index.json")
+        os.makedirs(directory, exist_ok=True)
+        self.versions: List[Dict] = []
+        self.current_hash: Optional[str] = None
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+                self.versions = manifest["versions"]
+                self.current_hash = manifest["current"]
+            except Exception as e:
+                logger.error(f"Ошибка чтения {self.manifest_path}: {e}")
+
+    def path_for(self, content_hash: str) -> str:
+        return os.path.join(self.directory, f"{content_hash}.docx")
+
+    def current(self) -> Optional[Dict]:
+        """Текущая версия {"hash", "size", "name", "uploaded_at"} или None"""
+        for version in self.versions:
+            if version["hash"] == self.current_hash:
+                return version
+        return None
+
+    def upload_path(self) -> str:
+        """Временный файл для новой загрузки в каталоге хранилища (для атомарного переименования)"""
+        return os.path.join(self.directory, f"upload-{uuid.uuid4().hex}.tmp")
+
+    @staticmethod
+    def _hash_file(path: str, chunk_size: int = 64 * 1024) -> tuple:
+        """SHA-256 и размер файла; файл читается кусками, целиком в память не загружается"""
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+                size += len(chunk)
+        return digest.hexdigest(), size
+
+    def commit_file(self, tmp_path: str, name: str) -> tuple:
+        """Сохранить загруженный во временный файл документ как текущую версию
+
+        Возвращает (версия, был ли такой файл уже в хранилище, удаленные из истории хэши).
+        """
+        content_hash, size = self._hash_file(tmp_path)
+        path = self.path_for(content_hash)
+        duplicate = os.path.exists(path)
+        if duplicate:
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+
+        version = {
+            "hash": content_hash,
+            "size": size,
+            "name": name,
+            "uploaded_at": datetime.now(MOSCOW_TZ).isoformat()
+        }
+        self.versions = [version] + [v for v in self.versions if v["hash"] != content_hash]
+        self.current_hash = content_hash
+        dropped = self._trim()
+        self._save()
+        logger.info(f"Новая версия документа {name}: {content_hash[:12]} ({size} байт)"
+                    f"{', уже была в хранилище' if duplicate else ''}")
+        return version, duplicate, dropped
+
+    @staticmethod
+    def discard(tmp_path: str):
+        """Удалить незавершенную загрузку"""
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def import_file(self, path: str, name: str) -> tuple:
+        """Добавить существующий файл с диска"""
+        tmp_path = self.upload_path()
+        shutil.copyfile(path, tmp_path)
+        return self.commit_file(tmp_path, name)
+
+    def deactivate(self) -> bool:
+        """Снять текущую версию с выдачи; история сохраняется для отката"""
+        if self.current_hash is None:
+            return False
+        self.current_hash = None
+        self._save()
+        return True
+
+    def rollback(self) -> Optional[Dict]:
+        """Сделать текущей предыдущую версию (после снятия с выдачи - последнюю)"""
+        if self.current_hash is None:
+            index = 0
+        else:
+            hashes = [v["hash"] for v in self.versions]
+            index = hashes.index(self.current_hash) + 1 if self.current_hash in hashes else 0
+        if index >= len(self.versions):
+            return None
+        self.current_hash = self.versions[index]["hash"]
+        self._save()
+        return self.versions[index]
+
+    def rollback_available(self) -> bool:
+        if self.current_hash is None:
+            return bool(self.versions)
+        return bool(self.versions) and self.versions[-1]["hash"] != self.current_hash
+
+    def _trim(self) -> List[str]:
+        """Оставить keep_versions последних версий, файлы старых удалить"""
+        dropped = [v["hash"] for v in self.versions[self.keep_versions:]]
+        self.versions = self.versions[:self.keep_versions]
+        for content_hash in dropped:
+            try:
+                os.remove(self.path_for(content_hash))
+            except FileNotFoundError:
+                pass
+        return dropped
+
+    def _save(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"versions": self.versions, "current": self.current_hash}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+
+class ProtocolRenderer:
+    """Протокол, заранее заполненный на конкретное дежурство
+
+    В шаблоне подставляются метки {{ДАТА}}, {{ДЕЖУРНЫЕ}} и {{ТЕЛЕФОНЫ}}. Если меток нет
+    (или Word разбил метку на несколько фрагментов), в начало документа добавляется абзац
+    с датой и дежурными. Готовые файлы кэшируются по хэшу шаблона, дате и составу дежурства;
+    сверх max_files удаляются давно не запрошенные (время изменения файла обновляется при каждом
+    обращении, поэтому порядок вытеснения - LRU, а не порядок сборки).
+    """
+
+    def __init__(self, store: DocumentStore, directory: str = os.path.join("protocols", "generated"),
+                 max_files: int = 64):
+        self.store = store
+        self.directory = directory
+        self.max_files = max_files
+        self.stats = {"renders": 0, "hits": 0}
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def cache_key(template_hash: str, duty: Dict) -> str:
+        """Ключ варианта: шаблон + дата + дежурные с телефонами"""
+        parts = [template_hash, str(duty["date_obj"].toordinal())] + duty["employees"] + duty["phones"]
+        return hashlib.sha256("|".join(parts).encode('utf-8')).hexdigest()[:32]
+
+    def render(self, template_hash: str, duty: Dict) -> tuple:
+        """Заполненный документ; блокирующая операция, вызывается через asyncio.to_thread
+
+        Возвращает (путь, ключи вариантов, удаленных из кэша при этой сборке).
+        """
+        path = os.path.join(self.directory, f"{self.cache_key(template_hash, duty)}.docx")
+        if self._touch(path):
+            self.stats["hits"] += 1
+            return path, []
+
+        values = {
+            "{{ДАТА}}": DutyScheduleGenerator.format_date(duty["date_obj"]),
+            "{{ДЕЖУРНЫЕ}}": ", ".join(duty["employees"]),
+            "{{ТЕЛЕФОНЫ}}": ", ".join(duty["phones"])
+        }
+        # Один и тот же вариант могут собирать несколько потоков сразу - у каждого свой файл
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with zipfile.ZipFile(self.store.path_for(template_hash)) as source, \
+                zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as target:
+            for item in source.infolist():
+                data = source.read(item.filename)
+                if item.filename == "word/document.xml":
+                    data = self._fill(data.decode('utf-8'), values).encode('utf-8')
+                target.writestr(item, data)
+        os.replace(tmp_path, path)
+        self.stats["renders"] += 1
+        return path, self._prune()
+
+    @staticmethod
+    def _fill(xml: str, values: Dict[str, str]) -> str:
+        filled = xml
+        for placeholder, value in values.items():
+            filled = filled.replace(placeholder, escape(value))
+        if filled != xml:
+            return filled
+
+        text = escape(f"Дата дежурства: {values['{{ДАТА}}']}  Дежурные: {values['{{ДЕЖУРНЫЕ}}']}")
+        paragraph = f'<w:p><w:r><w:rPr><w:b/></w:rPr><w:t xml:space="preserve">{text}</w:t></w:r></w:p>'
+        return re.sub(r'<w:body[^>]*>', lambda m: m.group(0) + paragraph, xml, count=1)
+
+    def touch(self, cache_key: str):
+        """Отметить обращение к варианту, отправленному по file_id без сборки"""
+        self._touch(os.path.join(self.directory, f"{cache_key}.docx"))
+
+    @staticmethod
+    def _touch(path: str) -> bool:
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _mtime(path: str) -> float:
+        try:
+            return os.path.getmtime(path)
+        except FileNotFoundError:
+            return 0.0
+
+    def _prune(self) -> List[str]:
+        """Удалить давно не запрошенные варианты сверх max_files, вернуть их ключи"""
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".docx")]
+        if len(files) <= self.max_files:
+            return []
+        files.sort(key=self._mtime)
+        dropped = []
+        for path in files[:len(files) - self.max_files]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Уже удален параллельной сборкой
+                continue
+            dropped.append(os.path.basename(path)[:-len(".docx")])
+        return dropped
+
+
+class UpdateRecorder:
+    """Запись входящих обновлений в JSON Lines для офлайн-воспроизведения (replay.py)
+
+    Логин и пароль из команды /admin заменяются на "***", в файл они не попадают - в любом
+    поле с сообщением: команда может прийти и правкой уже отправленного сообщения.
+    """
+
+    REDACTED = "***"
+    MESSAGE_FIELDS = ("message", "edited_message", "channel_post", "edited_channel_post",
+                      "business_message", "edited_business_message")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.recorded = 0
+        self._file = open(path, 'a', encoding='utf-8')
+        logger.info(f"Запись входящих обновлений в {path}")
+
+    async def record(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        data = update.to_dict()
+        for field in self.MESSAGE_FIELDS:
+            message = data.get(field)
+            if message:
+                self._redact(message)
+        self._file.write(json.dumps({"ts": time.time(), "update": data}, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self.recorded += 1
+
+    @classmethod
+    def _redact(cls, message: Dict):
+        for key in ("text", "caption"):
+            words = message.get(key, "").split()
+            if words and words[0].startswith("/admin"):
+                message[key] = " ".join(words[:1] + [cls.REDACTED] * (len(words) - 1))
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class CallbackRouter:
+    """Маршрутизатор callback_data, собирается один раз при запуске
+
+    Точные маршруты ищутся в словаре, параметризованные - по самому длинному совпавшему
+    префиксу; обработчик префиксного маршрута получает остаток строки. Маршруты admin=True
+    пропускаются только для админа с активной сессией.
+    """
+
+    def __init__(self, is_authorized, on_denied):
+        self.is_authorized = is_authorized
+        self.on_denied = on_denied
+        self._exact: Dict[str, tuple] = {}
+        self._prefixes: List[tuple] = []
+        self.stats: Dict[str, Dict] = {}
+
+    def add(self, data: str, handler, admin: bool = False):
+        """handler(query, context)"""
+        self._exact[data] = (data, handler, admin)
+        self.stats[data] = {"calls": 0, "denied": 0, "total_ms": 0.0, "max_ms": 0.0}
+
+    def add_prefix(self, prefix: str, handler, admin: bool = False):
+        """handler(query, context, payload)"""
+        route = prefix + "*"
+        self._prefixes.append((prefix, route, handler, admin))
+        self._prefixes.sort(key=lambda item: len(item[0]), reverse=True)
+        self.stats[route] = {"calls": 0, "denied": 0, "total_ms": 0.0, "max_ms": 0.0}
+
+    def resolve(self, data: str) -> Optional[tuple]:
+        """(маршрут, обработчик, admin, аргументы) или None"""
+        route = self._exact.get(data)
+        if route:
+            return route[0], route[1], route[2], ()
+        for prefix, route_name, handler, admin in self._prefixes:
+            if data.startswith(prefix):
+                return route_name, handler, admin, (data[len(prefix):],)
+        return None
+
+    async def dispatch(self, query, context, user_id: str, data: str) -> bool:
+        """Вызвать обработчик кнопки, вернуть False для неизвестных данных"""
+        resolved = self.resolve(data)
+        if resolved is None:
+            logger.warning(f"Неизвестная кнопка: {data}")
+            return False
+        route, handler, admin, args = resolved
+        stats = self.stats[route]
+        if admin and not self.is_authorized(user_id):
+            stats["denied"] += 1
+            await self.on_denied(query)
+            return True
+
+        started = time.perf_counter()
+        try:
+            await handler(query, context, *args)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            stats["calls"] += 1
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        return True
+
+    def get_stats(self) -> Dict[str, Dict]:
+        """Статистика вызванных маршрутов со средним временем обработки"""
+        return {
+            route: dict(stats, avg_ms=stats["total_ms"] / stats["calls"] if stats["calls"] else 0.0)
+            for route, stats in self.stats.items() if stats["calls"] or stats["denied"]
+        }
+
+
+class InstrumentedRequest(BaseRequest):
+    """Транспорт Bot API с замером времени каждого вызова (метод - последняя часть URL)"""
+
+    def __init__(self, inner: BaseRequest):
+        self.inner = inner
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await self.inner.do_request(
+                url, method, request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout
+            )
+        except Exception:
+            TELEGRAM_API_ERRORS.inc((api_method,))
+            raise
+        finally:
+            TELEGRAM_API_LATENCY.observe((api_method,), time.perf_counter() - started)
+        if code >= 400:
+            TELEGRAM_API_ERRORS.inc((api_method,))
+        return code, payload
+
+
+class SamplingProfiler:
+    """Выборочный профилировщик процесса и tracemalloc на ограниченное окно
+
+    Фоновый поток раз в interval секунд снимает стеки всех потоков через sys._current_frames
+    и считает для каждой функции собственное (вершина стека) и накопленное (где угодно в стеке)
+    число попаданий. Накладные расходы не зависят от числа вызовов, поэтому профилировать
+    можно прямо во время рассылки. По истечении окна сбор останавливается сам.
+    """
+
+    def __init__(self, interval: float = 0.005, tracemalloc_frames: int = 10):
+        self.interval = interval
+        self.tracemalloc_frames = tracemalloc_frames
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        # tracemalloc останавливаем, только если его включил сам профилировщик
+        self._owns_tracemalloc = False
+        self._reset()
+
+    def _reset(self):
+        self.samples = 0
+        self.self_counts: Dict[tuple, int] = {}
+        self.cumulative_counts: Dict[tuple, int] = {}
+        self.started_at: Optional[float] = None
+        self.stopped_at: Optional[float] = None
+        self.window = 0.0
+        self.snapshot = None
+        self.traced = (0, 0)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, window: float) -> bool:
+        """Начать сбор на window секунд; False, если сбор уже идет"""
+        if self.running:
+            return False
+        self._reset()
+        self.window = window
+        self.started_at = time.monotonic()
+        self._stop.clear()
+        self._owns_tracemalloc = not tracemalloc.is_tracing()
+        if self._owns_tracemalloc:
+            tracemalloc.start(self.tracemalloc_frames)
+        self._thread = threading.Thread(target=self._run, name="perf-sampler", daemon=True)
+        self._thread.start()
+        logger.info(f"Профилирование запущено на {window:.0f} с")
+        return True
+
+    def stop(self) -> bool:
+        """Остановить сбор и зафиксировать снимок памяти; False, если сбор не шел"""
+        if not self.running:
+            return False
+        self._stop.set()
+        self._thread.join()
+        return True
+
+    def _run(self):
+        own_id = threading.get_ident()
+        deadline = self.started_at + self.window
+        while not self._stop.wait(self.interval):
+            if time.monotonic() >= deadline:
+                break
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, frame in frames.items():
+                    if thread_id == own_id:
+                        continue
+                    self._record(frame)
+                self.samples += 1
+        self._finish()
+
+    def _record(self, frame):
+        leaf = True
+        seen = set()
+        while frame is not None:
+            code = frame.f_code
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+            if leaf:
+                self.self_counts[key] = self.self_counts.get(key, 0) + 1
+                leaf = False
+            if key not in seen:
+                seen.add(key)
+                self.cumulative_counts[key] = self.cumulative_counts.get(key, 0) + 1
+            frame = frame.f_back
+
+    def _finish(self):
+        self.stopped_at = time.monotonic()
+        if tracemalloc.is_tracing():
+            self.snapshot = tracemalloc.take_snapshot()
+            self.traced = tracemalloc.get_traced_memory()
+            if self._owns_tracemalloc:
+                tracemalloc.stop()
+        self._owns_tracemalloc = False
+        logger.info(f"Профилирование остановлено: {self.samples} выборок")
+
+    @staticmethod
+    def _where(key: tuple) -> str:
+        filename, line, name = key
+        return f"{name} ({os.path.basename(filename)}:{line})"
+
+    def report(self, top: int = 25) -> str:
+        """Текстовый отчет: функции по накопленному и собственному времени, места выделения памяти"""
+        with self._lock:
+            samples = self.samples
+            cumulative = sorted(self.cumulative_counts.items(), key=lambda item: item[1], reverse=True)[:top]
+            own = sorted(self.self_counts.items(), key=lambda item: item[1], reverse=True)[:top]
+        snapshot = self.snapshot
+        traced = self.traced
+        if self.running and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            traced = tracemalloc.get_traced_memory()
+
+        end = self.stopped_at if self.stopped_at is not None else time.monotonic()
+        duration = end - self.started_at if self.started_at is not None else 0.0
+        lines = [
+            f"Профиль процесса бота, {datetime.now(MOSCOW_TZ).strftime('%d.%m.%Y %H:%M:%S')}",
+            f"Статус: {'идет сбор' if self.running else 'остановлен'}",
+            f"Длительность: {duration:.1f} с, выборок: {samples}, интервал: {self.interval * 1000:.0f} мс",
+            "",
+            f"=== Топ-{top} функций по накопленному времени (доля выборок) ==="
+        ]
+        for key, count in cumulative:
+            lines.append(f"{count / samples * 100 if samples else 0:6.1f}%  {count:7d}  {self._where(key)}")
+        lines += ["", f"=== Топ-{top} функций по собственному времени ==="]
+        for key, count in own:
+            lines.append(f"{count / samples * 100 if samples else 0:6.1f}%  {count:7d}  {self._where(key)}")
+
+        lines += ["", f"=== Топ-{top} мест выделения памяти (tracemalloc) ==="]
+        if snapshot is not None:
+            lines.append(f"Сейчас: {traced[0] / 1024 / 1024:.1f} МБ, пик: {traced[1] / 1024 / 1024:.1f} МБ")
+            for stat in snapshot.statistics('lineno')[:top]:
+                frame = stat.traceback[0]
+                lines.append(f"{stat.size / 1024:10.1f} КБ  {stat.count:8d} блоков  "
+                             f"{os.path.basename(frame.filename)}:{frame.lineno}")
+        else:
+            lines.append("Нет данных")
+        return "\n".join(lines) + "\n"
+
+
+class HttpServer:
+    """Минимальный HTTP-сервер на asyncio для вебхука Telegram и служебных адресов
+
+    Каждый запрос обрабатывается в отдельном соединении (Connection: close).
+    Обработчик маршрута получает (headers, body) и возвращает (статус, content-type, тело).
+    Каждое чтение из сокета ограничено read_timeout: медленный клиент получает 408.
+    """
+
+    MAX_BODY = 1024 * 1024
+    REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+               405: "Method Not Allowed", 408: "Request Timeout", 413: "Payload Too Large",
+               500: "Internal Server Error"}
+
+    def __init__(self, host: str, port: int, read_timeout: float = 10.0):
+        self.host = host
+        self.port = port
+        self.read_timeout = read_timeout
+        self.routes: Dict[tuple, object] = {}
+        self._server = None
+
+    def route(self, method: str, path: str, handler):
+        self.routes[(method, path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"HTTP-сервер слушает {self.host}:{self.port}")
+
+    async def stop(self):
+        """Перестать принимать соединения и дождаться текущих запросов"""
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            logger.info("HTTP-сервер остановлен")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            status, content_type, body = await self._process(reader)
+        except asyncio.TimeoutError:
+            logger.warning(f"HTTP-запрос не получен за {self.read_timeout} с, соединение закрыто")
+            status, content_type, body = 408, "text/plain", b""
+        except Exception as e:
+            logger.error(f"Ошибка обработки HTTP-запроса: {e}")
+            status, content_type, body = 500, "text/plain", b""
+        try:
+            writer.write(
+                f"HTTP/1.1 {status} {self.REASONS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _read(self, read):
+        return await asyncio.wait_for(read, self.read_timeout)
+
+    async def _process(self, reader: asyncio.StreamReader) -> tuple:
+        request_line = await self._read(reader.readline())
+        try:
+            method, target, _ = request_line.decode('latin-1').split(" ", 2)
+        except ValueError:
+            return 400, "text/plain", b""
+
+        headers = {}
+        while True:
+            line = await self._read(reader.readline())
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        length = headers.get("content-length") or "0"
+        # int() принял бы и "+5", и " 5", и "-1" - длина тела только из цифр
+        if not length.isdigit() or not length.isascii():
+            return 400, "text/plain", b""
+        length = int(length)
+        if length > self.MAX_BODY:
+            return 413, "text/plain", b""
+        body = await self._read(reader.readexactly(length)) if length else b""
+
+        path = target.split("?", 1)[0]
+        handler = self.routes.get((method, path))
+        if handler is None:
+            allowed = any(route_path == path for _, route_path in self.routes)
+            return (405 if allowed else 404), "text/plain", b""
+        return await handler(headers, body)
+
 
 class DutyBot:
     def __init__(self, token: str):
         self.token = token
-        self.schedule_generator = DutyScheduleGenerator(DUTY_SCHEDULE)
+        self.schedule_generator = DutyScheduleGenerator(ScheduleStore())
+        self.notification_planner = NotificationPlanner(self.schedule_generator)
         self.user_data_file = "user_data.json"
+        self.user_store = UserStore(legacy_json_path=self.user_data_file)
+        self.user_writer = UserWriteBehind(self.user_store)
         self.protocol_file_path = "Протокол разногласий — пример.docx"
         self.protocol_attached_file_id = None
         self.admin_sessions = {}
+        self.file_ids = FileIdCache()
+        self.protocol_store = DocumentStore()
+        if not self.protocol_store.versions and os.path.exists(self.protocol_file_path):
+            self.protocol_store.import_file(self.protocol_file_path, os.path.basename(self.protocol_file_path))
+        self.protocol_renderer = ProtocolRenderer(self.protocol_store)
         self.application = None
         self.bot_instance = None
         self.scheduler = None
+        self.webhook_secret = WEBHOOK_SECRET
+        self.update_recorder = None
+        self.webhook_server = None
+        self.metrics_server = None
+        self.profiler = SamplingProfiler()
+        METRICS.set_collector("bot", self._collect_metrics)
+        self.broadcaster = BroadcastEngine()
+        self.broadcast_journal = BroadcastJournal()
+        # Готовые клавиатуры: (вид, ...) -> InlineKeyboardMarkup
+        self._keyboards: Dict[tuple, InlineKeyboardMarkup] = {}
+        self.callback_router = self._build_callback_router()
         self.load_user_data()
 
     async def setup_scheduler(self):
@@ -362,9 +2380,44 @@ class DutyBot:
             replace_existing=True
         )
 
+        # 4. Каждые 2 секунды - сброс отложенных изменений пользователей в базу
+        self.scheduler.add_job(
+            self.flush_user_writes,
+            IntervalTrigger(seconds=2, timezone=MOSCOW_TZ),
+            id='flush_user_data',
+            replace_existing=True
+        )
+
+        # 5. Однократно после запуска - продолжить рассылки, прерванные перезапуском
+        self.scheduler.add_job(
+            self.resume_broadcasts,
+            DateTrigger(run_date=datetime.now(MOSCOW_TZ) + timedelta(seconds=5), timezone=MOSCOW_TZ),
+            id='resume_broadcasts',
+            replace_existing=True
+        )
+
         self.scheduler.start()
+        self.notification_planner.get_week_plan()
         logger.info("Планировщик задач запущен: среда 18:00 (всем), пятница 18:00 (всем), суббота 10:00 (всем)")
 
+    async def flush_user_writes(self):
+        """Сброс отложенных записей пользователей - в потоке event loop, где создано соединение SQLite"""
+        self.user_writer.flush()
+
+    async def resume_broadcasts(self):
+        """Продолжить незавершенные рассылки из журнала - только по получателям в статусе pending"""
+        for job in self.broadcast_journal.load_unfinished():
+            pending = sum(1 for status in job["status"].values() if status == BroadcastJournal.PENDING)
+            logger.info(f"Продолжаю рассылку {job['id']} ({job['type']}): осталось {pending} из {len(job['status'])}")
+            try:
+                groups = {
+                    variant: [uid for uid in user_ids if job["status"][uid] == BroadcastJournal.PENDING]
+                    for variant, user_ids in job["groups"].items()
+                }
+                await self._run_broadcast(job["id"], job["type"], job["messages"], groups)
+            except Exception as e:
+                logger.error(f"Ошибка продолжения рассылки {job['id']}: {e}")
+
     async def send_wednesday_notification(self):
         """Отправка уведомления в СРЕДУ в 18:00 ВСЕМ пользователям о дежурстве в эту субботу"""
         try:
@@ -375,47 +2428,8 @@ class DutyBot:
                 return
 
             logger.info(f"Запуск send_wednesday_notification в среду {today.strftime('%d.%m.%Y %H:%M')}")
-            saturday = today + timedelta(days=3)
-
-            # Ищем дежурных на эту субботу в динамическом расписании
-            current_schedule = self.schedule_generator._generate_dynamic_schedule()
-            duty_saturday = next((d for d in current_schedule.values() if d["date_obj"].date() == saturday.date()),
-                                 None)
-
-            if not duty_saturday:
-                logger.info(f"На {saturday.strftime('%d.%m.%Y')} дежурных нет")
-                message = (
-                    f"🔔 <b>НАПОМИНАНИЕ О ДЕЖУРСТВЕ В СУББОТУ</b>\n\n"
-                    f"📅 <b>{saturday.strftime('%d.%m.%Y')}</b>\n\n"
-                    f"⚠️ <b>В эту субботу дежурных нет</b>\n\n"
-                    f"✅ Можно отдыхать!\n\n"
-                    f"<i>Следующее напоминание: пятница в 18:00</i>"
-                )
-            else:
-                if duty_saturday["is_pair"]:
-                    duty_text = f"{duty_saturday['employees'][0]} + {duty_saturday['employees'][1]}"
-                    phones_text = f"{duty_saturday['phones'][0]} + {duty_saturday['phones'][1]}"
-                else:
-                    duty_text = f"{duty_saturday['employees'][0]}"
-                    phones_text = f"{duty_saturday['phones'][0]}"
-
-                message = (
-                    f"🔔 <b>НАПОМИНАНИЕ О ДЕЖУРСТВЕ В СУББОТУ</b>\n\n"
-                    f"📅 <b>Дата:</b> {saturday.strftime('%d.%m.%Y')}\n"
-                    f"👤 <b>Дежурит:</b> {duty_text}\n"
-                    f"📞 <b>Телефоны:</b> {phones_text}\n\n"
-                    f"⏰ <b>Время:</b> 6:50 - 8:00\n"
-                    f"📍 <b>Место:</b> кабинет 6002, 6 этаж, АДЦ\n\n"
-                    f"📋 <b>Инструкция:</b>\n"
-                    f"• В пятницу до 17:00 позвонить в приемную: 5600\n"
-                    f"• Прийти в субботу к 6:50 в АДЦ\n"
-                    f"• Взять ключ на охране от кубов\n"
-                    f"• Сфотографировать открытый кабинет\n"
-                    f"• Находиться там до 8:00\n\n"
-                    f"<i>Следующее напоминание: пятница в 18:00</i>"
-                )
-
-            await self._send_notification_to_all_users(message, "среда")
+            messages = self.notification_planner.get_variants("среда", today)
+            await self._send_notification_to_all_users(messages, "среда")
         except Exception as e:
             logger.error(f"Ошибка отправки уведомления в среду: {e}")
 
@@ -429,50 +2443,8 @@ class DutyBot:
                 return
 
             logger.info(f"Запуск send_friday_notification_all в пятницу {today.strftime('%d.%m.%Y %H:%M')}")
-            tomorrow = today + timedelta(days=1)
-
-            current_schedule = self.schedule_generator._generate_dynamic_schedule()
-            duty_tomorrow = next((d for d in current_schedule.values() if d["date_obj"].date() == tomorrow.date()),
-                                 None)
-
-            if not duty_tomorrow:
-                logger.info(f"На {tomorrow.strftime('%d.%m.%Y')} дежурных нет")
-                message = (
-                    f"🔔 <b>НАПОМИНАНИЕ О ЗАВТРАШНЕМ ДЕЖУРСТВЕ</b>\n\n"
-                    f"📅 <b>Завтра ({tomorrow.strftime('%d.%m.%Y')}) дежурных нет</b>\n\n"
-                    f"✅ Можете не беспокоиться!\n\n"
-                    f"<i>Следующее напоминание: суббота в 10:00</i>"
-                )
-            else:
-                if duty_tomorrow["is_pair"]:
-                    duty_text = f"{duty_tomorrow['employees'][0]} + {duty_tomorrow['employees'][1]}"
-                    phones_text = f"{duty_tomorrow['phones'][0]} + {duty_tomorrow['phones'][1]}"
-                else:
-                    duty_text = f"{duty_tomorrow['employees'][0]}"
-                    phones_text = f"{duty_tomorrow['phones'][0]}"
-
-                message = (
-                    f"🔔 <b>НАПОМИНАНИЕ О ЗАВТРАШНЕМ ДЕЖУРСТВЕ</b>\n\n"
-                    f"📅 <b>Завтра ({tomorrow.strftime('%d.%m.%Y')}) дежурит:</b>\n"
-                    f"👤 {duty_text}\n"
-                    f"📞 {phones_text}\n\n"
-                    f"⏰ <b>Время:</b> 6:50 - 8:00\n"
-                    f"📍 <b>Место:</b> кабинет 6002, 6 этаж, АДЦ\n\n"
-                    f"⚠️ <b>ВАЖНО! СЕГОДНЯ ДО 19:00:</b>\n"
-                    f"• Дежурным позвонить в приемную: 5600\n"
-                    f"• Сообщить о дежурстве\n"
-                    f"• Попросить оставить ключи на вахте\n\n"
-                    f"📋 <b>План на завтра:</b>\n"
-                    f"• Прийти в АДЦ к 6:50\n"
-                    f"• Взять ключ на охране от кубов\n"
-                    f"• Открыть кабинет 6002\n"
-                    f"• Сфотографировать открытый кабинет\n"
-                    f"• Находиться там до 8:00\n"
-                    f"• Оформить протокол разногласий\n\n"
-                    f"<i>Следующее напоминание: суббота в 10:00</i>"
-                )
-
-            await self._send_notification_to_all_users(message, "пятница")
+            messages = self.notification_planner.get_variants("пятница", today)
+            await self._send_notification_to_all_users(messages, "пятница")
         except Exception as e:
             logger.error(f"Ошибка отправки уведомления в пятницу: {e}")
 
@@ -486,110 +2458,113 @@ class DutyBot:
                 return
 
             logger.info(f"Запуск send_saturday_notification_all в субботу {today.strftime('%d.%m.%Y %H:%M')}")
-            duty_today = self.schedule_generator.get_todays_duty()
-
-            if not duty_today:
-                logger.info(f"На {today.strftime('%d.%m.%Y')} дежурных нет")
-                message = (
-                    f"🔔 <b>ИНФОРМАЦИЯ О ДЕЖУРСТВЕ</b>\n\n"
-                    f"📅 <b>Сегодня ({today.strftime('%d.%m.%Y')}) дежурных нет</b>\n\n"
-                    f"✅ Всем хороших выходных!\n\n"
-                    f"<i>Следующее напоминание: среда в 18:00</i>"
-                )
-            else:
-                if duty_today["is_pair"]:
-                    duty_text = f"{duty_today['employees'][0]} + {duty_today['employees'][1]}"
-                    phones_text = f"{duty_today['phones'][0]} + {duty_today['phones'][1]}"
-                else:
-                    duty_text = f"{duty_today['employees'][0]}"
-                    phones_text = f"{duty_today['phones'][0]}"
-
-                message = (
-                    f"🔔 <b>ИТОГИ ДЕЖУРСТВА</b>\n\n"
-                    f"📅 <b>Сегодня ({today.strftime('%d.%m.%Y')}) дежурили:</b>\n"
-                    f"👤 {duty_text}\n"
-                    f"📞 {phones_text}\n\n"
-                    f"✅ <b>Дежурство завершилось в 8:00</b>\n\n"
-                    f"📋 <b>Напоминание дежурным:</b>\n"
-                    f"• Не забудьте оформить протокол разногласий\n"
-                    f"• Протокол оставить у Е.С. Денисовой\n\n"
-                    f"<i>Следующее напоминание: среда в 18:00</i>"
-                )
-
-            await self._send_notification_to_all_users(message, "суббота")
+            messages = self.notification_planner.get_variants("суббота", today)
+            await self._send_notification_to_all_users(messages, "суббота")
         except Exception as e:
             logger.error(f"Ошибка отправки уведомления в субботу: {e}")
 
-    async def _send_notification_to_all_users(self, message: str, notification_type: str):
-        """Отправка уведомлений ВСЕМ пользователям с проверкой ID"""
-        sent_count = 0
-        error_count = 0
-        deactivated_users = []
-
-        self.load_user_data()
+    async def _send_notification_to_all_users(self, messages: Dict[str, str], notification_type: str):
+        """Отправка уведомлений ВСЕМ пользователям: дежурным - персональный вариант, остальным - общий"""
+        self.refresh_user_data()
         logger.info(f"Отправка уведомления {notification_type} - всего пользователей: {len(self.user_data)}")
 
-        for user_id, user_info in list(self.user_data.items()):
-            try:
-                chat_id = int(user_id)
-                await self.bot_instance.send_message(
-                    chat_id=chat_id,
-                    text=message,
-                    parse_mode=ParseMode.HTML
-                )
-                sent_count += 1
-                logger.debug(f"✓ Отправлено пользователю {user_id}")
-                await asyncio.sleep(0.1)
-            except ValueError:
-                logger.error(f"✗ Некорректный ID пользователя: {user_id}")
-                error_count += 1
-                deactivated_users.append(user_id)
-            except Exception as e:
-                error_count += 1
-                error_msg = str(e).lower()
-                logger.error(f"✗ Ошибка отправки пользователю {user_id}: {error_msg[:100]}")
-
-                if any(phrase in error_msg for phrase in [
-                    'bot was blocked', 'user not found', 'chat not found',
-                    'kicked', 'deactivated', 'forbidden', 'can\'t initiate'
-                ]):
-                    logger.warning(f"Удаляю неактивного пользователя: {user_id}")
-                    deactivated_users.append(user_id)
-
-        for user_id in deactivated_users:
-            self.user_data.pop(user_id, None)
+        # Снимок получателей: регистрации во время рассылки не меняют её состав
+        groups = NotificationPlanner.group_recipients(self.user_data, messages)
+        logger.info(f"Варианты уведомления {notification_type}: " +
+                    ", ".join(f"{variant or 'общий'} - {len(user_ids)}" for variant, user_ids in groups.items()))
+        broadcast_id = self.broadcast_journal.create(notification_type, messages, groups)
+        await self._run_broadcast(broadcast_id, notification_type, messages, groups)
+
+    async def _run_broadcast(self, broadcast_id: str, notification_type: str,
+                             messages: Dict[str, str], groups: Dict[str, List[str]]):
+        """Выполнить рассылку из журнала с пакетной фиксацией прогресса"""
+        stats = await self.broadcaster.run(
+            self.bot_instance, groups, messages,
+            on_checkpoint=lambda sent, failed: self.broadcast_journal.checkpoint(broadcast_id, sent, failed)
+        )
+        self.broadcast_journal.finish(broadcast_id)
+        deactivated_users = stats["deactivated"]
 
         if deactivated_users:
-            self.save_user_data()
+            self.delete_users(deactivated_users)
+
+        BROADCAST_MESSAGES.inc((notification_type, "sent"), stats["sent"])
+        BROADCAST_MESSAGES.inc((notification_type, "failed"), stats["failed"])
+        BROADCAST_MESSAGES.inc((notification_type, "removed"), len(deactivated_users))
 
         logger.info(f"=== ИТОГИ УВЕДОМЛЕНИЯ {notification_type.upper()} ===")
         logger.info(f"Всего в базе: {len(self.user_data) + len(deactivated_users)}")
-        logger.info(f"Отправлено успешно: {sent_count}")
-        logger.info(f"Ошибок: {error_count}")
+        logger.info(f"Отправлено успешно: {stats['sent']}")
+        logger.info(f"Ошибок: {stats['failed']}")
         logger.info(f"Удалено неактивных: {len(deactivated_users)}")
+        logger.info(f"Повторных попыток: {stats['retried']}")
+        if stats["errors"]:
+            logger.info("Ошибки по типам: " + ", ".join(
+                f"{error_class} - {count}" for error_class, count in sorted(stats["errors"].items())))
+        logger.info(f"Скорость: {stats['rate']:.1f} сообщ./с за {stats['elapsed']:.1f} с")
 
-        if sent_count == 0 and len(self.user_data) > 0:
+        if stats["sent"] == 0 and len(self.user_data) > 0:
             logger.error("⚠️ КРИТИЧЕСКАЯ ПРОБЛЕМА: НЕ УДАЛОСЬ ОТПРАВИТЬ НИ ОДНОГО УВЕДОМЛЕНИЯ!")
 
     def load_user_data(self):
         """Загрузка данных пользователей"""
-        if os.path.exists(self.user_data_file):
-            try:
-                with open(self.user_data_file, 'r', encoding='utf-8') as f:
-                    self.user_data = json.load(f)
-            except Exception as e:
-                logger.error(f"Ошибка загрузки user_data.json: {e}")
-                self.user_data = {}
-        else:
+        try:
+            self.user_data = self.user_store.load_all()
+        except Exception as e:
+            logger.error(f"Ошибка загрузки пользователей из {self.user_store.db_path}: {e}")
             self.user_data = {}
 
-    def save_user_data(self):
-        """Сохранение данных пользователей"""
+    def refresh_user_data(self):
+        """Подхватить внешние правки базы без замены self.user_data
+
+        Словарь в памяти - основной источник данных. Если базу меняли снаружи, изменения
+        вливаются в него на месте; записи с несохраненными изменениями бота не затираются.
+        """
+        if not self.user_store.external_changes():
+            return
         try:
-            with open(self.user_data_file, 'w', encoding='utf-8') as f:
-                json.dump(self.user_data, f, ensure_ascii=False, indent=2)
+            fresh = self.user_store.load_all()
         except Exception as e:
-            logger.error(f"Ошибка сохранения user_data.json: {e}")
+            logger.error(f"Ошибка перечитывания пользователей: {e}")
+            return
+
+        pending = self.user_writer.dirty
+        added = updated = removed = 0
+        for user_id, info in fresh.items():
+            if user_id in pending:
+                continue
+            current = self.user_data.get(user_id)
+            if current is None:
+                self.user_data[user_id] = info
+                added += 1
+            elif current != info:
+                current.clear()
+                current.update(info)
+                updated += 1
+        for user_id in [uid for uid in self.user_data if uid not in fresh and uid not in pending]:
+            del self.user_data[user_id]
+            removed += 1
+        logger.info(f"Внешние изменения базы пользователей: +{added}, ~{updated}, -{removed}")
+
+    def save_user_data(self, user_id: str):
+        """Сохранение одного пользователя (отложенная запись)"""
+        if user_id in self.user_data:
+            self.user_writer.mark(user_id, self.user_data[user_id])
+
+    def save_users(self, user_ids: List[str]):
+        """Сохранение нескольких пользователей (отложенная запись)"""
+        for user_id in user_ids:
+            self.save_user_data(user_id)
+
+    def delete_users(self, user_ids: List[str]):
+        """Удаление пользователей из памяти и из базы"""
+        for user_id in user_ids:
+            self.user_data.pop(user_id, None)
+        self.user_writer.discard(user_ids)
+        try:
+            self.user_store.delete_many(user_ids)
+        except Exception as e:
+            logger.error(f"Ошибка удаления пользователей: {e}")
 
     def is_admin(self, user_id: str) -> bool:
         """Проверка, является ли пользователь админом"""
@@ -609,8 +2584,27 @@ class DutyBot:
             username = '@' + username
         return TELEGRAM_TO_EMPLOYEE.get(username.lower())
 
+    def _cached_keyboard(self, key: tuple) -> Optional[InlineKeyboardMarkup]:
+        return self._keyboards.get(key)
+
+    def _remember_keyboard(self, key: tuple, keyboard: List[List[InlineKeyboardButton]]) -> InlineKeyboardMarkup:
+        """Собрать клавиатуру один раз и хранить готовый объект"""
+        markup = InlineKeyboardMarkup(keyboard)
+        self._keyboards[key] = markup
+        return markup
+
+    def invalidate_employee_keyboards(self):
+        """Сбросить клавиатуры выбора сотрудника после изменения списка сотрудников"""
+        for key in [key for key in self._keyboards if key[0] == "employees"]:
+            del self._keyboards[key]
+
     def get_main_keyboard(self, user_id: str) -> InlineKeyboardMarkup:
         """Клавиатура главного меню"""
+        key = ("main", self.is_admin(user_id))
+        cached = self._cached_keyboard(key)
+        if cached:
+            return cached
+
         keyboard = [
             [
                 InlineKeyboardButton("📋 Полный график", callback_data="full_schedule"),
@@ -626,13 +2620,17 @@ class DutyBot:
             ]
         ]
 
-        if self.is_admin(user_id):
+        if key[1]:
             keyboard.append([InlineKeyboardButton("⚙️ Админ-панель", callback_data="admin_panel")])
 
-        return InlineKeyboardMarkup(keyboard)
+        return self._remember_keyboard(key, keyboard)
 
     def get_admin_keyboard(self) -> InlineKeyboardMarkup:
         """Клавиатура админ-панели"""
+        cached = self._cached_keyboard(("admin",))
+        if cached:
+            return cached
+
         keyboard = [
             [
                 InlineKeyboardButton("📅 Управление графиком", callback_data="admin_schedule"),
@@ -647,10 +2645,14 @@ class DutyBot:
                 InlineKeyboardButton("🚪 Выйти из админки", callback_data="admin_logout")
             ]
         ]
-        return InlineKeyboardMarkup(keyboard)
+        return self._remember_keyboard(("admin",), keyboard)
 
     def get_schedule_admin_keyboard(self) -> InlineKeyboardMarkup:
         """Клавиатура управления графиком"""
+        cached = self._cached_keyboard(("admin_schedule",))
+        if cached:
+            return cached
+
         keyboard = [
             [
                 InlineKeyboardButton("➕ Добавить дежурство", callback_data="admin_add_duty"),
@@ -662,10 +2664,14 @@ class DutyBot:
             ],
             [InlineKeyboardButton("🔙 Назад в админку", callback_data="admin_panel")]
         ]
-        return InlineKeyboardMarkup(keyboard)
+        return self._remember_keyboard(("admin_schedule",), keyboard)
 
     def get_employees_admin_keyboard(self) -> InlineKeyboardMarkup:
         """Клавиатура управления сотрудниками"""
+        cached = self._cached_keyboard(("admin_employees",))
+        if cached:
+            return cached
+
         keyboard = [
             [
                 InlineKeyboardButton("➕ Добавить сотрудника", callback_data="admin_add_employee"),
@@ -675,12 +2681,17 @@ class DutyBot:
                 InlineKeyboardButton("📞 Изменить телефон", callback_data="admin_edit_phone"),
                 InlineKeyboardButton("👥 Список сотрудников", callback_data="admin_list_employees")
             ],
+            [InlineKeyboardButton("🔁 Круг дежурств", callback_data="admin_edit_rotation")],
             [InlineKeyboardButton("🔙 Назад в админку", callback_data="admin_panel")]
         ]
-        return InlineKeyboardMarkup(keyboard)
+        return self._remember_keyboard(("admin_employees",), keyboard)
 
     def get_files_admin_keyboard(self) -> InlineKeyboardMarkup:
         """Клавиатура управления файлами"""
+        cached = self._cached_keyboard(("admin_files",))
+        if cached:
+            return cached
+
         keyboard = [
             [
                 InlineKeyboardButton("📤 Загрузить протокол", callback_data="admin_upload_protocol"),
@@ -692,32 +2703,44 @@ class DutyBot:
             ],
             [InlineKeyboardButton("🔙 Назад в админку", callback_data="admin_panel")]
         ]
-        return InlineKeyboardMarkup(keyboard)
+        return self._remember_keyboard(("admin_files",), keyboard)
 
     def get_back_keyboard(self) -> InlineKeyboardMarkup:
         """Клавиатура с кнопкой назад"""
+        cached = self._cached_keyboard(("back",))
+        if cached:
+            return cached
+
         keyboard = [[InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_main")]]
-        return InlineKeyboardMarkup(keyboard)
+        return self._remember_keyboard(("back",), keyboard)
 
     def get_employee_selection_keyboard(self, prefix: str = "emp_") -> InlineKeyboardMarkup:
         """Динамическая клавиатура для выбора сотрудника"""
+        key = ("employees", prefix)
+        cached = self._cached_keyboard(key)
+        if cached:
+            return cached
+
         keyboard = []
         employees_list = list(EMPLOYEE_PHONES.keys())
 
+        employee_id = self.schedule_generator.get_employee_id
+
         for i in range(0, len(employees_list), 2):
             row = []
             if i < len(employees_list):
-                row.append(InlineKeyboardButton(f"{employees_list[i]}", callback_data=f"{prefix}{employees_list[i]}"))
+                row.append(InlineKeyboardButton(f"{employees_list[i]}",
+                                                callback_data=f"{prefix}{employee_id(employees_list[i])}"))
             if i + 1 < len(employees_list):
-                row.append(
-                    InlineKeyboardButton(f"{employees_list[i + 1]}", callback_data=f"{prefix}{employees_list[i + 1]}"))
+                row.append(InlineKeyboardButton(f"{employees_list[i + 1]}",
+                                                callback_data=f"{prefix}{employee_id(employees_list[i + 1])}"))
             if row:
                 keyboard.append(row)
 
         if prefix.startswith("add_e"):
             keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="admin_schedule")])
 
-        return InlineKeyboardMarkup(keyboard)
+        return self._remember_keyboard(key, keyboard)
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
@@ -743,10 +2766,8 @@ class DutyBot:
                 if employee_name:
                     self.user_data[user_id]["selected_employee"] = employee_name
 
-            self.save_user_data()
-
         self.user_data[user_id]["last_active"] = datetime.now().isoformat()
-        self.save_user_data()
+        self.save_user_data(user_id)
 
         user_info = self.user_data[user_id]
         employee_name = user_info.get("selected_employee")
@@ -803,7 +2824,7 @@ class DutyBot:
         if login == ADMIN_CREDENTIALS["login"] and password == ADMIN_CREDENTIALS["password"]:
             if user_id in self.user_data:
                 self.user_data[user_id]["is_admin"] = True
-                self.save_user_data()
+                self.save_user_data(user_id)
 
             self.admin_sessions[user_id] = {
                 "logged_in": True,
@@ -840,7 +2861,7 @@ class DutyBot:
             )
             return
 
-        self.load_user_data()
+        self.refresh_user_data()
         text = "📊 <b>СТАТУС ПОЛЬЗОВАТЕЛЕЙ</b>\n\n"
         total = len(self.user_data)
         with_employee = 0
@@ -873,14 +2894,15 @@ class DutyBot:
         user = update.effective_user
         if not self.is_super_admin(user.username): return
 
-        self.load_user_data()
-        enabled_count = 0
+        self.refresh_user_data()
+        enabled = []
         for uid, info in self.user_data.items():
             if not info.get('notifications', True):
                 self.user_data[uid]['notifications'] = True
-                enabled_count += 1
+                enabled.append(uid)
 
-        self.save_user_data()
+        self.save_users(enabled)
+        enabled_count = len(enabled)
         await update.message.reply_text(
             f"✅ Уведомления включены для {enabled_count} пользователей\n📊 Всего пользователей: {len(self.user_data)}",
             parse_mode=ParseMode.HTML)
@@ -901,12 +2923,9 @@ class DutyBot:
         target_name = target
 
         if target.startswith('@'):
-            username = target[1:].lower()
-            for uid, info in self.user_data.items():
-                if info.get('username', '').lower() == username:
-                    target_id = uid
-                    target_name = info.get('telegram_name', target)
-                    break
+            target_id = self.user_store.find_by_username(target[1:])
+            if target_id in self.user_data:
+                target_name = self.user_data[target_id].get('telegram_name', target)
             if not target_id:
                 await update.message.reply_text(f"❌ Пользователь {target} не найден в базе")
                 return
@@ -956,13 +2975,52 @@ class DutyBot:
             parse_mode=ParseMode.HTML
         )
 
+    async def perf_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Профилирование процесса - ТОЛЬКО ДЛЯ @Tamerlantcik: /perf start [секунд] | stop | report"""
+        user = update.effective_user
+        if not self.is_super_admin(user.username): return
+
+        action = context.args[0].lower() if context.args else "report"
+        if action == "start":
+            try:
+                window = min(max(float(context.args[1]), 1.0), 600.0) if len(context.args) > 1 else 120.0
+            except ValueError:
+                await update.message.reply_text("❌ Используйте: /perf start [секунд, до 600]")
+                return
+            if self.profiler.start(window):
+                await update.message.reply_text(
+                    f"🔬 <b>ПРОФИЛИРОВАНИЕ ЗАПУЩЕНО</b>\n\nОкно: {window:.0f} с\n"
+                    "Остановить: /perf stop\nОтчет: /perf report",
+                    parse_mode=ParseMode.HTML)
+            else:
+                await update.message.reply_text("ℹ️ Профилирование уже идет. /perf stop - остановить")
+        elif action == "stop":
+            # Остановка ждет поток сборщика и снимок памяти - не в цикле событий
+            if await asyncio.to_thread(self.profiler.stop):
+                await update.message.reply_text("⏹ Профилирование остановлено. /perf report - отчет")
+            else:
+                await update.message.reply_text("ℹ️ Профилирование не запущено")
+        elif action == "report":
+            if self.profiler.started_at is None:
+                await update.message.reply_text("ℹ️ Данных нет. /perf start - начать сбор")
+                return
+            report = await asyncio.to_thread(self.profiler.report)
+            document = io.BytesIO(report.encode('utf-8'))
+            await update.message.reply_document(
+                document=document,
+                filename=f"perf-{datetime.now(MOSCOW_TZ).strftime('%Y%m%d-%H%M%S')}.txt",
+                caption=f"🔬 Профиль: {self.profiler.samples} выборок"
+            )
+        else:
+            await update.message.reply_text("❌ Используйте: /perf start [секунд] | stop | report")
+
     async def fix_all_users(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """ИСПРАВИТЬ: Включить уведомления и проверить всех пользователей"""
         user = update.effective_user
         if not self.is_super_admin(user.username): return
 
-        self.load_user_data()
-        fixed_count = 0
+        self.refresh_user_data()
+        fixed = []
         for uid, info in self.user_data.items():
             changes = []
             if not info.get('notifications', True):
@@ -972,127 +3030,156 @@ class DutyBot:
                 info['telegram_name'] = info.get('first_name', 'Пользователь')
                 changes.append("добавлено имя")
             if changes:
-                fixed_count += 1
+                fixed.append(uid)
                 logger.info(f"Исправлен пользователь {uid}: {', '.join(changes)}")
 
-        self.save_user_data()
+        self.save_users(fixed)
+        fixed_count = len(fixed)
 
         test_msg = (
             f"🔔 <b>ТЕСТОВОЕ УВЕДОМЛЕНИЕ ОТ АДМИНИСТРАТОРА</b>\n\n✅ Ваши уведомления были включены!\n\n"
             f"📅 Вы будете получать напоминания:\n• В среду в 18:00 - о дежурстве в субботу\n• В пятницу в 18:00 - о завтрашнем дежурстве\n• В субботу в 10:00 - в день дежурства\n\n📋 Используйте /start для просмотра меню"
         )
 
-        sent_count = 0
-        error_count = 0
-        for uid in self.user_data.keys():
-            try:
-                await self.bot_instance.send_message(chat_id=int(uid), text=test_msg, parse_mode=ParseMode.HTML)
-                sent_count += 1
-                await asyncio.sleep(0.1)
-            except Exception as e:
-                error_count += 1
-                logger.error(f"Ошибка отправки теста пользователю {uid}: {e}")
+        recipients = list(self.user_data.keys())
+        stats = await self.broadcaster.run(self.bot_instance, {"": recipients}, {"": test_msg})
 
         await update.message.reply_text(
-            f"✅ <b>ИСПРАВЛЕНИЕ ЗАВЕРШЕНО</b>\n\n📊 Исправлено пользователей: {fixed_count}\n📤 Отправлено тестовых уведомлений: {sent_count}\n❌ Ошибок отправки: {error_count}\n\n🔔 Теперь все пользователи будут получать уведомления!",
+            f"✅ <b>ИСПРАВЛЕНИЕ ЗАВЕРШЕНО</b>\n\n📊 Исправлено пользователей: {fixed_count}\n📤 Отправлено тестовых уведомлений: {stats['sent']}\n❌ Ошибок отправки: {stats['failed']}\n{self._format_errors(stats)}⚡ Скорость: {stats['rate']:.1f} сообщ./с\n\n🔔 Теперь все пользователи будут получать уведомления!",
             parse_mode=ParseMode.HTML
         )
 
+    @staticmethod
+    def _format_errors(stats: Dict) -> str:
+        """Строка с ошибками рассылки по типам для отчета в чат"""
+        if not stats["errors"]:
+            return ""
+        return "🧾 По типам: " + ", ".join(
+            f"{error_class} - {count}" for error_class, count in sorted(stats["errors"].items())) + "\n"
+
     # ============= КОНЕЦ ДИАГНОСТИЧЕСКИХ КОМАНД =============
 
+    def has_admin_session(self, user_id: str) -> bool:
+        """Админ с активной сессией"""
+        return self.is_admin(user_id) and self.admin_sessions.get(user_id, {}).get("logged_in", False)
+
+    async def deny_admin_access(self, query):
+        await query.edit_message_text(
+            "❌ <b>ДОСТУП ЗАПРЕЩЕН</b>\n\nДоступ только админам\n<code>Зайдите с нужного аккаунта!!</code>",
+            parse_mode=ParseMode.HTML)
+
+    def _build_callback_router(self) -> CallbackRouter:
+        """Таблица маршрутов кнопок"""
+        router = CallbackRouter(self.has_admin_session, self.deny_admin_access)
+
+        for data, handler in (
+            ("full_schedule", self.show_full_schedule),
+            ("my_duty", self.show_my_duty),
+            ("instructions", self.show_instructions),
+            ("protocol", self.download_protocol),
+            ("questions", self.show_questions),
+            ("back_to_main", self.back_to_main),
+            ("change_profile", self.change_profile),
+            ("admin_logout", self.admin_logout),
+        ):
+            router.add(data, handler)
+
+        for data, handler in (
+            ("admin_panel", self.show_admin_panel),
+            ("admin_refresh_schedule", self.admin_refresh_schedule),
+            ("admin_schedule", self.show_admin_schedule),
+            ("admin_employees", self.show_admin_employees),
+            ("admin_files", self.show_admin_files),
+            ("admin_stats", self.show_admin_stats),
+            ("admin_add_duty", self.admin_add_duty),
+            ("admin_remove_duty", self.admin_remove_duty),
+            ("admin_add_employee", self.admin_add_employee),
+            ("admin_remove_employee", self.admin_remove_employee),
+            ("admin_edit_phone", self.admin_edit_phone),
+            ("admin_edit_rotation", self.admin_edit_rotation),
+            ("admin_list_employees", self.admin_list_employees),
+            ("admin_upload_protocol", self.admin_upload_protocol),
+            ("admin_delete_protocol", self.admin_delete_protocol),
+            ("admin_check_protocol", self.admin_check_protocol),
+            ("admin_pin_protocol", self.admin_pin_protocol),
+            ("admin_rollback_protocol", self.admin_rollback_protocol),
+        ):
+            router.add(data, handler, admin=True)
+
+        # Параметризованные кнопки: после префикса идет значение
+        router.add_prefix("emp_", self.select_employee)
+        router.add_prefix("duty_protocol_", self.send_duty_protocol)
+        router.add_prefix("add_type_", self.admin_choose_duty_type, admin=True)
+        router.add_prefix("add_e1_", self.admin_choose_first_employee, admin=True)
+        router.add_prefix("add_e2_", self.admin_choose_second_employee, admin=True)
+        return router
+
     async def button_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик нажатий кнопок"""
         query = update.callback_query
         await query.answer()
+        await self.callback_router.dispatch(query, context, str(query.from_user.id), query.data)
 
-        user_id = str(query.from_user.id)
-        data = query.data
-
-        if data == "admin_panel":
-            if self.is_admin(user_id) and self.admin_sessions.get(user_id, {}).get("logged_in"):
-                await self.show_admin_panel(query)
-            else:
-                await query.edit_message_text(
-                    "❌ <b>ДОСТУП ЗАПРЕЩЕН</b>\n\nДоступ только админам\n<code>Зайдите с нужного аккаунта!!</code>",
-                    parse_mode=ParseMode.HTML)
+    async def select_employee(self, query, context, employee_id: str):
+        """Регистрация пользователя из меню"""
+        employee_name = self.schedule_generator.get_employee_by_id(employee_id)
+        if employee_name is None:
+            await self.answer_stale_button(query, "emp_")
             return
+        await self.register_employee(query, employee_name)
+
+    async def answer_stale_button(self, query, prefix: str):
+        """Кнопка выбора сотрудника из старого меню - показать актуальный список"""
+        await query.edit_message_text("⚠️ Кнопка устарела, откройте меню заново",
+                                      reply_markup=self.get_employee_selection_keyboard(prefix))
+
+    # ПОШАГОВОЕ ДОБАВЛЕНИЕ ДЕЖУРСТВА (ИНТЕГРИРОВАНО)
+    async def admin_add_duty(self, query, context=None):
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("👤 Один дежурный", callback_data="add_type_single"),
+             InlineKeyboardButton("👥 Пара (2 чел.)", callback_data="add_type_pair")],
+            [InlineKeyboardButton("❌ Отмена", callback_data="admin_schedule")]
+        ])
+        await query.edit_message_text("➕ <b>НОВОЕ ДЕЖУРСТВО</b>\n\n<b>Шаг 1:</b> Выберите формат дежурства:",
+                                      reply_markup=kb, parse_mode=ParseMode.HTML)
+
+    async def admin_choose_duty_type(self, query, context, duty_type: str):
+        is_pair = (duty_type == "pair")
+        context.user_data['new_duty'] = {'is_pair': is_pair, 'employees': [], 'phones': []}
+        context.user_data['awaiting_step'] = 'wait_date'
+        await query.edit_message_text(
+            "📅 <b>Шаг 2:</b> Введите дату в чат\n\nФормат: <code>дд.мм.гггг</code>\n<i>Например: 07.02.2026</i>",
+            parse_mode=ParseMode.HTML)
 
-        handlers = {
-            "full_schedule": self.show_full_schedule,
-            "my_duty": self.show_my_duty,
-            "instructions": self.show_instructions,
-            "protocol": self.download_protocol,
-            "questions": self.show_questions,
-            "back_to_main": self.back_to_main,
-            "change_profile": self.change_profile,
-            "admin_panel": self.show_admin_panel,
-            "admin_logout": self.admin_logout,
-            "admin_refresh_schedule": self.admin_refresh_schedule,
-            "admin_schedule": self.show_admin_schedule,
-            "admin_employees": self.show_admin_employees,
-            "admin_files": self.show_admin_files,
-            "admin_stats": self.show_admin_stats,
-            "admin_remove_duty": self.admin_remove_duty,
-            "admin_add_employee": self.admin_add_employee,
-            "admin_remove_employee": self.admin_remove_employee,
-            "admin_edit_phone": self.admin_edit_phone,
-            "admin_list_employees": self.admin_list_employees,
-            "admin_upload_protocol": self.admin_upload_protocol,
-            "admin_delete_protocol": self.admin_delete_protocol,
-            "admin_check_protocol": self.admin_check_protocol,
-            "admin_pin_protocol": self.admin_pin_protocol,
-        }
+    async def admin_choose_first_employee(self, query, context, employee_id: str):
+        name = self.schedule_generator.get_employee_by_id(employee_id)
+        if name is None:
+            await self.answer_stale_button(query, "add_e1_")
+            return
+        context.user_data['new_duty']['employees'].append(name)
 
-        # Регистрация пользователя из меню
-        if data.startswith("emp_"):
-            employee_name = data[4:]
-            await self.register_employee(query, employee_name)
-
-        # ПОШАГОВОЕ ДОБАВЛЕНИЕ ДЕЖУРСТВА (ИНТЕГРИРОВАНО)
-        elif data == "admin_add_duty":
-            kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("👤 Один дежурный", callback_data="add_type_single"),
-                 InlineKeyboardButton("👥 Пара (2 чел.)", callback_data="add_type_pair")],
-                [InlineKeyboardButton("❌ Отмена", callback_data="admin_schedule")]
-            ])
-            await query.edit_message_text("➕ <b>НОВОЕ ДЕЖУРСТВО</b>\n\n<b>Шаг 1:</b> Выберите формат дежурства:",
-                                          reply_markup=kb, parse_mode=ParseMode.HTML)
-
-        elif data.startswith("add_type_"):
-            is_pair = (data == "add_type_pair")
-            context.user_data['new_duty'] = {'is_pair': is_pair, 'employees': [], 'phones': []}
-            context.user_data['awaiting_step'] = 'wait_date'
+        if context.user_data['new_duty']['is_pair']:
             await query.edit_message_text(
-                "📅 <b>Шаг 2:</b> Введите дату в чат\n\nФормат: <code>дд.мм.гггг</code>\n<i>Например: 07.02.2026</i>",
-                parse_mode=ParseMode.HTML)
-
-        elif data.startswith("add_e1_"):
-            name = data.replace("add_e1_", "")
-            context.user_data['new_duty']['employees'].append(name)
-
-            if context.user_data['new_duty']['is_pair']:
-                await query.edit_message_text(
-                    f"✅ Выбран первый: <b>{name}</b>\n\n👥 <b>Шаг 4:</b> Выберите второго дежурного:",
-                    reply_markup=self.get_employee_selection_keyboard("add_e2_"), parse_mode=ParseMode.HTML)
-            else:
-                context.user_data['awaiting_step'] = 'wait_phones'
-                await query.edit_message_text(
-                    f"✅ Выбран: <b>{name}</b>\n\n📞 <b>Шаг 4:</b> Введите номер телефона в чат.\n\n<i>Лайфхак: Напишите в чат слово <b>ок</b>, и бот сам подставит сохраненный номер сотрудника!</i>",
-                    parse_mode=ParseMode.HTML)
-
-        elif data.startswith("add_e2_"):
-            name = data.replace("add_e2_", "")
-            context.user_data['new_duty']['employees'].append(name)
+                f"✅ Выбран первый: <b>{name}</b>\n\n👥 <b>Шаг 4:</b> Выберите второго дежурного:",
+                reply_markup=self.get_employee_selection_keyboard("add_e2_"), parse_mode=ParseMode.HTML)
+        else:
             context.user_data['awaiting_step'] = 'wait_phones'
             await query.edit_message_text(
-                f"✅ Выбрана пара: <b>{context.user_data['new_duty']['employees'][0]} + {name}</b>\n\n"
-                "📞 <b>Шаг 5:</b> Введите телефоны через запятую.\n\n<i>Лайфхак: Напишите в чат слово <b>ок</b>, и бот сам подставит номера обоих сотрудников!</i>",
-                parse_mode=ParseMode.HTML
-            )
+                f"✅ Выбран: <b>{name}</b>\n\n📞 <b>Шаг 4:</b> Введите номер телефона в чат.\n\n<i>Лайфхак: Напишите в чат слово <b>ок</b>, и бот сам подставит сохраненный номер сотрудника!</i>",
+                parse_mode=ParseMode.HTML)
 
-        # Стандартные обработчики кнопок
-        elif data in handlers:
-            await handlers[data](query, context)
+    async def admin_choose_second_employee(self, query, context, employee_id: str):
+        name = self.schedule_generator.get_employee_by_id(employee_id)
+        if name is None:
+            await self.answer_stale_button(query, "add_e2_")
+            return
+        context.user_data['new_duty']['employees'].append(name)
+        context.user_data['awaiting_step'] = 'wait_phones'
+        await query.edit_message_text(
+            f"✅ Выбрана пара: <b>{context.user_data['new_duty']['employees'][0]} + {name}</b>\n\n"
+            "📞 <b>Шаг 5:</b> Введите телефоны через запятую.\n\n<i>Лайфхак: Напишите в чат слово <b>ок</b>, и бот сам подставит номера обоих сотрудников!</i>",
+            parse_mode=ParseMode.HTML
+        )
 
     async def show_full_schedule(self, query, context=None):
         """Показать полный график дежурств"""
@@ -1120,26 +3207,15 @@ class DutyBot:
             await query.edit_message_text("❌ Выберите сотрудника в меню")
             return
 
-        duties = self.schedule_generator.get_employee_schedule(employee_name)
-        today = datetime.now(MOSCOW_TZ).replace(tzinfo=None)
-
-        if not duties:
-            text = f"📅 <b>БЛИЖАЙШИЕ ДЕЖУРСТВА: {employee_name}</b>\n\nНет запланированных дежурств"
-        else:
-            text = f"📅 <b>БЛИЖАЙШИЕ ДЕЖУРСТВА: {employee_name}</b>\n\n"
-            for duty in duties[:3]:
-                days_left = (duty["date_obj"] - today).days
-                if duty["is_pair"]:
-                    partners = [e for e in duty["employees"] if e != employee_name]
-                    duty_text = f"{duty['date']} (с {', '.join(partners)})"
-                    phones = ', '.join(duty['phones'])
-                else:
-                    duty_text = duty['date']
-                    phones = duty['phones'][0]
-
-                text += f"{duty_text}\n📅 Осталось: {max(0, days_left)} дней\n📞 {phones}\n\n"
+        text = self.schedule_generator.get_employee_duties_text(employee_name)
 
         keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]
+        next_duty = self.schedule_generator.get_next_duty(employee_name)
+        if next_duty and self.protocol_store.current():
+            keyboard.insert(0, [InlineKeyboardButton(
+                f"📄 Протокол на {next_duty['date_obj'].strftime('%d.%m.%Y')}",
+                callback_data=f"duty_protocol_{next_duty['date_obj'].toordinal()}"
+            )])
         await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
 
     async def back_to_main(self, query, context=None):
@@ -1160,21 +3236,75 @@ class DutyBot:
 
         await query.edit_message_text(text, reply_markup=self.get_main_keyboard(user_id), parse_mode=ParseMode.HTML)
 
+    async def _reply_document_cached(self, message, cache_key: str, get_path, filename: str, caption: str):
+        """Отправить документ по сохраненному file_id, а при его отсутствии загрузить файл и запомнить file_id
+
+        get_path - корутина, возвращающая путь к файлу; вызывается только если загрузка нужна.
+        """
+        file_id = self.file_ids.get(cache_key)
+        if file_id:
+            try:
+                return await message.reply_document(document=file_id, caption=caption, parse_mode=ParseMode.HTML)
+            except BadRequest as e:
+                # Сетевые ошибки и лимиты не повод забывать file_id - их обрабатывает вызывающий
+                logger.warning(f"file_id {filename} больше не действителен, файл будет загружен заново: {e}")
+                self.file_ids.forget(cache_key)
+
+        path = await get_path()
+        with open(path, 'rb') as f:
+            sent = await message.reply_document(document=f, filename=filename, caption=caption,
+                                                parse_mode=ParseMode.HTML)
+        if sent.document:
+            self.file_ids.put(cache_key, sent.document.file_id)
+        return sent
+
     async def download_protocol(self, query, context=None):
         """Скачать протокол разногласий"""
         try:
-            if not os.path.exists(self.protocol_file_path):
+            version = self.protocol_store.current()
+            if version is None:
                 await query.edit_message_text("❌ Файл не найден", reply_markup=self.get_back_keyboard(),
                                               parse_mode=ParseMode.HTML)
                 return
 
-            with open(self.protocol_file_path, 'rb') as f:
-                await query.message.reply_document(
-                    document=f,
-                    filename="Протокол разногласий.docx",
-                    caption="📄 Протокол разногласий",
-                    parse_mode=ParseMode.HTML
-                )
+            content_hash = version["hash"]
+
+            async def get_path():
+                return self.protocol_store.path_for(content_hash)
+
+            await self._reply_document_cached(query.message, content_hash, get_path,
+                                              "Протокол разногласий.docx", "📄 Протокол разногласий")
+
+            await query.edit_message_text("✅ Файл отправлен", reply_markup=self.get_back_keyboard(),
+                                          parse_mode=ParseMode.HTML)
+        except Exception as e:
+            await query.edit_message_text(f"❌ Ошибка: {str(e)[:50]}", reply_markup=self.get_back_keyboard(),
+                                          parse_mode=ParseMode.HTML)
+
+    async def send_duty_protocol(self, query, context, day: str):
+        """Протокол, заполненный на дежурство в указанную субботу"""
+        try:
+            version = self.protocol_store.current()
+            duty = self.schedule_generator.get_duty(datetime.fromordinal(int(day)))
+            if version is None or duty is None:
+                await query.edit_message_text("❌ Файл не найден", reply_markup=self.get_back_keyboard(),
+                                              parse_mode=ParseMode.HTML)
+                return
+
+            date_text = duty["date_obj"].strftime('%d.%m.%Y')
+            cache_key = ProtocolRenderer.cache_key(version["hash"], duty)
+            self.protocol_renderer.touch(cache_key)
+
+            async def get_path():
+                # Сборка документа - работа с zip на диске, выполняется вне цикла событий
+                path, dropped = await asyncio.to_thread(self.protocol_renderer.render, version["hash"], duty)
+                for dropped_key in dropped:
+                    self.file_ids.forget(dropped_key)
+                return path
+
+            await self._reply_document_cached(query.message, cache_key, get_path,
+                                              f"Протокол разногласий {date_text}.docx",
+                                              f"📄 Протокол разногласий на {date_text}")
 
             await query.edit_message_text("✅ Файл отправлен", reply_markup=self.get_back_keyboard(),
                                           parse_mode=ParseMode.HTML)
@@ -1231,7 +3361,7 @@ class DutyBot:
         if user_id in self.user_data:
             self.user_data[user_id]["selected_employee"] = employee_name
             self.user_data[user_id]["registered_at"] = datetime.now().isoformat()
-            self.save_user_data()
+            self.save_user_data(user_id)
 
             text = (
                 "<b>✅ РЕГИСТРАЦИЯ УСПЕШНА</b>\n\n"
@@ -1282,7 +3412,7 @@ class DutyBot:
 
         if user_id in self.user_data:
             self.user_data[user_id]["is_admin"] = False
-            self.save_user_data()
+            self.save_user_data(user_id)
 
         await query.edit_message_text(
             "✅ <b>ВЫ УСПЕШНО ВЫШЛИ ИЗ АДМИН-ПАНЕЛИ</b>\n\nВсе права администратора отозваны.",
@@ -1322,11 +3452,12 @@ class DutyBot:
 
     async def show_admin_files(self, query, context=None):
         """Показать управление файлами"""
-        protocol_exists = os.path.exists(self.protocol_file_path)
+        protocol_exists = self.protocol_store.current() is not None
         text = (
             "📁 <b>УПРАВЛЕНИЕ ФАЙЛАМИ</b>\n\n"
             f"📄 <b>Протокол разногласий:</b>\n"
             f"Статус: {'✅ Доступен' if protocol_exists else '❌ Отсутствует'}\n"
+            f"Версий в истории: {len(self.protocol_store.versions)}\n"
             f"Прикреплен: {'✅ Да' if self.protocol_attached_file_id else '❌ Нет'}\n\n"
             "Доступные действия:\n\n"
             "📤 <b>Загрузить протокол:</b>\nДобавить новый файл протокола\n\n"
@@ -1368,19 +3499,33 @@ class DutyBot:
                 next_saturday = check_date
                 break
 
-        current_schedule = self.schedule_generator._generate_dynamic_schedule()
-        next_duty = next((d for d in current_schedule.values() if d["date_obj"].date() == next_saturday), None)
+        saturday = datetime.combine(next_saturday, datetime.min.time())
+        next_duty = next(self.schedule_generator.iter_duties(saturday, saturday), None)
 
         text = (
             "📊 <b>СТАТИСТИКА СИСТЕМЫ</b>\n\n"
             f"👥 <b>Всего пользователей:</b> {total_users}\n"
             f"📱 <b>Активных сегодня:</b> {active_today}\n"
             f"🤖 <b>Автопривязанных:</b> {auto_linked}\n"
-            f"📅 <b>Дежурств на выводе:</b> {len(current_schedule)}\n"
-            f"👥 <b>Ручных правок в базе:</b> {len(self.schedule_generator.schedule)}\n"
-            f"👤 <b>Всего сотрудников:</b> {len(EMPLOYEE_PHONES)}\n\n"
+            f"📅 <b>Дежурств на выводе:</b> {DutyScheduleGenerator.SCHEDULE_WEEKS}\n"
+            f"👥 <b>Ручных правок в базе:</b> {len(self.schedule_generator.overrides)}\n"
+            f"👤 <b>Всего сотрудников:</b> {len(EMPLOYEE_PHONES)}\n"
+        )
+
+        # Равномерность нагрузки: сколько суббот выпадает каждому за год вперед
+        text += self.schedule_generator.get_fairness_text()
+
+        writer_stats = self.user_writer.get_stats()
+        text += (
+            f"💾 <b>Записей в базу:</b> {writer_stats['flushes']} "
+            f"(в среднем {writer_stats['avg_batch']:.1f}, макс. {writer_stats['max_batch']} за раз)\n"
         )
 
+        route_stats = sorted(self.callback_router.get_stats().items(), key=lambda item: item[1]["calls"], reverse=True)
+        text += "🖱 <b>Кнопки:</b> " + (", ".join(
+            f"{route} - {stats['calls']} ({stats['avg_ms']:.0f} мс)" for route, stats in route_stats[:3]
+        ) or "нажатий не было") + "\n\n"
+
         if next_duty:
             text += f"<b>Следующее дежурство ({next_saturday.strftime('%d.%m.%Y')}):</b>\n"
             if next_duty["is_pair"]:
@@ -1461,6 +3606,21 @@ class DutyBot:
         await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
         context.user_data['awaiting_phone_edit'] = True
 
+    async def admin_edit_rotation(self, query, context):
+        """Изменить состав и порядок круга дежурств (инструкция)"""
+        rotation_list = "\n".join([f"{i}. {emp}" for i, emp in enumerate(DUTY_ROTATION_CIRCLE, 1)])
+        text = (
+            "🔁 <b>КРУГ ДЕЖУРСТВ</b>\n\n"
+            f"<b>Текущий порядок:</b>\n{rotation_list}\n\n"
+            "<i>Для изменения отправьте ФИО сотрудников в новом порядке, каждое с новой строки.</i>\n"
+            "Первый в списке дежурит 30.05.2026, дальше по кругу.\n\n"
+            "<b>Пример:</b>\n<code>Осипов Р.Э\nДенисова Е.С.\nКаримов Т.Р.</code>\n\n"
+            "<i>Отправьте список или нажмите 'Отмена':</i>"
+        )
+        keyboard = [[InlineKeyboardButton("❌ Отмена", callback_data="admin_employees")]]
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
+        context.user_data['awaiting_rotation_edit'] = True
+
     async def admin_list_employees(self, query, context=None):
         """Показать список сотрудников"""
         employees_text = ""
@@ -1502,11 +3662,11 @@ class DutyBot:
 
     async def admin_delete_protocol(self, query, context=None):
         """Удалить протокол"""
-        if os.path.exists(self.protocol_file_path):
+        if self.protocol_store.current_hash is not None:
             try:
-                os.remove(self.protocol_file_path)
+                self.protocol_store.deactivate()
                 self.protocol_attached_file_id = None
-                text = "🗑 <b>ФАЙЛ ПРОТОКОЛА УДАЛЕН</b>\n\nФайл протокола был успешно удален.\n\n<i>Пользователи больше не смогут скачать протокол.</i>"
+                text = "🗑 <b>ФАЙЛ ПРОТОКОЛА УДАЛЕН</b>\n\nФайл протокола был успешно удален.\n\n<i>Пользователи больше не смогут скачать протокол. Вернуть его можно откатом версии.</i>"
             except Exception as e:
                 text = f"❌ <b>ОШИБКА УДАЛЕНИЯ:</b> {str(e)}"
         else:
@@ -1516,26 +3676,29 @@ class DutyBot:
             [InlineKeyboardButton("🔙 Назад", callback_data="admin_files")],
             [InlineKeyboardButton("📄 Проверить файл", callback_data="admin_check_protocol")]
         ]
-        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
 
     async def admin_check_protocol(self, query, context=None):
         """Проверить наличие файла протокола"""
-        protocol_exists = os.path.exists(self.protocol_file_path)
-        if protocol_exists:
-            file_size = os.path.getsize(self.protocol_file_path)
-            file_size_mb = file_size / (1024 * 1024)
+        # Размер и хэш берутся из манифеста хранилища, файл не перечитывается
+        version = self.protocol_store.current()
+        if version:
+            file_size_mb = version["size"] / (1024 * 1024)
+            uploaded_at = datetime.fromisoformat(version["uploaded_at"]).strftime('%d.%m.%Y %H:%M')
             text = (
                 "✅ <b>ФАЙЛ ПРОТОКОЛА НАЙДЕН</b>\n\n"
-                f"📄 <b>Имя файла:</b> {os.path.basename(self.protocol_file_path)}\n"
+                f"📄 <b>Имя файла:</b> {version['name']}\n"
                 f"📁 <b>Размер:</b> {file_size_mb:.2f} МБ\n"
-                f"📍 <b>Путь:</b> {self.protocol_file_path}\n"
+                f"🔑 <b>SHA-256:</b> <code>{version['hash'][:16]}</code>\n"
+                f"🕒 <b>Загружен:</b> {uploaded_at}\n"
+                f"🗂 <b>Версий в истории:</b> {len(self.protocol_store.versions)}\n"
                 f"📎 <b>Прикреплен:</b> {'Да' if self.protocol_attached_file_id else 'Нет'}\n\n"
                 "<i>Файл доступен для скачивания пользователями.</i>"
             )
         else:
             text = (
                 "❌ <b>ФАЙЛ ПРОТОКОЛА НЕ НАЙДЕН</b>\n\n"
-                f"<i>Путь:</i> {self.protocol_file_path}\n\n"
+                f"<i>Версий в истории:</i> {len(self.protocol_store.versions)}\n\n"
                 "<b>Что делать:</b>\n1. Загрузите файл протокола\n2. Используйте кнопку 'Загрузить протокол'"
             )
 
@@ -1543,11 +3706,33 @@ class DutyBot:
             [InlineKeyboardButton("🔙 Назад", callback_data="admin_files")],
             [InlineKeyboardButton("📤 Загрузить протокол", callback_data="admin_upload_protocol")]
         ]
+        if self.protocol_store.rollback_available():
+            keyboard.append([InlineKeyboardButton("↩️ Откатить версию", callback_data="admin_rollback_protocol")])
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
+
+    async def admin_rollback_protocol(self, query, context=None):
+        """Вернуть предыдущую версию протокола"""
+        version = self.protocol_store.rollback()
+        if version:
+            uploaded_at = datetime.fromisoformat(version["uploaded_at"]).strftime('%d.%m.%Y %H:%M')
+            text = (
+                "↩️ <b>ВЕРСИЯ ПРОТОКОЛА ВОССТАНОВЛЕНА</b>\n\n"
+                f"📄 <b>Имя файла:</b> {version['name']}\n"
+                f"🕒 <b>Загружен:</b> {uploaded_at}\n"
+                f"🔑 <b>SHA-256:</b> <code>{version['hash'][:16]}</code>"
+            )
+        else:
+            text = "ℹ️ <b>НЕТ ПРЕДЫДУЩЕЙ ВЕРСИИ</b>\n\nВ истории нет более старых версий протокола."
+
+        keyboard = [
+            [InlineKeyboardButton("🔙 Назад", callback_data="admin_files")],
+            [InlineKeyboardButton("📄 Проверить файл", callback_data="admin_check_protocol")]
+        ]
         await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
 
     async def admin_pin_protocol(self, query, context=None):
         """Прикрепить протокол в закрепленное сообщение"""
-        if not os.path.exists(self.protocol_file_path):
+        if self.protocol_store.current() is None:
             text = "❌ <b>ФАЙЛ НЕ НАЙДЕН</b>\n\nСначала загрузите файл протокола.\nИспользуйте кнопку 'Загрузить протокол'."
             keyboard = [
                 [InlineKeyboardButton("📤 Загрузить протокол", callback_data="admin_upload_protocol")],
@@ -1667,10 +3852,9 @@ class DutyBot:
                     success = self.schedule_generator.add_employee(employee_name, phone)
 
                     if success:
+                        self.invalidate_employee_keyboards()
                         if telegram_username:
-                            if not telegram_username.startswith('@'):
-                                telegram_username = '@' + telegram_username
-                            TELEGRAM_TO_EMPLOYEE[telegram_username.lower()] = employee_name
+                            telegram_username = self.schedule_generator.link_telegram(telegram_username, employee_name)
 
                         await update.message.reply_text(
                             f"✅ <b>СОТРУДНИК ДОБАВЛЕН</b>\n\n👤 ФИО: {employee_name}\n📞 Телефон: {phone}\n📱 Telegram: {telegram_username if telegram_username else 'не указан'}\n\n<i>Сотрудник добавлен в систему.</i>",
@@ -1695,11 +3879,8 @@ class DutyBot:
             success = self.schedule_generator.remove_employee(employee_name)
 
             if success:
-                telegram_usernames = []
-                for tg_user, emp_name in list(TELEGRAM_TO_EMPLOYEE.items()):
-                    if emp_name == employee_name:
-                        telegram_usernames.append(tg_user)
-                        del TELEGRAM_TO_EMPLOYEE[tg_user]
+                self.invalidate_employee_keyboards()
+                telegram_usernames = self.schedule_generator.unlink_telegram(employee_name)
 
                 telegram_info = f"\n📱 Telegram: {', '.join(telegram_usernames)}" if telegram_usernames else ""
 
@@ -1741,6 +3922,29 @@ class DutyBot:
                                                 parse_mode=ParseMode.HTML)
             context.user_data.pop('awaiting_phone_edit', None)
 
+        elif context.user_data.get('awaiting_rotation_edit'):
+            members = [line.strip() for line in message_text.splitlines() if line.strip()]
+            unknown = [name for name in members if name not in EMPLOYEE_PHONES]
+
+            if not members:
+                await update.message.reply_text(
+                    "❌ <b>ПУСТОЙ СПИСОК</b>\n\nОтправьте ФИО сотрудников, каждое с новой строки.",
+                    parse_mode=ParseMode.HTML)
+            elif unknown:
+                unknown_list = "\n".join(unknown)
+                await update.message.reply_text(
+                    f"❌ <b>СОТРУДНИКИ НЕ НАЙДЕНЫ</b>\n\n{unknown_list}\n\n"
+                    "Проверьте правильность ФИО, круг не изменен.",
+                    parse_mode=ParseMode.HTML)
+            else:
+                self.schedule_generator.set_rotation(members)
+                await update.message.reply_text(
+                    f"✅ <b>КРУГ ДЕЖУРСТВ ОБНОВЛЕН</b>\n\n👥 Сотрудников в круге: {len(members)}\n\n"
+                    "<i>Автоматический график пересчитан, ручные правки сохранены.</i>",
+                    reply_markup=self.get_employees_admin_keyboard(),
+                    parse_mode=ParseMode.HTML)
+            context.user_data.pop('awaiting_rotation_edit', None)
+
         # Обработка загрузки файлов
         elif update.message and update.message.document:
             document = update.message.document
@@ -1750,9 +3954,21 @@ class DutyBot:
                 if document.file_name.endswith('.docx'):
                     try:
                         file = await document.get_file()
-                        await file.download_to_drive(self.protocol_file_path)
+                        # Файл сразу пишется во временный файл хранилища, хэш считается по нему кусками.
+                        # С облачным Bot API библиотека все равно получает ответ целиком, с локальным
+                        # сервером в режиме --local (TELEGRAM_BASE_URL) файл просто копируется с диска
+                        tmp_path = self.protocol_store.upload_path()
+                        try:
+                            await file.download_to_drive(tmp_path)
+                            version, duplicate, dropped = self.protocol_store.commit_file(tmp_path, document.file_name)
+                        except Exception:
+                            self.protocol_store.discard(tmp_path)
+                            raise
+                        for content_hash in dropped:
+                            self.file_ids.forget(content_hash)
+                        note = "Такой файл уже был в хранилище и снова стал текущим." if duplicate else "Файл успешно сохранен и доступен для скачивания."
                         await update.message.reply_text(
-                            f"✅ <b>ФАЙЛ ПРОТОКОЛА ЗАГРУЖЕН</b>\n\n📄 Имя файла: {document.file_name}\n📁 Размер: {document.file_size / 1024:.1f} КБ\n\n<i>Файл успешно сохранен и доступен для скачивания.</i>",
+                            f"✅ <b>ФАЙЛ ПРОТОКОЛА ЗАГРУЖЕН</b>\n\n📄 Имя файла: {document.file_name}\n📁 Размер: {version['size'] / 1024:.1f} КБ\n\n<i>{note}</i>",
                             parse_mode=ParseMode.HTML
                         )
                     except Exception as e:
@@ -1817,6 +4033,21 @@ class DutyBot:
         await self.send_saturday_notification_all()
         await update.message.reply_text("✅ Тестовое субботнее уведомление отправлено!")
 
+    async def preview_notifications(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Показать админу уведомления этой недели ровно в том виде, в котором они уйдут"""
+        user_id = str(update.effective_user.id)
+        if not self.is_admin(user_id): return
+        plan = self.notification_planner.get_week_plan()
+        await update.message.reply_text(
+            f"👁 <b>УВЕДОМЛЕНИЯ НА НЕДЕЛЮ</b>\n\n📅 Суббота: {plan['saturday'].strftime('%d.%m.%Y')}\n"
+            f"🔢 Версия графика: {plan['version']}",
+            parse_mode=ParseMode.HTML
+        )
+        for kind, title in (("среда", "Среда 18:00"), ("пятница", "Пятница 18:00"), ("суббота", "Суббота 10:00")):
+            for variant, message in plan["variants"][kind].items():
+                audience = f"лично {variant}" if variant else "всем"
+                await update.message.reply_text(f"<b>▸ {title} ({audience}):</b>\n\n{message}", parse_mode=ParseMode.HTML)
+
     async def test_notification_for_user(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = str(update.effective_user.id)
         if not self.is_admin(user_id): return
@@ -1835,37 +4066,181 @@ class DutyBot:
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка отправки: {str(e)}")
 
-    def run(self):
-        """Запуск бота"""
-        self.application = ApplicationBuilder().token(self.token).build()
-        self.bot_instance = self.application.bot
+    def register_handlers(self, application):
+        """Регистрация обработчиков команд, кнопок и сообщений"""
+        if UPDATE_CAPTURE_FILE:
+            # Группа -1 выполняется раньше обработчиков и не мешает им
+            self.update_recorder = UpdateRecorder(UPDATE_CAPTURE_FILE)
+            application.add_handler(TypeHandler(Update, self.update_recorder.record), group=-1)
+
+        timed = self._timed_handler
+        application.add_handler(CommandHandler("start", timed(self.start)))
+        application.add_handler(CommandHandler("admin", timed(self.admin_login)))
+        application.add_handler(CommandHandler("test_wednesday", timed(self.send_test_wednesday)))
+        application.add_handler(CommandHandler("test_friday", timed(self.send_test_friday)))
+        application.add_handler(CommandHandler("test_saturday", timed(self.send_test_saturday)))
+        application.add_handler(CommandHandler("test_user", timed(self.test_notification_for_user)))
+        application.add_handler(CommandHandler("preview", timed(self.preview_notifications)))
+
+        application.add_handler(CommandHandler("users", timed(self.check_users_status)))
+        application.add_handler(CommandHandler("enable_all", timed(self.enable_notifications_all)))
+        application.add_handler(CommandHandler("test_send", timed(self.test_send_to_user)))
+        application.add_handler(CommandHandler("time", timed(self.check_time)))
+        application.add_handler(CommandHandler("fix", timed(self.fix_all_users)))
+        application.add_handler(CommandHandler("perf", timed(self.perf_command)))
+
+        application.add_handler(CallbackQueryHandler(timed(self.button_handler)))
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed(self.message_handler)))
+        application.add_handler(MessageHandler(filters.Document.ALL, timed(self.message_handler)))
+
+    @staticmethod
+    def _timed_handler(callback):
+        """Обработчик с замером времени в гистограмму dutybot_handler_seconds"""
+        labels = (callback.__name__,)
+
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                HANDLER_LATENCY.observe(labels, time.perf_counter() - started)
+        return wrapper
+
+    def _collect_metrics(self) -> List[tuple]:
+        """Метрики из состояния бота, считываются только при запросе /metrics"""
+        generator = self.schedule_generator
+        caches = {
+            "dynamic_schedule": (generator.cache_stats["hits"], generator.cache_stats["misses"]),
+            "render": (generator.render_cache.hits, generator.render_cache.misses),
+            "notification_plan": (self.notification_planner.stats["hits"], self.notification_planner.stats["renders"]),
+            "duty_protocol": (self.protocol_renderer.stats["hits"], self.protocol_renderer.stats["renders"])
+        }
+        requests, ratios = [], []
+        for cache, (hits, misses) in caches.items():
+            requests.append(({"cache": cache, "result": "hit"}, hits))
+            requests.append(({"cache": cache, "result": "miss"}, misses))
+            ratios.append(({"cache": cache}, hits / (hits + misses) if hits + misses else 0.0))
+        writer_stats = self.user_writer.get_stats()
+        return [
+            ("dutybot_cache_requests_total", "counter", "Обращения к кэшам", requests),
+            ("dutybot_cache_hit_ratio", "gauge", "Доля попаданий в кэш", ratios),
+            ("dutybot_users", "gauge", "Пользователей в базе", [({}, len(self.user_data))]),
+            ("dutybot_user_writes_pending", "gauge", "Несохраненных изменений пользователей",
+             [({}, writer_stats["pending"])]),
+            ("dutybot_schedule_version", "gauge", "Версия графика", [({}, generator.version)])
+        ]
+
+    async def handle_metrics(self, headers: Dict[str, str], body: bytes) -> tuple:
+        return 200, "text/plain; version=0.0.4; charset=utf-8", METRICS.render().encode('utf-8')
 
-        self.application.add_handler(CommandHandler("start", self.start))
-        self.application.add_handler(CommandHandler("admin", self.admin_login))
-        self.application.add_handler(CommandHandler("test_wednesday", self.send_test_wednesday))
-        self.application.add_handler(CommandHandler("test_friday", self.send_test_friday))
-        self.application.add_handler(CommandHandler("test_saturday", self.send_test_saturday))
-        self.application.add_handler(CommandHandler("test_user", self.test_notification_for_user))
+    async def start_metrics_server(self):
+        """Страница /metrics на отдельном локальном порту"""
+        if not METRICS_PORT:
+            return
+        self.metrics_server = HttpServer(METRICS_LISTEN, METRICS_PORT)
+        self.metrics_server.route("GET", "/metrics", self.handle_metrics)
+        try:
+            await self.metrics_server.start()
+        except OSError as e:
+            logger.error(f"Не удалось запустить страницу метрик на {METRICS_LISTEN}:{METRICS_PORT}: {e}")
+            self.metrics_server = None
+
+    async def stop_metrics_server(self, application=None):
+        """Остановить страницу /metrics; в режиме polling вызывается приложением как post_shutdown"""
+        if self.metrics_server:
+            server, self.metrics_server = self.metrics_server, None
+            await server.stop()
+
+    def build_application(self):
+        builder = ApplicationBuilder().token(self.token)
+        builder = builder.request(InstrumentedRequest(HTTPXRequest(connection_pool_size=256)))
+        if TELEGRAM_BASE_URL:
+            builder = builder.base_url(TELEGRAM_BASE_URL)
+        # run_polling сам закрывает event loop - сервер метрик останавливается внутри него
+        builder = builder.post_shutdown(self.stop_metrics_server)
+        self.application = builder.build()
+        self.bot_instance = self.application.bot
+        self.register_handlers(self.application)
+        return self.application
+
+    async def handle_webhook(self, headers: Dict[str, str], body: bytes) -> tuple:
+        """Прием обновления от Telegram: проверка секрета и передача в очередь приложения"""
+        token = headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token.encode(), self.webhook_secret.encode()):
+            logger.warning("Вебхук: запрос с неверным секретом отклонен")
+            return 403, "text/plain", b""
+        try:
+            update = Update.de_json(json.loads(body), self.bot_instance)
+        except Exception as e:
+            logger.error(f"Вебхук: некорректное обновление: {e}")
+            return 400, "text/plain", b""
+        await self.application.update_queue.put(update)
+        return 200, "text/plain", b""
+
+    async def run_webhook(self):
+        """Работа через вебхук: свой HTTP-сервер, корректный запуск и остановка по сигналу"""
+        self.webhook_secret = WEBHOOK_SECRET or uuid.uuid4().hex
+        server = self.webhook_server = HttpServer(WEBHOOK_LISTEN, WEBHOOK_PORT)
+        server.route("POST", WEBHOOK_PATH, self.handle_webhook)
+
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError:
+                pass
 
-        self.application.add_handler(CommandHandler("users", self.check_users_status))
-        self.application.add_handler(CommandHandler("enable_all", self.enable_notifications_all))
-        self.application.add_handler(CommandHandler("test_send", self.test_send_to_user))
-        self.application.add_handler(CommandHandler("time", self.check_time))
-        self.application.add_handler(CommandHandler("fix", self.fix_all_users))
+        async with self.application:
+            await self.application.start()
+            await server.start()
+            await self.start_metrics_server()
+            try:
+                await self.bot_instance.set_webhook(
+                    url=WEBHOOK_URL,
+                    secret_token=self.webhook_secret,
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=True
+                )
+                logger.info(f"Вебхук зарегистрирован: {WEBHOOK_URL}")
+                await self.setup_scheduler()
+                await stop_event.wait()
+            finally:
+                logger.info("Остановка вебхука...")
+                # Сначала перестаем принимать обновления, затем даем приложению обработать принятые
+                await server.stop()
+                await self.stop_metrics_server()
+                if self.scheduler:
+                    self.scheduler.shutdown(wait=False)
+                await self.application.stop()
 
-        self.application.add_handler(CallbackQueryHandler(self.button_handler))
-        self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.message_handler))
-        self.application.add_handler(MessageHandler(filters.Document.ALL, self.message_handler))
+    def run(self):
+        """Запуск бота"""
+        self.build_application()
 
-        logger.info("Бот запущен...")
+        logger.info(f"Бот запущен ({BOT_MODE})...")
 
-        loop = asyncio.get_event_loop()
-        loop.create_task(self.setup_scheduler())
+        try:
+            if BOT_MODE == "webhook":
+                if not WEBHOOK_URL:
+                    raise ValueError("Для режима webhook нужно задать WEBHOOK_URL")
+                asyncio.run(self.run_webhook())
+            else:
+                loop = asyncio.get_event_loop()
+                loop.create_task(self.setup_scheduler())
+                loop.create_task(self.start_metrics_server())
 
-        self.application.run_polling(
-            allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=True
-        )
+                self.application.run_polling(
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=True
+                )
+        finally:
+            flushed = self.user_writer.flush()
+            self.user_store.close()
+            if self.update_recorder:
+                self.update_recorder.close()
+            logger.info(f"Бот остановлен, сохранено отложенных записей: {flushed}")
 
 
 if __name__ == "__main__":
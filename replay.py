@@ -0,0 +1,231 @@
+"""Воспроизведение записанных обновлений через обработчики бота
+
+Обновления записываются самим ботом при заданной переменной окружения UPDATE_CAPTURE_FILE
+(JSON Lines: {"ts": время, "update": объект Update}). Здесь они прогоняются через
+Application.process_update офлайн - Bot API подменяется FakeTelegram из bench.py, состояние
+бота создается во временном каталоге. Отчет в JSON: p50/p95/p99 и ошибки по обработчикам.
+
+    python replay.py updates.jsonl --speed 10 --concurrency 4 --output replay.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench import BOT_TOKEN, FakeTelegram, percentiles  # noqa: E402
+
+
+def load_capture(path: str, restore_admin: bool = True) -> List[Dict]:
+    """Прочитать запись; скрытые логин и пароль /admin подставляются из настроек бота"""
+    import bot as bot_module
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning(f"Строка {line_number}: не JSON, пропущена")
+                continue
+            for field in bot_module.UpdateRecorder.MESSAGE_FIELDS:
+                message = record["update"].get(field)
+                if not (restore_admin and message):
+                    continue
+                # Запись скрывает учетные данные и в тексте, и в подписи к вложению
+                for key in ("text", "caption"):
+                    parts = message.get(key, "").split()
+                    if parts and parts[0].startswith("/admin") and parts[1:] == [bot_module.UpdateRecorder.REDACTED] * 2:
+                        credentials = bot_module.ADMIN_CREDENTIALS
+                        message[key] = f"{parts[0]} {credentials['login']} {credentials['password']}"
+            records.append(record)
+    records.sort(key=lambda record: record.get("ts", 0))
+    return records
+
+
+class Replay:
+    def __init__(self, args):
+        import bot as bot_module
+        self.args = args
+        self.transport = FakeTelegram(args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate, args.seed)
+        self.duty_bot = bot_module.DutyBot(BOT_TOKEN)
+        self.duty_bot.application = (
+            ApplicationBuilder().token(BOT_TOKEN)
+            .request(self.transport)
+            .get_updates_request(FakeTelegram())
+            .build()
+        )
+        self.duty_bot.bot_instance = self.duty_bot.application.bot
+        self.duty_bot.register_handlers(self.duty_bot.application)
+        self.duty_bot.application.add_error_handler(self._on_error)
+
+        self.samples: Dict[str, List[float]] = {}
+        self.route_samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, Dict[str, int]] = {}
+        self._labels: Dict[int, str] = {}
+
+    def handler_name(self, update: Update) -> str:
+        """Имя первого обработчика, который примет обновление (как это сделает Application)"""
+        for group in sorted(self.duty_bot.application.handlers):
+            if group < 0:
+                continue
+            for handler in self.duty_bot.application.handlers[group]:
+                check = handler.check_update(update)
+                if check is not None and check is not False:
+                    return handler.callback.__name__
+        return "unhandled"
+
+    def route_name(self, update: Update) -> Optional[str]:
+        if update.callback_query and update.callback_query.data:
+            resolved = self.duty_bot.callback_router.resolve(update.callback_query.data)
+            return resolved[0] if resolved else "unknown"
+        return None
+
+    async def _on_error(self, update, context):
+        label = self._labels.get(update.update_id, "unhandled") if isinstance(update, Update) else "unhandled"
+        kind = type(context.error).__name__
+        errors = self.errors.setdefault(label, {})
+        errors[kind] = errors.get(kind, 0) + 1
+
+    async def _process(self, update: Update):
+        label = self.handler_name(update)
+        route = self.route_name(update)
+        self._labels[update.update_id] = label
+        started = time.perf_counter()
+        await self.duty_bot.application.process_update(update)
+        elapsed = time.perf_counter() - started
+        self.samples.setdefault(label, []).append(elapsed)
+        if route:
+            self.route_samples.setdefault(route, []).append(elapsed)
+
+    async def run(self, records: List[Dict]) -> Dict:
+        application = self.duty_bot.application
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        tasks = []
+        lag = 0.0
+
+        async def process(update: Update):
+            async with semaphore:
+                await self._process(update)
+
+        async with application:
+            if self.args.grant_admin:
+                for record in records:
+                    user = Update.de_json(record["update"], application.bot).effective_user
+                    if user:
+                        self.duty_bot.admin_sessions[str(user.id)] = {"logged_in": True}
+
+            first_ts = records[0].get("ts", 0) if records else 0
+            started = time.perf_counter()
+            for record in records:
+                if self.args.speed > 0:
+                    due = started + (record.get("ts", first_ts) - first_ts) / self.args.speed
+                    delay = due - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    else:
+                        lag = max(lag, -delay)
+                update = Update.de_json(record["update"], application.bot)
+                if self.args.concurrency > 1:
+                    tasks.append(asyncio.create_task(process(update)))
+                else:
+                    await self._process(update)
+            if tasks:
+                await asyncio.gather(*tasks)
+            wall = time.perf_counter() - started
+
+        self.duty_bot.user_writer.flush()
+        self.duty_bot.user_store.close()
+
+        handlers = {}
+        for label, samples in sorted(self.samples.items()):
+            handlers[label] = dict(percentiles(samples), errors=self.errors.get(label, {}))
+        return {
+            "updates": len(records),
+            "wall_s": round(wall, 3),
+            "updates_per_s": round(len(records) / wall, 1) if wall else None,
+            "max_lag_s": round(lag, 3),
+            "errors": sum(sum(kinds.values()) for kinds in self.errors.values()),
+            "handlers": handlers,
+            "routes": {route: percentiles(samples) for route, samples in sorted(self.route_samples.items())}
+        }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных обновлений бота")
+    parser.add_argument("capture", help="файл, записанный ботом с UPDATE_CAPTURE_FILE")
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="множитель скорости относительно записи (0 - максимально быстро, 1 - как было)")
+    parser.add_argument("--concurrency", type=int, default=1, help="одновременно обрабатываемых обновлений")
+    parser.add_argument("--repeat", type=int, default=1, help="сколько раз прогнать запись")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="задержка каждого вызова Bot API")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="случайная добавка к задержке (0..jitter)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля отправок, завершающихся 403")
+    parser.add_argument("--grant-admin", action="store_true",
+                        help="считать всех пользователей записи вошедшими админами")
+    parser.add_argument("--keep-redacted", action="store_true",
+                        help="не подставлять логин и пароль в скрытые команды /admin")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="файл для JSON (по умолчанию - stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("bot").setLevel(logging.CRITICAL)
+
+    capture = os.path.abspath(args.capture)
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp(prefix="duty-replay-")
+    os.chdir(workdir)
+
+    records = load_capture(capture, restore_admin=not args.keep_redacted)
+    if args.repeat > 1:
+        # Повторные прогоны идут подряд со сдвигом времени и своими update_id
+        span = (records[-1].get("ts", 0) - records[0].get("ts", 0)) if records else 0
+        repeated = []
+        for i in range(args.repeat):
+            for record in records:
+                update = dict(record["update"], update_id=record["update"]["update_id"] + i * 10_000_000)
+                repeated.append({"ts": record.get("ts", 0) + i * (span + 1), "update": update})
+        records = repeated
+
+    replay = Replay(args)
+    results = asyncio.run(replay.run(records))
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "capture": capture,
+            "speed": args.speed,
+            "concurrency": args.concurrency,
+            "repeat": args.repeat,
+            "latency_ms": args.latency_ms,
+            "error_rate": args.error_rate,
+            "api_calls": replay.transport.calls,
+            "workdir": workdir
+        },
+        "results": results
+    }
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
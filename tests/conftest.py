@@ -0,0 +1,30 @@
+import copy
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Бот создает свои файлы в текущем каталоге - каждый тест работает во временном"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture(autouse=True)
+def directories():
+    """Справочники модуля меняются на месте - после теста возвращаем исходные"""
+    saved = [(target, copy.deepcopy(target))
+             for target in (bot.EMPLOYEE_PHONES, bot.TELEGRAM_TO_EMPLOYEE, bot.DUTY_ROTATION_CIRCLE)]
+    yield
+    for target, original in saved:
+        if isinstance(target, dict):
+            target.clear()
+            target.update(original)
+        else:
+            target[:] = original
@@ -0,0 +1,206 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+import bot
+
+
+class ScriptedBot:
+    """Отправка по сценарию: chat_id -> список ошибок для очередных попыток, потом успех"""
+
+    def __init__(self, script=None):
+        self.script = {chat_id: list(errors) for chat_id, errors in (script or {}).items()}
+        self.calls = []
+        self.delivered = []
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        self.calls.append(chat_id)
+        errors = self.script.get(chat_id)
+        if errors:
+            error = errors.pop(0)
+            if error is not None:
+                raise error
+        self.delivered.append(chat_id)
+
+
+def make_engine(**kwargs):
+    params = dict(concurrency=4, global_rate=1000, per_chat_interval=0, max_attempts=3,
+                  backoff_base=0.01, backoff_max=0.05)
+    params.update(kwargs)
+    return bot.BroadcastEngine(**params)
+
+
+def broadcast(engine, fake_bot, user_ids, on_checkpoint=None):
+    return asyncio.run(engine.run(fake_bot, {"all": user_ids}, {"all": "text"}, on_checkpoint))
+
+
+def test_token_bucket_limits_rate():
+    async def scenario():
+        bucket = bot.TokenBucket(50, capacity=1)
+        started = time.monotonic()
+        for _ in range(6):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) >= 5 / 50 * 0.9
+
+
+def test_token_bucket_pause_blocks_tokens():
+    async def scenario():
+        bucket = bot.TokenBucket(1000)
+        bucket.pause(0.1)
+        started = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) >= 0.09
+
+
+@pytest.mark.parametrize("error", [
+    Forbidden("Forbidden: bot was blocked by the user"),
+    BadRequest("Chat not found"),
+    BadRequest("Bad Request: user not found"),
+    BadRequest("Bad Request: PEER_ID_INVALID"),
+    BadRequest("Forbidden: user is deactivated"),
+])
+def test_unreachable_chat_is_deactivated(error):
+    fake_bot = ScriptedBot({1: [error]})
+    stats = broadcast(make_engine(), fake_bot, ["1", "2"])
+
+    assert stats["sent"] == 1
+    assert stats["failed"] == 1
+    assert stats["deactivated"] == ["1"]
+    assert stats["retried"] == 0
+    assert stats["errors"] == {type(error).__name__: 1}
+
+
+@pytest.mark.parametrize("error", [
+    BadRequest("Can't parse entities: unsupported start tag"),
+    BadRequest("Message is too long"),
+    BadRequest("Bad Request: something unexpected"),
+])
+def test_other_bad_request_is_plain_failure(error):
+    fake_bot = ScriptedBot({1: [error]})
+    stats = broadcast(make_engine(), fake_bot, ["1"])
+
+    assert stats["failed"] == 1
+    assert stats["deactivated"] == []
+    assert stats["retried"] == 0
+    assert fake_bot.calls == [1]
+
+
+def test_network_error_is_retried_with_backoff():
+    fake_bot = ScriptedBot({1: [TimedOut(), NetworkError("connection reset")]})
+    stats = broadcast(make_engine(), fake_bot, ["1"])
+
+    assert stats["sent"] == 1
+    assert stats["retried"] == 2
+    assert stats["errors"] == {"TimedOut": 1, "NetworkError": 1}
+    assert fake_bot.calls == [1, 1, 1]
+
+
+def test_retries_stop_after_max_attempts():
+    fake_bot = ScriptedBot({1: [TimedOut()] * 5})
+    stats = broadcast(make_engine(max_attempts=3), fake_bot, ["1"])
+
+    assert stats["sent"] == 0
+    assert stats["failed"] == 1
+    assert stats["retried"] == 2
+    assert stats["deactivated"] == []
+    assert len(fake_bot.calls) == 3
+
+
+def test_retry_after_pauses_and_requeues():
+    fake_bot = ScriptedBot({1: [RetryAfter(0)]})
+    stats = broadcast(make_engine(), fake_bot, ["1", "2"])
+
+    assert sorted(fake_bot.delivered) == [1, 2]
+    assert stats["retried"] == 1
+    assert stats["errors"] == {"RetryAfter": 1}
+
+
+def test_retry_after_does_not_use_up_attempts():
+    fake_bot = ScriptedBot({1: [RetryAfter(0)] * 5 + [TimedOut()]})
+    stats = broadcast(make_engine(max_attempts=3), fake_bot, ["1"])
+
+    assert fake_bot.delivered == [1]
+    assert stats["sent"] == 1
+    assert stats["failed"] == 0
+    assert stats["retried"] == 6
+    assert stats["errors"] == {"RetryAfter": 5, "TimedOut": 1}
+
+
+def test_backoff_does_not_block_worker():
+    fake_bot = ScriptedBot({1: [TimedOut()]})
+    engine = make_engine(concurrency=1, backoff_base=0.2, backoff_max=0.2)
+    stats = broadcast(engine, fake_bot, ["1", "2", "3"])
+
+    assert stats["sent"] == 3
+    # Пока первый получатель ждет повтора, единственный воркер успевает обслужить остальных
+    assert fake_bot.calls == [1, 2, 3, 1]
+
+
+def test_per_chat_interval_does_not_block_worker():
+    async def scenario():
+        fake_bot = ScriptedBot()
+        engine = make_engine(concurrency=1, per_chat_interval=0.2)
+        await engine.run(fake_bot, {"first": ["1"], "rest": ["1", "2", "3"]},
+                         {"first": "a", "rest": "b"})
+        return fake_bot.calls
+
+    # Второе сообщение в чат 1 ждет своего слота, а единственный воркер тем временем обслуживает других
+    assert asyncio.run(scenario()) == [1, 2, 3, 1]
+
+
+def test_checkpoints_cover_every_recipient():
+    batches = []
+    fake_bot = ScriptedBot({2: [Forbidden("blocked")], 3: [TimedOut()]})
+    engine = make_engine(checkpoint_every=2)
+    stats = broadcast(engine, fake_bot, [str(i) for i in range(1, 6)],
+                      on_checkpoint=lambda sent, failed: batches.append((list(sent), list(failed))))
+
+    sent = sorted(uid for batch, _ in batches for uid in batch)
+    failed = [uid for _, batch in batches for uid in batch]
+    assert sent == ["1", "3", "4", "5"]
+    assert failed == ["2"]
+    assert stats["total"] == 5
+
+
+def test_checkpoint_failure_keeps_delivery_and_retries_batch():
+    batches = []
+    calls = {"n": 0}
+
+    def on_checkpoint(sent, failed):
+        calls["n"] += 1
+        if calls["n"] == 1:
+            raise OSError("No space left on device")
+        batches.append((list(sent), list(failed)))
+
+    fake_bot = ScriptedBot()
+    engine = make_engine(concurrency=1, checkpoint_every=2)
+    stats = broadcast(engine, fake_bot, [str(i) for i in range(1, 6)], on_checkpoint)
+
+    # Сбой журнала не делает доставленное ошибкой, а пачка уходит со следующей фиксацией
+    assert stats["sent"] == 5
+    assert stats["failed"] == 0
+    assert stats["errors"] == {}
+    assert fake_bot.calls == [1, 2, 3, 4, 5]
+    assert sorted(uid for batch, _ in batches for uid in batch) == ["1", "2", "3", "4", "5"]
+
+
+def test_dead_worker_aborts_broadcast_instead_of_hanging():
+    engine = make_engine(concurrency=2)
+
+    def broken_record(progress, status, user_id):
+        raise RuntimeError("bookkeeping bug")
+
+    engine._record = broken_record
+
+    async def scenario():
+        return await asyncio.wait_for(
+            engine.run(ScriptedBot(), {"all": ["1", "2", "3"]}, {"all": "text"}), timeout=5)
+
+    with pytest.raises(RuntimeError, match="bookkeeping bug"):
+        asyncio.run(scenario())
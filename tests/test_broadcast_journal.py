@@ -0,0 +1,73 @@
+import asyncio
+import json
+import os
+from datetime import datetime, timedelta
+
+import bot
+from test_broadcast import ScriptedBot, make_engine
+
+
+def write_job(journal, broadcast_id, created_at, groups, batches=()):
+    records = [{"op": "start", "id": broadcast_id, "type": "среда", "messages": {"all": "text"},
+                "created_at": created_at.isoformat(), "groups": groups}]
+    records += [{"op": "batch", "sent": sent, "failed": failed} for sent, failed in batches]
+    with open(journal._path(broadcast_id), 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def test_checkpoints_mark_recipients():
+    journal = bot.BroadcastJournal()
+    broadcast_id = journal.create("среда", {"all": "text"}, {"all": ["1", "2", "3"]})
+    journal.checkpoint(broadcast_id, ["1"], ["2"])
+
+    [job] = journal.load_unfinished()
+    assert job["id"] == broadcast_id
+    assert job["status"] == {"1": bot.BroadcastJournal.SENT, "2": bot.BroadcastJournal.FAILED,
+                             "3": bot.BroadcastJournal.PENDING}
+
+    journal.finish(broadcast_id)
+    assert journal.load_unfinished() == []
+
+
+def test_stale_jobs_are_dropped():
+    journal = bot.BroadcastJournal(max_age_hours=12)
+    now = datetime.now(bot.MOSCOW_TZ)
+    write_job(journal, "old", now - timedelta(hours=13), {"all": ["1"]})
+    write_job(journal, "fresh", now - timedelta(hours=11), {"all": ["2"]})
+
+    assert [job["id"] for job in journal.load_unfinished()] == ["fresh"]
+    assert not os.path.exists(journal._path("old"))
+
+
+def test_torn_tail_is_cut_before_next_checkpoint():
+    journal = bot.BroadcastJournal()
+    broadcast_id = journal.create("среда", {"all": "text"}, {"all": ["1", "2", "3"]})
+    journal.checkpoint(broadcast_id, ["1"], [])
+    with open(journal._path(broadcast_id), 'a', encoding='utf-8') as f:
+        f.write('{"op": "batch", "sent": ["2"')
+
+    [job] = journal.load_unfinished()
+    assert job["status"]["2"] == bot.BroadcastJournal.PENDING
+
+    # Пачка после перезапуска не должна оказаться за битой строкой
+    journal.checkpoint(broadcast_id, ["2"], ["3"])
+    [job] = journal.load_unfinished()
+    assert job["status"] == {"1": bot.BroadcastJournal.SENT, "2": bot.BroadcastJournal.SENT,
+                             "3": bot.BroadcastJournal.FAILED}
+
+
+def test_resume_sends_only_pending_recipients():
+    duty_bot = bot.DutyBot("TEST")
+    duty_bot.broadcaster = make_engine()
+    duty_bot.bot_instance = fake_bot = ScriptedBot()
+    now = datetime.now(bot.MOSCOW_TZ)
+    write_job(duty_bot.broadcast_journal, "interrupted", now - timedelta(hours=1),
+              {"all": ["1", "2", "3", "4"]}, batches=[(["1"], ["2"])])
+    write_job(duty_bot.broadcast_journal, "stale", now - timedelta(hours=13), {"all": ["5"]})
+
+    asyncio.run(duty_bot.resume_broadcasts())
+
+    assert sorted(fake_bot.calls) == [3, 4]
+    assert os.listdir(duty_bot.broadcast_journal.directory) == []
+    duty_bot.user_store.close()
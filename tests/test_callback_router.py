@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+class Recorder:
+    def __init__(self):
+        self.calls = []
+        self.denied = []
+
+    def handler(self, name):
+        async def handle(query, context, *args):
+            self.calls.append((name,) + args)
+        return handle
+
+    async def on_denied(self, query):
+        self.denied.append(query)
+
+
+def make_router(admins=()):
+    recorder = Recorder()
+    router = bot.CallbackRouter(lambda user_id: user_id in admins, recorder.on_denied)
+    router.add("menu", recorder.handler("menu"))
+    router.add("admin_panel", recorder.handler("admin_panel"), admin=True)
+    router.add_prefix("add_", recorder.handler("add"))
+    router.add_prefix("add_e1_", recorder.handler("add_e1"), admin=True)
+    return router, recorder
+
+
+def dispatch(router, data, user_id="1"):
+    return asyncio.run(router.dispatch("query", "context", user_id, data))
+
+
+def test_exact_and_longest_prefix_routes():
+    router, recorder = make_router(admins={"1"})
+
+    assert dispatch(router, "menu")
+    assert dispatch(router, "add_e1_0a")
+    assert dispatch(router, "add_type_single")
+
+    assert recorder.calls == [("menu",), ("add_e1", "0a"), ("add", "type_single")]
+    assert router.resolve("add_e1_")[3] == ("",)
+
+
+def test_unknown_data_is_not_dispatched():
+    router, recorder = make_router()
+
+    assert not dispatch(router, "unknown")
+    assert recorder.calls == []
+    assert router.get_stats() == {}
+
+
+def test_admin_routes_require_session():
+    router, recorder = make_router(admins={"1"})
+
+    assert dispatch(router, "admin_panel", user_id="2")
+    assert dispatch(router, "add_e1_0", user_id="2")
+    assert recorder.calls == []
+    assert len(recorder.denied) == 2
+
+    dispatch(router, "admin_panel", user_id="1")
+    stats = router.get_stats()
+    assert stats["admin_panel"]["calls"] == 1
+    assert stats["admin_panel"]["denied"] == 1
+    assert stats["add_e1_*"]["calls"] == 0
+    assert stats["add_e1_*"]["denied"] == 1
+
+
+def test_handler_errors_still_counted():
+    router = bot.CallbackRouter(lambda user_id: True, None)
+
+    async def broken(query, context):
+        raise RuntimeError("boom")
+
+    router.add("broken", broken)
+    with pytest.raises(RuntimeError):
+        dispatch(router, "broken")
+    assert router.get_stats()["broken"]["calls"] == 1
+
+
+def test_every_bot_button_has_a_route():
+    duty_bot = bot.DutyBot("TEST")
+    duty_bot.user_data["1"] = {"username": "user", "notifications": True, "selected_employee": "Каримов Т.Р."}
+    keyboards = [
+        duty_bot.get_main_keyboard("1"),
+        duty_bot.get_admin_keyboard(),
+        duty_bot.get_schedule_admin_keyboard(),
+        duty_bot.get_employees_admin_keyboard(),
+        duty_bot.get_files_admin_keyboard(),
+        duty_bot.get_back_keyboard(),
+    ] + [duty_bot.get_employee_selection_keyboard(prefix) for prefix in ("emp_", "add_e1_", "add_e2_")]
+
+    for keyboard in keyboards:
+        for row in keyboard.inline_keyboard:
+            for button in row:
+                assert duty_bot.callback_router.resolve(button.callback_data), button.callback_data
+    duty_bot.user_store.close()
@@ -0,0 +1,66 @@
+import asyncio
+import json
+
+from telegram import Update
+
+import bot
+import replay
+
+
+def message(text_key: str, text: str) -> dict:
+    return {"message_id": 1, "date": 0, "chat": {"id": 7, "type": "private"},
+            "from": {"id": 7, "is_bot": False, "first_name": "U"}, text_key: text}
+
+
+def record_updates(updates) -> list:
+    recorder = bot.UpdateRecorder("capture.jsonl")
+    for data in updates:
+        asyncio.run(recorder.record(Update.de_json(data, None), None))
+    recorder.close()
+    with open("capture.jsonl", encoding="utf-8") as f:
+        return [json.loads(line)["update"] for line in f]
+
+
+def test_admin_credentials_are_redacted_in_every_message_field():
+    secret = "/admin login s3cret"
+    updates = [
+        {"update_id": 1, "message": message("text", secret)},
+        {"update_id": 2, "edited_message": message("text", secret)},
+        {"update_id": 3, "channel_post": message("caption", secret)},
+        {"update_id": 4, "edited_channel_post": message("text", secret)},
+        {"update_id": 5, "message": message("text", "/start")},
+    ]
+
+    recorded = record_updates(updates)
+
+    assert "s3cret" not in json.dumps(recorded)
+    assert recorded[0]["message"]["text"] == "/admin *** ***"
+    assert recorded[1]["edited_message"]["text"] == "/admin *** ***"
+    assert recorded[2]["channel_post"]["caption"] == "/admin *** ***"
+    assert recorded[3]["edited_channel_post"]["text"] == "/admin *** ***"
+    assert recorded[4]["message"]["text"] == "/start"
+
+
+def test_replay_restores_redacted_credentials():
+    record_updates([{"update_id": 1, "edited_message": message("text", "/admin login s3cret")}])
+    credentials = bot.ADMIN_CREDENTIALS
+
+    restored = replay.load_capture("capture.jsonl")
+    assert restored[0]["update"]["edited_message"]["text"] == (
+        f"/admin {credentials['login']} {credentials['password']}")
+
+    kept = replay.load_capture("capture.jsonl", restore_admin=False)
+    assert kept[0]["update"]["edited_message"]["text"] == "/admin *** ***"
+
+
+def test_replay_restores_credentials_in_caption():
+    record_updates([
+        {"update_id": 1, "channel_post": message("caption", "/admin login s3cret")},
+        {"update_id": 2, "message": message("caption", "подпись /admin *** ***")},
+    ])
+    credentials = bot.ADMIN_CREDENTIALS
+
+    restored = replay.load_capture("capture.jsonl")
+    assert restored[0]["update"]["channel_post"]["caption"] == (
+        f"/admin {credentials['login']} {credentials['password']}")
+    assert restored[1]["update"]["message"]["caption"] == "подпись /admin *** ***"
@@ -0,0 +1,250 @@
+import asyncio
+import hashlib
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import BadRequest, TimedOut
+
+import bot
+
+DOCUMENT_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?><w:document xmlns:w="w"><w:body>'
+    '<w:p><w:r><w:t>{body}</w:t></w:r></w:p></w:body></w:document>'
+)
+
+
+TEMPLATE_BODY = "Протокол {{ДАТА}}: {{ДЕЖУРНЫЕ}}, {{ТЕЛЕФОНЫ}}"
+
+
+def make_docx(path: str, body: str = TEMPLATE_BODY) -> str:
+    with zipfile.ZipFile(path, "w") as docx:
+        docx.writestr("[Content_Types].xml", "<Types/>")
+        docx.writestr("word/document.xml", DOCUMENT_XML.format(body=body))
+    return path
+
+
+def read_document(path: str) -> str:
+    with zipfile.ZipFile(path) as docx:
+        return docx.read("word/document.xml").decode("utf-8")
+
+
+def make_duty(weeks: int, names=("Каримов Т.Р.",)) -> dict:
+    return {"employees": list(names), "phones": ["8-900"] * len(names), "is_pair": len(names) > 1,
+            "date_obj": datetime(2026, 5, 30) + timedelta(weeks=weeks)}
+
+
+def make_renderer(template_body: str = TEMPLATE_BODY, max_files: int = 64):
+    store = bot.DocumentStore()
+    version, _, _ = store.import_file(make_docx("template.docx", template_body), "template.docx")
+    return bot.ProtocolRenderer(store, max_files=max_files), version["hash"]
+
+
+def test_render_fills_placeholders_and_caches():
+    renderer, template_hash = make_renderer()
+    duty = make_duty(0, ("Каримов Т.Р.", "Денисова Е.С."))
+
+    path, dropped = renderer.render(template_hash, duty)
+    assert dropped == []
+    assert "Протокол 30.05.2026г.: Каримов Т.Р., Денисова Е.С., 8-900, 8-900" in read_document(path)
+
+    assert renderer.render(template_hash, duty) == (path, [])
+    assert renderer.stats == {"renders": 1, "hits": 1}
+
+
+def test_render_without_placeholders_adds_heading():
+    renderer, template_hash = make_renderer("Текст без меток")
+
+    path, _ = renderer.render(template_hash, make_duty(1))
+    xml = read_document(path)
+    assert "Дата дежурства: 06.06.2026г.  Дежурные: Каримов Т.Р." in xml
+    assert "Текст без меток" in xml
+
+
+def test_prune_reports_dropped_keys():
+    renderer, template_hash = make_renderer(max_files=2)
+    first_path, _ = renderer.render(template_hash, make_duty(0))
+    second_path, _ = renderer.render(template_hash, make_duty(1))
+    os.utime(first_path, (1, 1))
+    os.utime(second_path, (2, 2))
+
+    _, dropped = renderer.render(template_hash, make_duty(2))
+    assert dropped == [bot.ProtocolRenderer.cache_key(template_hash, make_duty(0))]
+    assert not os.path.exists(first_path)
+    assert os.path.exists(second_path)
+
+
+def test_prune_evicts_least_recently_requested():
+    renderer, template_hash = make_renderer(max_files=2)
+    first_path, _ = renderer.render(template_hash, make_duty(0))
+    second_path, _ = renderer.render(template_hash, make_duty(1))
+    os.utime(first_path, (1, 1))
+    os.utime(second_path, (2, 2))
+
+    # Первый вариант собран раньше, но запрошен позже второго - вытесняется второй
+    assert renderer.render(template_hash, make_duty(0)) == (first_path, [])
+    _, dropped = renderer.render(template_hash, make_duty(2))
+    assert dropped == [bot.ProtocolRenderer.cache_key(template_hash, make_duty(1))]
+    assert os.path.exists(first_path)
+
+    # Отправка по file_id тоже считается обращением
+    third_key = bot.ProtocolRenderer.cache_key(template_hash, make_duty(2))
+    os.utime(first_path, (3, 3))
+    os.utime(os.path.join(renderer.directory, f"{third_key}.docx"), (4, 4))
+    renderer.touch(bot.ProtocolRenderer.cache_key(template_hash, make_duty(0)))
+    _, dropped = renderer.render(template_hash, make_duty(3))
+    assert dropped == [third_key]
+
+
+def test_concurrent_renders_of_same_duty():
+    renderer, template_hash = make_renderer()
+    duty = make_duty(5)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda _: renderer.render(template_hash, duty)[0], range(16)))
+
+    assert len(set(results)) == 1
+    assert "Каримов Т.Р." in read_document(results[0])
+    assert [n for n in os.listdir(renderer.directory) if n.endswith(".tmp")] == []
+
+
+class DocumentMessage:
+    """Сообщение, на которое бот отвечает документом; ответ по file_id может завершиться ошибкой"""
+
+    def __init__(self, file_id_error=None):
+        self.file_id_error = file_id_error
+        self.sent = []
+
+    async def reply_document(self, document, caption=None, parse_mode=None, filename=None):
+        if isinstance(document, str):
+            self.sent.append(("file_id", document))
+            if self.file_id_error is not None:
+                raise self.file_id_error
+        else:
+            self.sent.append(("upload", filename))
+        return SimpleNamespace(document=SimpleNamespace(file_id=f"id-{len(self.sent)}"))
+
+
+def send_cached(duty_bot, message):
+    async def get_path():
+        return make_docx("send.docx")
+
+    return asyncio.run(duty_bot._reply_document_cached(message, "key", get_path, "Протокол.docx", "Протокол"))
+
+
+def test_document_is_uploaded_once_then_sent_by_file_id():
+    duty_bot = bot.DutyBot("TEST")
+    message = DocumentMessage()
+
+    send_cached(duty_bot, message)
+    send_cached(duty_bot, message)
+
+    assert message.sent == [("upload", "Протокол.docx"), ("file_id", "id-1")]
+    duty_bot.user_store.close()
+
+
+def test_stale_file_id_falls_back_to_upload():
+    duty_bot = bot.DutyBot("TEST")
+    duty_bot.file_ids.put("key", "stale")
+    message = DocumentMessage(BadRequest("Wrong file identifier/http url specified"))
+
+    send_cached(duty_bot, message)
+
+    assert message.sent == [("file_id", "stale"), ("upload", "Протокол.docx")]
+    assert duty_bot.file_ids.get("key") == "id-2"
+    duty_bot.user_store.close()
+
+
+def test_network_error_keeps_file_id():
+    duty_bot = bot.DutyBot("TEST")
+    duty_bot.file_ids.put("key", "valid")
+    message = DocumentMessage(TimedOut())
+
+    with pytest.raises(TimedOut):
+        send_cached(duty_bot, message)
+
+    assert message.sent == [("file_id", "valid")]
+    assert duty_bot.file_ids.get("key") == "valid"
+    duty_bot.user_store.close()
+
+
+def write_file(path: str, content: bytes) -> str:
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+def upload(store: bot.DocumentStore, content: bytes, name: str = "protocol.docx") -> tuple:
+    return store.commit_file(write_file(store.upload_path(), content), name)
+
+
+def test_upload_is_content_addressed_and_deduplicated():
+    store = bot.DocumentStore()
+    version, duplicate, dropped = upload(store, b"first" * 50000)
+
+    assert version["hash"] == hashlib.sha256(b"first" * 50000).hexdigest()
+    assert version["size"] == 250000
+    assert (duplicate, dropped) == (False, [])
+    assert os.path.exists(store.path_for(version["hash"]))
+
+    again, duplicate, _ = upload(store, b"first" * 50000, "renamed.docx")
+    assert duplicate is True
+    assert again["name"] == "renamed.docx"
+    assert len(store.versions) == 1
+    assert [n for n in os.listdir(store.directory) if n.endswith(".tmp")] == []
+
+
+def test_rollback_walks_history_and_survives_restart():
+    store = bot.DocumentStore()
+    first, _, _ = upload(store, b"v1")
+    second, _, _ = upload(store, b"v2")
+    assert store.current() == second
+
+    assert store.rollback() == first
+    assert not store.rollback_available()
+    assert store.rollback() is None
+
+    restored = bot.DocumentStore()
+    assert restored.current()["hash"] == first["hash"]
+    assert [v["hash"] for v in restored.versions] == [second["hash"], first["hash"]]
+
+
+def test_deactivate_then_rollback_restores_latest():
+    store = bot.DocumentStore()
+    upload(store, b"v1")
+    latest, _, _ = upload(store, b"v2")
+
+    assert store.deactivate()
+    assert store.current() is None
+    assert not store.deactivate()
+    assert store.rollback_available()
+    assert store.rollback() == latest
+
+
+def test_old_versions_are_trimmed():
+    store = bot.DocumentStore(keep_versions=2)
+    oldest, _, _ = upload(store, b"v1")
+    upload(store, b"v2")
+    _, _, dropped = upload(store, b"v3")
+
+    assert dropped == [oldest["hash"]]
+    assert not os.path.exists(store.path_for(oldest["hash"]))
+    assert len(store.versions) == 2
+
+
+def test_import_and_discard():
+    store = bot.DocumentStore()
+    source = write_file("legacy.docx", b"legacy")
+    version, _, _ = store.import_file(source, "legacy.docx")
+
+    assert os.path.exists(source)
+    with open(store.path_for(version["hash"]), "rb") as f:
+        assert f.read() == b"legacy"
+
+    tmp_path = write_file(store.upload_path(), b"partial")
+    store.discard(tmp_path)
+    store.discard(tmp_path)
+    assert not os.path.exists(tmp_path)
@@ -0,0 +1,63 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+
+class EditableQuery:
+    def __init__(self, user_id: int = 7):
+        self.from_user = SimpleNamespace(id=user_id, username="user")
+        self.edits = []
+
+    async def edit_message_text(self, text, reply_markup=None, parse_mode=None):
+        self.edits.append((text, reply_markup))
+
+
+def test_registry_assigns_compact_stable_ids():
+    registry = bot.EmployeeRegistry()
+    ids = [registry.assign(f"Сотрудник {i}") for i in range(40)]
+
+    assert ids[:3] == ["0", "1", "2"]
+    assert ids[35:37] == ["z", "10"]
+    assert registry.get_name("10") == "Сотрудник 36"
+
+    restored = bot.EmployeeRegistry()
+    restored.load(registry.as_dict())
+    assert restored.assign("Новый") == "14"
+
+
+def test_ids_fit_callback_data_limit():
+    generator = bot.DutyScheduleGenerator(bot.ScheduleStore())
+    for name in bot.EMPLOYEE_PHONES:
+        data = f"add_e2_{generator.get_employee_id(name)}"
+        assert len(data.encode("utf-8")) <= 64
+        assert generator.get_employee_by_id(generator.get_employee_id(name)) == name
+
+
+def test_unknown_or_removed_employee_is_stale():
+    generator = bot.DutyScheduleGenerator(bot.ScheduleStore())
+    employee_id = generator.get_employee_id("Каримов Т.Р.")
+
+    assert generator.get_employee_by_id("zzz") is None
+    # Кнопки старого формата с ФИО целиком продолжают работать
+    assert generator.get_employee_by_id("Каримов Т.Р.") == "Каримов Т.Р."
+
+    generator.remove_employee("Каримов Т.Р.")
+    assert generator.get_employee_by_id(employee_id) is None
+    assert generator.get_employee_by_id("Каримов Т.Р.") is None
+
+
+def test_stale_button_reopens_menu():
+    duty_bot = bot.DutyBot("TEST")
+    duty_bot.user_data["7"] = {"username": "user", "notifications": True}
+    query = EditableQuery()
+    context = SimpleNamespace(user_data={"new_duty": {"employees": [], "is_pair": False}})
+
+    asyncio.run(duty_bot.select_employee(query, context, "zzz"))
+    asyncio.run(duty_bot.admin_choose_first_employee(query, context, "zzz"))
+
+    assert [text for text, _ in query.edits] == ["⚠️ Кнопка устарела, откройте меню заново"] * 2
+    assert query.edits[1][1] is duty_bot.get_employee_selection_keyboard("add_e1_")
+    assert "selected_employee" not in duty_bot.user_data["7"]
+    assert context.user_data["new_duty"]["employees"] == []
+    duty_bot.user_store.close()
@@ -0,0 +1,66 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+ADMIN_ID = "1"
+
+
+class FakeMessage:
+    def __init__(self, text):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, reply_markup=None, parse_mode=None):
+        self.replies.append(text)
+
+
+def make_admin_bot() -> bot.DutyBot:
+    duty_bot = bot.DutyBot("TEST")
+    duty_bot.user_data[ADMIN_ID] = {"is_admin": True}
+    duty_bot.admin_sessions[ADMIN_ID] = {"logged_in": True}
+    return duty_bot
+
+
+def send_admin_text(duty_bot, text, awaiting):
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=int(ADMIN_ID), username="admin"),
+                             message=FakeMessage(text))
+    context = SimpleNamespace(user_data={awaiting: True})
+    asyncio.run(duty_bot.message_handler(update, context))
+    return update.message.replies
+
+
+def button_texts(markup):
+    return [button.text for row in markup.inline_keyboard for button in row]
+
+
+def test_keyboards_are_built_once():
+    duty_bot = make_admin_bot()
+
+    employees = duty_bot.get_employee_selection_keyboard()
+    assert duty_bot.get_employee_selection_keyboard() is employees
+    assert duty_bot.get_employee_selection_keyboard("add_emp_") is not employees
+    assert duty_bot.get_main_keyboard(ADMIN_ID) is duty_bot.get_main_keyboard(ADMIN_ID)
+    assert duty_bot.get_main_keyboard(ADMIN_ID) is not duty_bot.get_main_keyboard("2")
+    assert duty_bot.get_admin_keyboard() is duty_bot.get_admin_keyboard()
+    duty_bot.user_store.close()
+
+
+def test_employee_keyboards_are_rebuilt_after_admin_edits():
+    duty_bot = make_admin_bot()
+    before = duty_bot.get_employee_selection_keyboard()
+    admin = duty_bot.get_admin_keyboard()
+
+    send_admin_text(duty_bot, "Новый Н.Н.;8-900;@new_user", "awaiting_employee_add")
+    added = duty_bot.get_employee_selection_keyboard()
+    assert added is not before
+    assert "Новый Н.Н." in button_texts(added)
+    assert "Новый Н.Н." not in button_texts(before)
+    # Остальные клавиатуры от списка сотрудников не зависят и остаются в кэше
+    assert duty_bot.get_admin_keyboard() is admin
+
+    send_admin_text(duty_bot, "Новый Н.Н.", "awaiting_employee_remove")
+    removed = duty_bot.get_employee_selection_keyboard()
+    assert removed is not added
+    assert "Новый Н.Н." not in button_texts(removed)
+    duty_bot.user_store.close()
@@ -0,0 +1,91 @@
+import asyncio
+import socket
+
+import pytest
+
+import bot
+from test_webhook import request
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_counter_renders_prometheus_text_with_escaped_labels():
+    registry = bot.MetricsRegistry()
+    counter = registry.counter("test_total", "Тестовый счетчик", ["type", "result"])
+    counter.inc(("среда", "sent"), 3)
+    counter.inc(('a"b\\c\nd', "failed"))
+
+    assert registry.render().splitlines() == [
+        "# HELP test_total Тестовый счетчик",
+        "# TYPE test_total counter",
+        'test_total{type="a\\"b\\\\c\\nd",result="failed"} 1',
+        'test_total{type="среда",result="sent"} 3',
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = bot.MetricsRegistry()
+    histogram = registry.histogram("test_seconds", "Время", ["store"], buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 5.0):
+        histogram.observe(("db",), value)
+
+    assert registry.render().splitlines() == [
+        "# HELP test_seconds Время",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{store="db",le="0.1"} 2',
+        'test_seconds_bucket{store="db",le="1.0"} 3',
+        'test_seconds_bucket{store="db",le="+Inf"} 4',
+        'test_seconds_sum{store="db"} 5.65',
+        'test_seconds_count{store="db"} 4',
+    ]
+
+
+def test_failed_collector_does_not_break_page():
+    registry = bot.MetricsRegistry()
+
+    def broken():
+        raise RuntimeError("нет данных")
+
+    registry.set_collector("broken", broken)
+    registry.set_collector("cache", lambda: [
+        ("test_cache_size", "gauge", "Размер кэша", [({"cache": 'x"y'}, 2), ({}, 5)])])
+
+    assert registry.render().splitlines() == [
+        "# HELP test_cache_size Размер кэша",
+        "# TYPE test_cache_size gauge",
+        'test_cache_size{cache="x\\"y"} 2',
+        "test_cache_size 5",
+    ]
+
+
+def test_metrics_page_is_served_and_stopped_on_shutdown(monkeypatch):
+    monkeypatch.setattr(bot, "METRICS_PORT", free_port())
+    duty_bot = bot.DutyBot("TEST")
+    application = duty_bot.build_application()
+
+    async def scenario():
+        await duty_bot.start_metrics_server()
+        port = duty_bot.metrics_server.port
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: test\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+
+        # Так приложение останавливает сервер в конце run_polling
+        await application.post_shutdown(application)
+        assert duty_bot.metrics_server is None
+        with pytest.raises(OSError):
+            await request(port, b"GET /metrics HTTP/1.1\r\n\r\n")
+        return response
+
+    response = asyncio.run(scenario())
+    head, _, body = response.partition(b"\r\n\r\n")
+    assert head.startswith(b"HTTP/1.1 200 OK")
+    assert b"Content-Type: text/plain; version=0.0.4; charset=utf-8" in head
+    assert b"# TYPE dutybot_broadcast_messages_total counter" in body
+    assert b"dutybot_schedule_version " in body
+    duty_bot.user_store.close()
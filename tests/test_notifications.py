@@ -0,0 +1,118 @@
+from datetime import timedelta
+
+import bot
+from test_schedule import future_saturday, make_generator
+
+
+# Тексты уведомлений до введения NotificationPlanner - планировщик обязан выдавать их без изменений
+def baseline_wednesday(saturday, duty_text, phones_text):
+    return (
+        f"🔔 <b>НАПОМИНАНИЕ О ДЕЖУРСТВЕ В СУББОТУ</b>\n\n"
+        f"📅 <b>Дата:</b> {saturday.strftime('%d.%m.%Y')}\n"
+        f"👤 <b>Дежурит:</b> {duty_text}\n"
+        f"📞 <b>Телефоны:</b> {phones_text}\n\n"
+        f"⏰ <b>Время:</b> 6:50 - 8:00\n"
+        f"📍 <b>Место:</b> кабинет 6002, 6 этаж, АДЦ\n\n"
+        f"📋 <b>Инструкция:</b>\n"
+        f"• В пятницу до 17:00 позвонить в приемную: 5600\n"
+        f"• Прийти в субботу к 6:50 в АДЦ\n"
+        f"• Взять ключ на охране от кубов\n"
+        f"• Сфотографировать открытый кабинет\n"
+        f"• Находиться там до 8:00\n\n"
+        f"<i>Следующее напоминание: пятница в 18:00</i>"
+    )
+
+
+def baseline_friday(tomorrow, duty_text, phones_text):
+    return (
+        f"🔔 <b>НАПОМИНАНИЕ О ЗАВТРАШНЕМ ДЕЖУРСТВЕ</b>\n\n"
+        f"📅 <b>Завтра ({tomorrow.strftime('%d.%m.%Y')}) дежурит:</b>\n"
+        f"👤 {duty_text}\n"
+        f"📞 {phones_text}\n\n"
+        f"⏰ <b>Время:</b> 6:50 - 8:00\n"
+        f"📍 <b>Место:</b> кабинет 6002, 6 этаж, АДЦ\n\n"
+        f"⚠️ <b>ВАЖНО! СЕГОДНЯ ДО 19:00:</b>\n"
+        f"• Дежурным позвонить в приемную: 5600\n"
+        f"• Сообщить о дежурстве\n"
+        f"• Попросить оставить ключи на вахте\n\n"
+        f"📋 <b>План на завтра:</b>\n"
+        f"• Прийти в АДЦ к 6:50\n"
+        f"• Взять ключ на охране от кубов\n"
+        f"• Открыть кабинет 6002\n"
+        f"• Сфотографировать открытый кабинет\n"
+        f"• Находиться там до 8:00\n"
+        f"• Оформить протокол разногласий\n\n"
+        f"<i>Следующее напоминание: суббота в 10:00</i>"
+    )
+
+
+def baseline_saturday(today, duty_text, phones_text):
+    return (
+        f"🔔 <b>ИТОГИ ДЕЖУРСТВА</b>\n\n"
+        f"📅 <b>Сегодня ({today.strftime('%d.%m.%Y')}) дежурили:</b>\n"
+        f"👤 {duty_text}\n"
+        f"📞 {phones_text}\n\n"
+        f"✅ <b>Дежурство завершилось в 8:00</b>\n\n"
+        f"📋 <b>Напоминание дежурным:</b>\n"
+        f"• Не забудьте оформить протокол разногласий\n"
+        f"• Протокол оставить у Е.С. Денисовой\n\n"
+        f"<i>Следующее напоминание: среда в 18:00</i>"
+    )
+
+
+def assert_week_matches_baseline(planner, saturday, duty_text, phones_text):
+    wednesday = saturday - timedelta(days=3, hours=-18)
+    friday = saturday - timedelta(days=1, hours=-18)
+    saturday_morning = saturday + timedelta(hours=10)
+
+    assert planner.get_message("среда", wednesday) == baseline_wednesday(saturday, duty_text, phones_text)
+    assert planner.get_message("пятница", friday) == baseline_friday(saturday, duty_text, phones_text)
+    assert planner.get_message("суббота", saturday_morning) == baseline_saturday(saturday, duty_text, phones_text)
+
+
+def test_rotation_week_texts_match_baseline():
+    generator = make_generator()
+    planner = bot.NotificationPlanner(generator)
+    saturday = future_saturday(2)
+    duty = generator.get_duty(saturday)
+    [employee_name] = duty["employees"]
+
+    assert_week_matches_baseline(planner, saturday, employee_name, bot.EMPLOYEE_PHONES[employee_name])
+
+
+def test_pair_override_texts_match_baseline():
+    generator = make_generator()
+    planner = bot.NotificationPlanner(generator)
+    saturday = future_saturday(2)
+    generator.add_duty(generator.format_date(saturday), ["Первый П.П.", "Второй В.В."], ["8-001", "8-002"], True)
+
+    assert_week_matches_baseline(planner, saturday, "Первый П.П. + Второй В.В.", "8-001 + 8-002")
+
+
+def test_group_recipients_puts_every_user_in_one_variant():
+    generator = make_generator()
+    planner = bot.NotificationPlanner(generator)
+    saturday = future_saturday(2)
+    generator.add_duty(generator.format_date(saturday), ["Первый П.П.", "Второй В.В."], ["8-001", "8-002"], True)
+    variants = planner.get_variants("пятница", saturday - timedelta(days=1))
+    users = {
+        "1": {"selected_employee": "Первый П.П."},
+        "2": {"selected_employee": "Второй В.В."},
+        "3": {"selected_employee": "Третий Т.Т."},
+        "4": {},
+        "5": {"selected_employee": None},
+        "6": {"selected_employee": "Первый П.П."},
+    }
+
+    groups = bot.NotificationPlanner.group_recipients(users, variants)
+
+    assert groups == {"": ["3", "4", "5"], "Первый П.П.": ["1", "6"], "Второй В.В.": ["2"]}
+    assert sorted(uid for user_ids in groups.values() for uid in user_ids) == sorted(users)
+    assert variants["Первый П.П."].startswith("👤 <b>Завтра дежурите вы!</b>\n👥 <b>Ваш напарник:</b> Второй В.В. (8-002)\n\n")
+    assert variants["Первый П.П."].endswith(variants[""])
+
+
+def test_group_recipients_without_personal_variants():
+    users = {"1": {"selected_employee": "Первый П.П."}, "2": {}}
+
+    assert bot.NotificationPlanner.group_recipients(users, {"": "text"}) == {"": ["1", "2"]}
@@ -0,0 +1,68 @@
+import asyncio
+import sqlite3
+
+from apscheduler.triggers.interval import IntervalTrigger
+
+import bot
+
+
+def flush_count(store: str) -> int:
+    series = bot.PERSISTENCE_FLUSH.values.get((store,))
+    return series[2] if series else 0
+
+
+def test_write_behind_coalesces_marks():
+    store = bot.UserStore()
+    writer = bot.UserWriteBehind(store)
+    writer.mark("1", {"username": "a", "notifications": True})
+    writer.mark("1", {"username": "b", "notifications": True})
+    writer.mark("2", {"username": "c", "notifications": False})
+
+    assert writer.flush() == 2
+    assert writer.flush() == 0
+    users = store.load_all()
+    assert users["1"]["username"] == "b"
+    assert users["2"]["notifications"] is False
+    store.close()
+
+
+def test_write_behind_flushes_when_full():
+    store = bot.UserStore()
+    writer = bot.UserWriteBehind(store, max_dirty=3)
+    for i in range(3):
+        writer.mark(str(i), {"username": f"u{i}"})
+
+    assert writer.dirty == {}
+    assert set(store.load_all()) == {"0", "1", "2"}
+    store.close()
+
+
+def test_flush_job_runs_through_scheduler():
+    async def scenario():
+        duty_bot = bot.DutyBot("TEST")
+        await duty_bot.setup_scheduler()
+        duty_bot.scheduler.reschedule_job("flush_user_data", trigger=IntervalTrigger(seconds=0.1))
+        duty_bot.user_data["42"] = {"username": "tester", "notifications": True}
+        duty_bot.save_user_data("42")
+        try:
+            for _ in range(50):
+                await asyncio.sleep(0.05)
+                if duty_bot.user_writer.stats["flushes"]:
+                    break
+        finally:
+            duty_bot.scheduler.shutdown(wait=False)
+        return duty_bot
+
+    before = flush_count("users")
+    duty_bot = asyncio.run(scenario())
+
+    stats = duty_bot.user_writer.get_stats()
+    assert stats["flushes"] == 1
+    assert stats["errors"] == 0
+    assert stats["pending"] == 0
+    assert flush_count("users") == before + 1
+    duty_bot.user_store.close()
+    conn = sqlite3.connect(duty_bot.user_store.db_path)
+    rows = conn.execute("SELECT user_id, username FROM users").fetchall()
+    conn.close()
+    assert rows == [("42", "tester")]
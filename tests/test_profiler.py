@@ -0,0 +1,54 @@
+import time
+import tracemalloc
+
+import bot
+
+
+def busy(seconds: float):
+    deadline = time.monotonic() + seconds
+    data = []
+    while time.monotonic() < deadline:
+        data.append(sum(range(100)))
+    return data
+
+
+def test_profiler_collects_samples_and_stops_its_own_tracing():
+    assert not tracemalloc.is_tracing()
+    profiler = bot.SamplingProfiler(interval=0.001)
+
+    assert profiler.start(10)
+    assert not profiler.start(10)
+    assert tracemalloc.is_tracing()
+    busy(0.1)
+    assert profiler.stop()
+    assert not profiler.stop()
+
+    assert not tracemalloc.is_tracing()
+    assert profiler.samples > 0
+    report = profiler.report(top=5)
+    assert "busy (test_profiler.py" in report
+    assert "Статус: остановлен" in report
+
+
+def test_profiler_keeps_foreign_tracing():
+    tracemalloc.start()
+    try:
+        profiler = bot.SamplingProfiler(interval=0.001)
+        profiler.start(10)
+        busy(0.02)
+        profiler.stop()
+        assert tracemalloc.is_tracing()
+        assert profiler.snapshot is not None
+    finally:
+        tracemalloc.stop()
+
+
+def test_profiler_window_ends_collection():
+    profiler = bot.SamplingProfiler(interval=0.001)
+    profiler.start(0.05)
+    busy(0.1)
+    profiler._thread.join(5)
+
+    assert not profiler.running
+    assert profiler.stopped_at is not None
+    assert not tracemalloc.is_tracing()
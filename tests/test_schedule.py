@@ -0,0 +1,239 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import bot
+
+BASE = bot.DutyScheduleGenerator.BASE_DATE
+
+
+def make_generator() -> bot.DutyScheduleGenerator:
+    return bot.DutyScheduleGenerator(bot.ScheduleStore())
+
+
+def future_saturday(weeks: int = 3) -> datetime:
+    today = datetime.now(bot.MOSCOW_TZ).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    return today + timedelta(days=(5 - today.weekday()) % 7, weeks=weeks)
+
+
+def test_iter_duties_follows_rotation_in_any_direction():
+    generator = make_generator()
+    circle = bot.DUTY_ROTATION_CIRCLE
+
+    duties = list(generator.iter_duties(BASE - timedelta(weeks=2), BASE + timedelta(weeks=2)))
+    assert [d["date_obj"] for d in duties] == [BASE + timedelta(weeks=w) for w in range(-2, 3)]
+    assert [d["employees"][0] for d in duties] == [circle[-2], circle[-1], circle[0], circle[1], circle[2]]
+
+    far = BASE + timedelta(weeks=len(circle) * 40 + 3)
+    assert next(generator.iter_duties(far, far))["employees"] == [circle[3]]
+
+
+def test_iter_duties_starts_from_next_saturday():
+    generator = make_generator()
+    friday = BASE + timedelta(days=6)
+
+    assert [d["date_obj"] for d in generator.iter_duties(friday, friday + timedelta(days=1))] == [
+        BASE + timedelta(weeks=1)]
+
+
+def test_duty_counts_are_even_over_full_cycles():
+    generator = make_generator()
+    cycles = 4
+    end = BASE + timedelta(weeks=len(bot.DUTY_ROTATION_CIRCLE) * cycles - 1)
+
+    counts = generator.duty_counts(BASE, end)
+    assert counts == {name: cycles for name in bot.DUTY_ROTATION_CIRCLE}
+
+
+def test_upcoming_duties_reach_past_displayed_cycle():
+    generator = make_generator()
+    name = bot.DUTY_ROTATION_CIRCLE[0]
+
+    duties = generator.get_upcoming_duties(name, 5)
+    days = [d["date_obj"] for d in duties]
+    assert len(days) == 5
+    assert all((b - a).days == 7 * len(bot.DUTY_ROTATION_CIRCLE) for a, b in zip(days, days[1:]))
+    assert generator.get_next_duty(name) == duties[0]
+
+
+def test_employee_listed_twice_gets_every_rotation_week():
+    generator = make_generator()
+    first, second, third = bot.DUTY_ROTATION_CIRCLE[:3]
+    generator.set_rotation([first, second, first, third])
+
+    start, end = future_saturday(), future_saturday(20)
+    expected = [d["date_obj"] for d in generator.iter_duties(start, end) if first in d["employees"]]
+    assert len(expected) == 9
+    assert [d["date_obj"] for d in generator.iter_employee_duties(first, start, end)] == expected
+
+
+def test_employee_duties_include_overrides():
+    generator = make_generator()
+    name = "Каримов Т.Р."
+    rotation_day = generator.get_next_duty(name)["date_obj"]
+    extra = future_saturday(1)
+    if extra == rotation_day:
+        extra += timedelta(weeks=1)
+    generator.add_duty(generator.format_date(extra), [name, "Денисова Е.С."], ["1", "2"], True)
+    generator.add_duty(generator.format_date(rotation_day), ["Денисова Е.С."], ["2"], False)
+
+    days = [d["date_obj"] for d in generator.get_upcoming_duties(name, 3)]
+    assert extra in days
+    assert rotation_day not in days
+    assert days == sorted(days)
+
+    text = generator.get_employee_duties_text(name)
+    assert generator.format_date(extra) in text
+    assert "(с Денисова Е.С.)" in text
+
+
+def make_duty(day: datetime, name: str = "Каримов Т.Р.") -> dict:
+    return {"employees": [name], "phones": ["1"], "is_pair": False, "date_obj": day}
+
+
+def test_override_store_keeps_days_sorted():
+    store = bot.OverrideStore()
+    days = [BASE + timedelta(weeks=w) for w in (5, 1, 3, 0, 4)]
+    for day in days:
+        assert store.put(make_duty(day)) is None
+
+    assert [d["date_obj"] for d in store.values()] == sorted(days)
+    assert (BASE + timedelta(weeks=3)).toordinal() in store
+    assert len(store) == 5
+
+    replacement = make_duty(BASE + timedelta(weeks=3), "Денисова Е.С.")
+    assert store.put(replacement)["employees"] == ["Каримов Т.Р."]
+    assert store.get((BASE + timedelta(weeks=3)).toordinal()) is replacement
+    assert len(store) == 5
+
+    assert store.pop((BASE + timedelta(weeks=1)).toordinal())["date_obj"] == BASE + timedelta(weeks=1)
+    assert store.pop((BASE + timedelta(weeks=1)).toordinal()) is None
+    assert [d["date_obj"] for d in store.values()] == [BASE + timedelta(weeks=w) for w in (0, 3, 4, 5)]
+
+
+def test_override_store_range_and_prune():
+    store = bot.OverrideStore()
+    for w in range(6):
+        store.put(make_duty(BASE + timedelta(weeks=w)))
+
+    between = store.between((BASE + timedelta(weeks=1)).toordinal(), (BASE + timedelta(weeks=3)).toordinal())
+    assert [d["date_obj"] for d in between] == [BASE + timedelta(weeks=w) for w in (1, 2, 3)]
+    assert list(store.between(BASE.toordinal() - 10, BASE.toordinal() - 1)) == []
+
+    removed = store.prune_before((BASE + timedelta(weeks=2)).toordinal())
+    assert [d["date_obj"] for d in removed] == [BASE, BASE + timedelta(weeks=1)]
+    assert [d["date_obj"] for d in store.values()] == [BASE + timedelta(weeks=w) for w in range(2, 6)]
+
+
+def test_iter_duties_overlays_saturday_overrides_only():
+    generator = make_generator()
+    sat = future_saturday(2)
+    generator.add_duty(generator.format_date(sat), ["Денисова Е.С.", "Каримов Т.Р."], ["1", "2"], True)
+    generator.add_duty(generator.format_date(sat - timedelta(days=1)), ["Каримов Т.Р."], ["2"], False)
+
+    duties = list(generator.iter_duties(sat - timedelta(weeks=1), sat + timedelta(weeks=1)))
+    assert [d["date_obj"] for d in duties] == [sat - timedelta(weeks=1), sat, sat + timedelta(weeks=1)]
+    assert duties[1]["employees"] == ["Денисова Е.С.", "Каримов Т.Р."]
+    assert duties[0] == generator._rotation_duty(sat - timedelta(weeks=1))
+    assert generator.get_duty(sat - timedelta(days=1))["employees"] == ["Каримов Т.Р."]
+
+
+def test_render_cache_evicts_least_recently_used():
+    cache = bot.RenderCache(maxsize=2)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    assert cache.get("a") == "A"
+    cache.put("c", "C")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "A"
+    assert cache.get("c") == "C"
+    assert cache.get_stats() == {"size": 2, "hits": 3, "misses": 1, "hit_rate": 0.75}
+
+
+def test_schedule_text_is_cached_until_edit():
+    generator = make_generator()
+    sat = future_saturday(1)
+    first = generator.get_schedule_text()
+    generator.get_employee_duties_text("Каримов Т.Р.")
+    hits = generator.render_cache.hits
+
+    assert generator.get_schedule_text() == first
+    generator.get_employee_duties_text("Каримов Т.Р.")
+    assert generator.render_cache.hits == hits + 2
+
+    generator.add_duty(generator.format_date(sat), ["Каримов Т.Р."], ["8-000"], False)
+    edited = generator.get_schedule_text()
+    assert edited != first
+    assert generator.format_date(sat) in edited
+    assert "8-000" in edited
+    assert generator.format_date(sat) in generator.get_employee_duties_text("Каримов Т.Р.")
+
+    # Смена телефона тоже меняет версию: круговые дежурства показывают новый номер
+    generator.update_employee_phone("Каримов Т.Р.", "8-111")
+    assert "8-111" in generator.get_employee_duties_text("Каримов Т.Р.")
+    assert generator.render_cache.hits == hits + 2
+
+
+MUTATORS = {
+    "add_duty": lambda g: g.add_duty(g.format_date(future_saturday(1)), ["Каримов Т.Р."], ["8-000"], False),
+    "remove_duty": lambda g: g.remove_duty(g.format_date(future_saturday(2))),
+    "update_phone": lambda g: g.update_employee_phone("Каримов Т.Р.", "8-111"),
+    "add_employee": lambda g: g.add_employee("Новый Н.Н.", "8-222"),
+    "remove_employee": lambda g: g.remove_employee("Каримов Т.Р."),
+    "set_rotation": lambda g: g.set_rotation(list(reversed(bot.DUTY_ROTATION_CIRCLE))),
+    "link_telegram": lambda g: g.link_telegram("new_user", "Каримов Т.Р."),
+    "unlink_telegram": lambda g: g.unlink_telegram("Каримов Т.Р."),
+}
+
+
+@pytest.mark.parametrize("mutate", MUTATORS.values(), ids=MUTATORS.keys())
+def test_every_mutator_invalidates_cached_texts(mutate):
+    generator = make_generator()
+    generator.add_duty(generator.format_date(future_saturday(2)), ["Каримов Т.Р."], ["8-000"], False)
+    generator.link_telegram("karimov", "Каримов Т.Р.")
+    generator.get_schedule_text()
+    generator.get_employee_duties_text("Каримов Т.Р.")
+    version, misses = generator.version, generator.render_cache.misses
+
+    mutate(generator)
+
+    assert generator.version > version
+    generator.get_schedule_text()
+    generator.get_employee_duties_text("Каримов Т.Р.")
+    assert generator.render_cache.misses == misses + 2
+
+
+def test_fairness_text_is_cached_until_schedule_changes(monkeypatch):
+    generator = make_generator()
+    calls = []
+    duty_counts = generator.duty_counts
+    monkeypatch.setattr(generator, "duty_counts", lambda start, end: calls.append(start) or duty_counts(start, end))
+
+    text = generator.get_fairness_text()
+    assert "Дежурств на год вперед" in text
+    assert generator.get_fairness_text() == text
+    assert len(calls) == 1
+
+    generator.set_rotation(list(reversed(bot.DUTY_ROTATION_CIRCLE)))
+    generator.get_fairness_text()
+    assert len(calls) == 2
+
+
+def test_admin_stats_do_not_rebuild_schedule(monkeypatch):
+    from test_employee_ids import EditableQuery
+
+    duty_bot = bot.DutyBot("TEST")
+    generator = duty_bot.schedule_generator
+    monkeypatch.setattr(generator, "_generate_dynamic_schedule", None)
+    query = EditableQuery()
+
+    asyncio.run(duty_bot.show_admin_stats(query))
+    asyncio.run(duty_bot.show_admin_stats(query))
+
+    text, _ = query.edits[-1]
+    assert "Следующее дежурство" in text
+    assert "Дежурств на год вперед" in text
+    assert generator.render_cache.hits >= 1
+    duty_bot.user_store.close()
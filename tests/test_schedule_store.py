@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta
+
+import bot
+
+
+def future_saturday(weeks: int = 3) -> datetime:
+    today = datetime.now(bot.MOSCOW_TZ).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    return today + timedelta(days=(5 - today.weekday()) % 7, weeks=weeks)
+
+
+def make_generator(**kwargs) -> bot.DutyScheduleGenerator:
+    return bot.DutyScheduleGenerator(bot.ScheduleStore(**kwargs))
+
+
+def count_lines(path: str) -> int:
+    with open(path, encoding="utf-8") as f:
+        return sum(1 for _ in f)
+
+
+def test_edits_survive_restart():
+    sat = future_saturday()
+    date_str = bot.DutyScheduleGenerator.format_date(sat)
+    generator = make_generator()
+    assert generator.add_duty(date_str, ["Денисова Е.С.", "Каримов Т.Р."], ["1", "2"], True)[0]
+    assert generator.update_employee_phone("Осипов Р.Э", "8-000-000-00-00")
+    assert generator.add_employee("Новиков Н.Н.", "8-111-111-11-11")
+    generator.link_telegram("Novikov", "Новиков Н.Н.")
+    employee_id = generator.get_employee_id("Новиков Н.Н.")
+
+    restored = make_generator()
+
+    duty = restored.get_duty(sat)
+    assert duty["employees"] == ["Денисова Е.С.", "Каримов Т.Р."]
+    assert duty["is_pair"] is True
+    assert bot.EMPLOYEE_PHONES["Осипов Р.Э"] == "8-000-000-00-00"
+    assert bot.TELEGRAM_TO_EMPLOYEE["@novikov"] == "Новиков Н.Н."
+    assert restored.get_employee_by_id(employee_id) == "Новиков Н.Н."
+
+
+def test_removed_duty_is_not_replayed():
+    sat = future_saturday()
+    date_str = bot.DutyScheduleGenerator.format_date(sat)
+    generator = make_generator()
+    rotation_duty = generator.get_duty(sat)
+    generator.add_duty(date_str, ["Каримов Т.Р."], ["1"], False)
+    assert generator.remove_duty(date_str)
+
+    assert make_generator().get_duty(sat) == rotation_duty
+
+
+def test_rotation_change_is_persisted():
+    members = ["Каримов Т.Р.", "Денисова Е.С."]
+    generator = make_generator()
+    version = generator.version
+    generator.set_rotation(members)
+
+    assert generator.version == version + 1
+    assert generator.get_duty(bot.DutyScheduleGenerator.BASE_DATE)["employees"] == ["Каримов Т.Р."]
+
+    bot.DUTY_ROTATION_CIRCLE[:] = ["Осипов Р.Э"]
+    restored = make_generator()
+    assert bot.DUTY_ROTATION_CIRCLE == members
+    base = bot.DutyScheduleGenerator.BASE_DATE
+    assert restored.get_duty(base + timedelta(weeks=1))["employees"] == ["Денисова Е.С."]
+    assert restored.get_next_duty("Денисова Е.С.")["date_obj"].weekday() == 5
+
+
+def test_log_is_compacted_into_snapshot():
+    generator = make_generator(compact_every=5)
+    start = future_saturday()
+    for week in range(8):
+        date_str = bot.DutyScheduleGenerator.format_date(start + timedelta(weeks=week))
+        generator.add_duty(date_str, ["Каримов Т.Р."], [str(week)], False)
+
+    # Снимок и записи после него, а не вся история правок
+    assert count_lines(bot.SCHEDULE_STORE_FILE) < 5 + 1
+    state = bot.ScheduleStore().load()
+    assert len(state["overrides"]) == 8
+    assert state["rotation"] == list(bot.DUTY_ROTATION_CIRCLE)
+
+    restored = make_generator(compact_every=5)
+    for week in range(8):
+        assert restored.get_duty(start + timedelta(weeks=week))["phones"] == [str(week)]
+
+
+def test_corrupted_tail_is_skipped():
+    sat = future_saturday()
+    generator = make_generator()
+    generator.add_duty(bot.DutyScheduleGenerator.format_date(sat), ["Каримов Т.Р."], ["1"], False)
+    with open(bot.SCHEDULE_STORE_FILE, "a", encoding="utf-8") as f:
+        f.write('{"op": "duty_del", "da')
+
+    state = bot.ScheduleStore().load()
+    assert list(state["overrides"]) == [sat.toordinal()]
+
+
+def test_edits_after_torn_tail_survive_restart():
+    sat = future_saturday()
+    generator = make_generator()
+    generator.add_duty(bot.DutyScheduleGenerator.format_date(sat), ["Каримов Т.Р."], ["1"], False)
+    with open(bot.SCHEDULE_STORE_FILE, "a", encoding="utf-8") as f:
+        f.write('{"op": "duty_del", "da')
+
+    # Перезапуск после падения, затем новая правка
+    restarted = make_generator()
+    later = sat + timedelta(weeks=1)
+    assert restarted.add_duty(bot.DutyScheduleGenerator.format_date(later), ["Денисова Е.С."], ["2"], False)[0]
+
+    restored = make_generator()
+    assert restored.get_duty(sat)["employees"] == ["Каримов Т.Р."]
+    assert restored.get_duty(later)["employees"] == ["Денисова Е.С."]
+
+
+def test_read_journal_keeps_only_complete_lines(workdir):
+    path = workdir / "journal.jsonl"
+    path.write_bytes(b'{"a": 1}\n{"b": 2}\n{"c": 3}')
+
+    assert bot.read_journal(str(path)) == [{"a": 1}, {"b": 2}]
+    assert path.read_bytes() == b'{"a": 1}\n{"b": 2}\n'
+    assert bot.read_journal(str(path)) == [{"a": 1}, {"b": 2}]
@@ -0,0 +1,120 @@
+import json
+import sqlite3
+
+import bot
+
+LEGACY = {
+    "1": {"username": "ivanov", "first_name": "Иван", "notifications": True,
+          "selected_employee": "Каримов Т.Р.", "is_admin": False, "language": "ru"},
+    "2": {"username": "petrov", "notifications": False},
+}
+
+
+def write_legacy(users):
+    with open("user_data.json", 'w', encoding='utf-8') as f:
+        json.dump(users, f, ensure_ascii=False)
+
+
+def test_legacy_json_is_imported_once():
+    write_legacy(LEGACY)
+    store = bot.UserStore()
+    assert store.load_all() == LEGACY
+    store.delete_many(["2"])
+    store.close()
+
+    # Повторный запуск не импортирует файл заново и не воскрешает удаленных
+    write_legacy({**LEGACY, "3": {"username": "sidorov"}})
+    store = bot.UserStore()
+    assert store.load_all() == {"1": LEGACY["1"]}
+    store.close()
+
+
+def test_start_without_legacy_json():
+    store = bot.UserStore()
+    assert store.load_all() == {}
+    store.close()
+
+
+def test_upsert_touches_only_its_row():
+    store = bot.UserStore()
+    store.upsert_many(LEGACY.items())
+
+    store.upsert("1", {**LEGACY["1"], "notifications": False, "last_active": "2026-10-18T10:00:00"})
+    users = store.load_all()
+    assert users["1"]["notifications"] is False
+    assert users["1"]["last_active"] == "2026-10-18T10:00:00"
+    assert users["1"]["language"] == "ru"
+    assert users["2"] == LEGACY["2"]
+    assert store.find_by_username("IVANOV") == "1"
+    store.close()
+
+
+def test_delete_many_removes_only_given_users():
+    store = bot.UserStore()
+    store.upsert_many(LEGACY.items())
+    store.upsert("3", {"username": "sidorov"})
+
+    store.delete_many(["1", "3", "missing"])
+    assert store.load_all() == {"2": LEGACY["2"]}
+    assert store.find_by_username("ivanov") is None
+    store.close()
+
+
+def external_write(*statements):
+    conn = sqlite3.connect("user_data.db")
+    for sql, params in statements:
+        conn.execute(sql, params)
+    conn.commit()
+    conn.close()
+
+
+def test_refresh_picks_up_writes_from_another_connection():
+    duty_bot = bot.DutyBot("TEST")
+    duty_bot.user_store.upsert_many(LEGACY.items())
+    duty_bot.user_store.external_changes()
+    duty_bot.user_data = duty_bot.user_store.load_all()
+    user_data, ivanov = duty_bot.user_data, duty_bot.user_data["1"]
+
+    external_write(
+        ("UPDATE users SET notifications = 0 WHERE user_id = ?", ("1",)),
+        ("DELETE FROM users WHERE user_id = ?", ("2",)),
+        ("INSERT INTO users (user_id, username) VALUES (?, ?)", ("3", "sidorov")),
+    )
+    duty_bot.refresh_user_data()
+
+    # Словарь и записи обновляются на месте - ссылки на них остаются рабочими
+    assert duty_bot.user_data is user_data
+    assert duty_bot.user_data["1"] is ivanov
+    assert ivanov["notifications"] is False
+    assert set(user_data) == {"1", "3"}
+    assert user_data["3"] == {"username": "sidorov"}
+    duty_bot.user_store.close()
+
+
+def test_refresh_keeps_unsaved_bot_changes():
+    duty_bot = bot.DutyBot("TEST")
+    duty_bot.user_store.upsert_many(LEGACY.items())
+    duty_bot.user_store.external_changes()
+    duty_bot.user_data = duty_bot.user_store.load_all()
+    duty_bot.user_data["1"]["selected_employee"] = "Другой"
+    duty_bot.save_user_data("1")
+
+    external_write(("UPDATE users SET username = ? WHERE user_id = ?", ("ivanov2", "1")))
+    duty_bot.refresh_user_data()
+
+    assert duty_bot.user_data["1"]["selected_employee"] == "Другой"
+    duty_bot.user_store.close()
+
+
+def test_refresh_without_external_changes_does_not_reload(monkeypatch):
+    duty_bot = bot.DutyBot("TEST")
+    duty_bot.user_store.external_changes()
+    # Собственные записи бота data_version не меняют
+    duty_bot.user_store.upsert("1", LEGACY["1"])
+
+    def fail():
+        raise AssertionError("база перечитана без внешних изменений")
+
+    monkeypatch.setattr(duty_bot.user_store, "load_all", fail)
+    duty_bot.refresh_user_data()
+    duty_bot.user_store.close()
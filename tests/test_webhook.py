@@ -0,0 +1,163 @@
+import asyncio
+import json
+
+import pytest
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import bot
+
+SECRET = "s3cret"
+TOKEN = "1:TEST"
+START_UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1, "date": 0, "chat": {"id": 7, "type": "private"},
+        "from": {"id": 7, "is_bot": False, "first_name": "U", "username": "u"},
+        "text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    },
+}
+
+
+class FakeTelegramApi:
+    """Заглушка Bot API на том же HttpServer: запоминает вызовы и отвечает успехом"""
+
+    RESULTS = {
+        "getMe": {"id": 1, "is_bot": True, "first_name": "Bot", "username": "duty_bot"},
+        "sendMessage": {"message_id": 5, "date": 0, "chat": {"id": 7, "type": "private"}, "text": "ok"},
+    }
+
+    def __init__(self):
+        self.server = bot.HttpServer("127.0.0.1", 0)
+        self.calls = []
+        for method in ("getMe", "setWebhook", "deleteWebhook", "sendMessage"):
+            self.server.route("POST", f"/bot{TOKEN}/{method}", self._handler(method))
+
+    def _handler(self, method):
+        async def handle(headers, body):
+            self.calls.append(method)
+            payload = {"ok": True, "result": self.RESULTS.get(method, True)}
+            return 200, "application/json", json.dumps(payload).encode()
+        return handle
+
+
+async def request(port, raw: bytes) -> int:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(raw)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b" ", 2)[1])
+
+
+async def post(port, path, payload, secret) -> int:
+    body = json.dumps(payload).encode()
+    head = (f"POST {path} HTTP/1.1\r\nHost: test\r\nContent-Type: application/json\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\nContent-Length: {len(body)}\r\n\r\n")
+    return await request(port, head.encode() + body)
+
+
+async def wait_for(condition, timeout=5.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline, "условие не выполнилось"
+        await asyncio.sleep(0.02)
+
+
+def test_http_server_routes():
+    async def scenario():
+        async def ok(headers, body):
+            return 200, "text/plain", body
+
+        server = bot.HttpServer("127.0.0.1", 0)
+        server.route("POST", "/echo", ok)
+        await server.start()
+        try:
+            return [
+                await post(server.port, "/echo", {}, ""),
+                await request(server.port, b"GET /echo HTTP/1.1\r\n\r\n"),
+                await request(server.port, b"GET /missing HTTP/1.1\r\n\r\n"),
+                await request(server.port, b"garbage\r\n\r\n"),
+            ]
+        finally:
+            await server.stop()
+
+    assert asyncio.run(scenario()) == [200, 405, 404, 400]
+
+
+@pytest.mark.parametrize("length, expected", [
+    (b"abc", 400), (b"-1", 400), (b"+2", 400), (b"1e3", 400), (b"\xd9\xa3", 400),
+    (str(bot.HttpServer.MAX_BODY + 1).encode(), 413), (b"2", 200), (b"", 200),
+])
+def test_http_server_validates_content_length(length, expected):
+    async def scenario():
+        async def ok(headers, body):
+            return 200, "text/plain", body
+
+        server = bot.HttpServer("127.0.0.1", 0, read_timeout=0.5)
+        server.route("POST", "/echo", ok)
+        await server.start()
+        try:
+            return await request(server.port, b"POST /echo HTTP/1.1\r\nContent-Length: " + length + b"\r\n\r\n{}")
+        finally:
+            await server.stop()
+
+    assert asyncio.run(scenario()) == expected
+
+
+def test_http_server_times_out_slow_client():
+    async def scenario():
+        server = bot.HttpServer("127.0.0.1", 0, read_timeout=0.1)
+        await server.start()
+        try:
+            # Заголовки не дописаны - сервер не должен ждать вечно
+            return await asyncio.wait_for(
+                request(server.port, b"POST /webhook HTTP/1.1\r\nContent-Length: 10\r\n"), 2)
+        finally:
+            await server.stop()
+
+    assert asyncio.run(scenario()) == 408
+
+
+def test_webhook_checks_secret_and_dispatches(monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_URL", "https://example.org/telegram")
+    monkeypatch.setattr(bot, "WEBHOOK_LISTEN", "127.0.0.1")
+    monkeypatch.setattr(bot, "WEBHOOK_PORT", 0)
+    monkeypatch.setattr(bot, "WEBHOOK_PATH", "/telegram")
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", SECRET)
+    monkeypatch.setattr(bot, "METRICS_PORT", 0)
+
+    async def scenario():
+        api = FakeTelegramApi()
+        await api.server.start()
+        monkeypatch.setattr(bot, "TELEGRAM_BASE_URL", f"http://127.0.0.1:{api.server.port}/bot")
+
+        duty_bot = bot.DutyBot(TOKEN)
+        application = duty_bot.build_application()
+        received = []
+
+        async def collect(update, context):
+            received.append(update.update_id)
+
+        application.add_handler(TypeHandler(Update, collect), group=-5)
+        task = asyncio.create_task(duty_bot.run_webhook())
+        try:
+            await wait_for(lambda: "setWebhook" in api.calls)
+            port = duty_bot.webhook_server.port
+            statuses = [
+                await post(port, "/telegram", START_UPDATE, "wrong"),
+                await post(port, "/telegram", dict(START_UPDATE, update_id=2), SECRET),
+                await post(port, "/telegram", "not an update", SECRET),
+            ]
+            await wait_for(lambda: received)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await api.server.stop()
+        duty_bot.user_store.close()
+        return statuses, received
+
+    statuses, received = asyncio.run(scenario())
+    assert statuses == [403, 200, 400]
+    assert received == [2]